@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+import watcher
+import writer
+import pandas as pd
+import datetime
+import hashlib
+import json
+import os
+import re
+import threading
+
+
+# Manifest of the run (None means stages are not checkpointed)
+manifest = None
+# Folder with the manifest and the stage outputs
+folder = None
+lock = threading.Lock()
+
+
+def get_inputs(read_path,
+               county_name,
+               month,
+               settings = None):
+    """
+
+    Parameters
+    ----------
+    read_path : str
+        Full path of the data (all parent folders)
+    county_name : str
+        Name of the county folder, ex: 'Los Angeles County'
+    month : str
+        Year and month of the data, ex: '2023_06'
+    settings : dict, optional
+        Settings that change the outputs of every stage, ex: {'id_label': 'CDCNo'}
+        Default is None.
+
+    Returns
+    -------
+    dict
+        Size and modification time of the input files of the month and of the sorting criteria, and the settings
+        Checkpoints are only reused if the inputs did not change
+
+    """
+    county_path = '/'.join(l for l in [read_path, county_name] if l)
+    month_path = '/'.join(l for l in [county_path, month] if l)
+    return {'files': watcher.get_fingerprint(month_path, watcher.get_file_names()),
+            'sorting criteria': watcher.get_fingerprint(county_path, ['Criteria/sorting_criteria.xlsx']),
+            'settings': settings}
+
+
+def get_key(*objs):
+    """
+
+    Parameters
+    ----------
+    *objs
+        Objects that change the output of a stage, ex: the eligibility conditions of the scenario
+
+    Returns
+    -------
+    str
+        Hash of the objects. A checkpoint is only reused if it was saved with the same key
+
+    """
+    return hashlib.sha1(json.dumps(objs, sort_keys = True, default = str).encode()).hexdigest()
+
+
+def find_latest(output_path):
+    """
+
+    Parameters
+    ----------
+    output_path : str
+        Full path of the folder with one output folder per date of execution, ex: county_name/month/output/date of execution
+
+    Returns
+    -------
+    str or None
+        Most recent output folder with a checkpoint manifest. None if there is no such folder
+
+    """
+    if not os.path.exists(output_path):
+        return None
+    folders = [entry.path for entry in os.scandir(output_path) if os.path.exists(entry.path+'/checkpoint/manifest.json')]
+    if not folders:
+        return None
+    return max(folders, key = lambda path: os.path.getmtime(path+'/checkpoint/manifest.json'))
+
+
+def write_manifest():
+    """
+
+    Returns
+    -------
+    None.
+        Writes the manifest to the checkpoint folder. The file is replaced in one step so that a crash does not leave a partial manifest
+
+    """
+    with open(folder+'/manifest.json.tmp', 'w') as f:
+        json.dump(manifest, f, indent = 2)
+    os.replace(folder+'/manifest.json.tmp', folder+'/manifest.json')
+
+
+def start(write_path,
+          inputs,
+          resume = False):
+    """
+
+    Parameters
+    ----------
+    write_path : str
+        Full path of the output folder of the run. Checkpoints are written to its 'checkpoint' sub-folder
+    inputs : dict
+        Inputs of the run (see get_inputs())
+    resume : boolean, optional
+        Specify whether to reuse the checkpoints of an earlier run in the same output folder. They are only reused if the inputs did not change
+        Default is False.
+
+    Returns
+    -------
+    list
+        Names of the completed stages that can be reused
+
+    """
+    global manifest, folder
+    folder = write_path+'/checkpoint'
+
+    # If directory does not exist, then first create it
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    # Reuse the stages of the earlier run if its inputs are unchanged
+    if resume and os.path.exists(folder+'/manifest.json'):
+        with open(folder+'/manifest.json') as f:
+            manifest = json.load(f)
+        if manifest['inputs'] == json.loads(json.dumps(inputs)):
+            print('Resuming the run in', write_path, 'with completed stages:', ', '.join(manifest['stages'].keys()) or 'none')
+            return list(manifest['stages'].keys())
+        print('Warning: the inputs changed since the checkpoints in', write_path, 'were written, the run starts from the beginning')
+    elif resume:
+        print('Warning: no checkpoints found in', write_path+', the run starts from the beginning')
+
+    manifest = {'inputs': inputs, 'started': datetime.datetime.now().isoformat(timespec = 'seconds'), 'stages': {}}
+    write_manifest()
+    return []
+
+
+def get_file_name(stage):
+    """
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage, ex: 'eligibility adult'
+
+    Returns
+    -------
+    str
+        Name of the file of the stage output in the checkpoint folder
+
+    """
+    return re.sub(r'[^\w-]+', '_', stage)+'.pkl'
+
+
+def load(stage,
+         key = None):
+    """
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage, ex: 'extract'
+    key : str, optional
+        Key of the stage (see get_key())
+        Default is None.
+
+    Returns
+    -------
+    found : boolean
+        True if the stage was completed with the same key
+    obj : object
+        Output of the stage. None if it was not found
+
+    """
+    if manifest is None:
+        return False, None
+    with lock:
+        record = manifest['stages'].get(stage)
+    if record is None or record['key'] != key or not os.path.exists(folder+'/'+record['file']):
+        return False, None
+    return True, pd.read_pickle(folder+'/'+record['file'])
+
+
+def save(stage,
+         obj,
+         key = None):
+    """
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage, ex: 'extract'
+    obj : object
+        Output of the stage. Has to be picklable
+    key : str, optional
+        Key of the stage (see get_key())
+        Default is None.
+
+    Returns
+    -------
+    None.
+        Pickles the output and marks the stage as completed in the manifest
+
+    """
+    if manifest is None:
+        return
+    file_name = get_file_name(stage)
+    pd.to_pickle(obj, folder+'/'+file_name)
+    with lock:
+        manifest['stages'][stage] = {'file': file_name, 'key': key, 'finished': datetime.datetime.now().isoformat(timespec = 'seconds')}
+        write_manifest()
+
+
+def run(stage,
+        func,
+        key = None,
+        background = False):
+    """
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage, ex: 'extract'
+    func : function
+        Function without arguments that computes the output of the stage
+    key : str, optional
+        Key of the stage (see get_key())
+        Default is None.
+    background : boolean, optional
+        Specify whether to save the checkpoint with the background writer (see writer.submit()). It is then saved after the outputs the stage submitted before it, so that the stage is only marked as completed once its outputs are written
+        The output should not be modified afterwards
+        Default is False.
+
+    Returns
+    -------
+    obj : object
+        Output of the stage, loaded from the checkpoint if the stage was already completed
+
+    """
+    found, obj = load(stage, key = key)
+    if found:
+        print('Loaded', stage, 'from checkpoint')
+        return obj
+
+    obj = func()
+    if background:
+        writer.submit(save, stage, obj, key = key)
+    else:
+        save(stage, obj, key = key)
+    return obj
+
+
+def stop():
+    """
+
+    Returns
+    -------
+    None.
+        Stops checkpointing the stages
+
+    """
+    global manifest, folder
+    manifest = None
+    folder = None
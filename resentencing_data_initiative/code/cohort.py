@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+import helpers
+import utils
+import store
+import report
+import pandas as pd
+import os
+
+
+# Columns of the demographics data whose distribution is profiled
+cols = ['description', 'controlling offense', 'sex registrant', 'offense category']
+# Bins (in years) of the histograms of the time variables
+bins = {'age in years': [0, 18, 26, 36, 46, 56, 66, 76, 120],
+        'aggregate sentence in years': [0, 5, 10, 15, 20, 25, 30, 40, 50, 1000]}
+
+
+def gen_profile(el_cdcr_nums,
+                demographics,
+                current_commits,
+                id_label,
+                top = 20,
+                clean_col_names = True):
+    """
+
+    Parameters
+    ----------
+    el_cdcr_nums : list
+        CDCR numbers of the cohort
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated
+    current_commits : pandas dataframe
+        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
+    id_label : str
+        Name of the column with the CDCR IDs
+    top : int, optional
+        Number of most frequent values to keep for each variable (the histograms are always kept in full)
+        Default is 20.
+    clean_col_names : boolean, optional
+        Specify whether to clean column names. Applies the utils.clean() function on the column headers
+        Default is True
+
+    Returns
+    -------
+    profile : pandas dataframe
+        One row per variable and value with the count and the share (%) of the cohort (or of the current offenses of the cohort)
+        Variables are the description, controlling offense, sex registrant, offense category, current offense and the age and sentence length histograms
+
+    """
+    # Clean the column names
+    if clean_col_names:
+        # Shallow copies are renamed, since other stages can read the same datasets at the same time
+        demographics, current_commits = [df.set_axis([utils.clean(col, remove = ['\n']) for col in df.columns], axis = 1, copy = False) for df in [demographics, current_commits]]
+    id_label = utils.clean(id_label)
+
+    # Filter the data of the cohort once
+    cohort = store.take(store.gen_store(demographics, id_label, verbose = False), el_cdcr_nums)
+    commits = current_commits.loc[current_commits[id_label].isin(set(el_cdcr_nums)), ['offense']]
+
+    # Add the time variables if they are missing
+    if not all(col in cohort.columns for col in bins.keys()):
+        cohort, errors = helpers.gen_time_vars(df = cohort, id_label = id_label, merge = True)
+
+    # Bring every variable into a single long table: one row per individual (or current offense) and variable
+    values = cohort[[col for col in cols if col in cohort.columns]].astype(str)
+    for col, edges in bins.items():
+        values[col] = pd.cut(cohort[col], bins = edges, right = False).astype(str)
+    long = pd.concat([values.melt(var_name = 'variable', value_name = 'value'),
+                      commits.astype(str).rename(columns = {'offense': 'current offense'}).melt(var_name = 'variable', value_name = 'value')],
+                     ignore_index = True)
+
+    # Count every value of every variable in one grouped pass
+    profile = long.groupby(['variable', 'value'], sort = False).size().rename('count').reset_index()
+    totals = profile.groupby('variable', sort = False)['count'].transform('sum')
+    profile['share (%)'] = (100*profile['count']/totals).round(2)
+
+    # Keep the most frequent values of each variable and the histograms in the order of their bins
+    hist = profile['variable'].isin(list(bins.keys()))
+    freq = profile[~hist].sort_values(['variable', 'count'], ascending = [True, False]).groupby('variable', sort = False).head(top)
+    hist = profile[hist & (profile['value'] != 'nan')]
+    hist = hist.assign(order = hist['value'].str.extract(r'^\[(-?[\d.]+)', expand = False).astype(float)).sort_values(['variable', 'order']).drop(columns = 'order')
+
+    return pd.concat([freq, hist], ignore_index = True)
+
+
+def compare_profiles(profiles):
+    """
+
+    Parameters
+    ----------
+    profiles : dict
+        Profiles by label of the cohort (see gen_profile()), ex: {'adult': ..., 'juvenile': ...}
+
+    Returns
+    -------
+    pandas dataframe
+        Side by side comparison with one row per variable and value and the count and share (%) of each cohort (0 if a value does not occur in a cohort)
+
+    """
+    wide = pd.concat({label: profile.set_index(['variable', 'value'])[['count', 'share (%)']] for label, profile in profiles.items()}, axis = 1)
+    wide = wide.fillna(0)
+    # Counts are stored as floats after values missing in a cohort are filled
+    for label, col in wide.columns:
+        if col == 'count':
+            wide[(label, col)] = wide[(label, col)].astype(int)
+    wide.columns = [label+' '+col for label, col in wide.columns]
+    return wide.reset_index()
+
+
+def write_profiles(profiles,
+                   write_path,
+                   run_report = None,
+                   file_name = 'cohort_profiles.xlsx'):
+    """
+
+    Parameters
+    ----------
+    profiles : dict
+        Profiles by label of the cohort (see gen_profile())
+    write_path : str
+        Full path of the folder where the report should be written
+    run_report : list, optional
+        Records of the run (see report.track()). The records of the profiles are written to a 'Timings' sheet
+        Default is None.
+    file_name : str, optional
+        Name of the report file
+        Default is 'cohort_profiles.xlsx'.
+
+    Returns
+    -------
+    None.
+
+    """
+    # If directory does not exist, then first create it
+    if not os.path.exists(write_path):
+        os.makedirs(write_path)
+
+    # One sheet per cohort, the comparison of all the cohorts and the time spent profiling each cohort
+    with pd.ExcelWriter(write_path+'/'+file_name) as writer:
+        for label, profile in profiles.items():
+            profile.to_excel(writer, sheet_name = label[:31], index = False)
+        if len(profiles) > 1:
+            compare_profiles(profiles).to_excel(writer, sheet_name = 'Comparison', index = False)
+        if run_report:
+            pd.DataFrame([record for record in run_report if record['rule id'] == 'profile']).to_excel(writer, sheet_name = 'Timings', index = False)
+    print('Cohort profiles written to: ', write_path+'/'+file_name)
+
+
+def gen_profiles(el_cdcr_nums,
+                 demographics,
+                 current_commits,
+                 id_label,
+                 top = 20,
+                 write_path = None,
+                 run_report = None):
+    """
+
+    Parameters
+    ----------
+    el_cdcr_nums : dict
+        CDCR numbers of each cohort by label, ex: {'adult': [...], 'juvenile': [...]}
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated
+    current_commits : pandas dataframe
+        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
+    id_label : str
+        Name of the column with the CDCR IDs
+    top : int, optional
+        Number of most frequent values to keep for each variable
+        Default is 20.
+    write_path : str, optional
+        Full path of the folder where the report should be written. If None, nothing is written
+        Default is None.
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+
+    Returns
+    -------
+    profiles : dict
+        Profiles by label of the cohort (see gen_profile())
+
+    """
+    # Index the demographics once for all the cohorts
+    demographics = demographics.set_axis([utils.clean(col, remove = ['\n']) for col in demographics.columns], axis = 1, copy = False)
+    demographics = store.gen_store(demographics, utils.clean(id_label))
+
+    profiles = {}
+    for label, cdcr_nums in el_cdcr_nums.items():
+        with report.track(run_report, stage = label, rule_id = 'profile', input_size = len(cdcr_nums)) as record:
+            profiles[label] = gen_profile(el_cdcr_nums = cdcr_nums,
+                                          demographics = demographics,
+                                          current_commits = current_commits,
+                                          id_label = id_label,
+                                          top = top)
+            record['output size'] = len(profiles[label])
+
+    if write_path:
+        write_profiles(profiles, write_path = write_path, run_report = run_report)
+
+    return profiles
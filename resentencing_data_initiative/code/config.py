@@ -16,4 +16,42 @@ elif data_conn == 'aws ec2':
     write_data_path = None
 
 # Specify CDCR ID column
-id_label = 'CDCNo'
\ No newline at end of file
+id_label = 'CDCNo'
+
+# Profiling of the pipeline stages (can also be switched on with the THREE_STRIKES_PROFILE environment variable)
+profile = False
+# Record memory allocations of the profiled stages with tracemalloc (or set THREE_STRIKES_PROFILE_MEMORY)
+profile_memory = False
+
+# Memory budget in MB for the large stages (a warning is printed and the stage runs in chunks when it would be exceeded). None disables the check
+memory_budget_mb = None
+
+# Write the Excel outputs in a background thread while the next scenario runs. Number of outputs that can wait to be written (0 writes them immediately)
+max_pending_writes = 4
+
+# Reuse the pickled inputs of an earlier run for the input files that did not change (pickles are stored in the input folder of the month)
+cache_inputs = False
+
+# Checkpoint the output of every stage to the output folder, so that a failed run can be continued with run.py --resume
+checkpoint = True
+
+# Maximum number of pipeline stages that run at the same time (the scenarios are independent once the data is prepared, and each summary only depends on its scenario)
+max_workers = 1
+
+# Engine that evaluates the rules: 'pandas', or 'sqlite' or 'duckdb' to evaluate them in an in-memory database (duckdb has to be installed, SQLite is used otherwise)
+engine = 'pandas'
+
+# Stream the summaries in batches of CDCR numbers to a file ('xlsx', 'jsonl', 'csv' or 'parquet') instead of generating them at once, so that memory does not grow with the size of the cohort. None generates them at once
+summary_stream = None
+summary_batch_size = 10000
+
+# Number of worker processes that run the scenarios once the data is prepared (0 runs them in the main process). The prepared data is exported once and mapped read-only by every worker instead of being pickled to it (see shared.py). Scenarios run at the same time when max_workers is also raised
+processes = 0
+
+# Check the extracted data (required columns, dates and numbers that do not parse, duplicate and orphaned CDCR IDs) before any rule is applied, and write a data quality report (see quality.py)
+# The run stops if a required column is missing or fewer than min_parse_rate of the values of a date or number column parse
+check_quality = True
+min_parse_rate = 0.99
+
+# Margin as a share of each numerical threshold, ex: 0.1 for 10%. Individuals who meet all the other rules and miss the numerical thresholds by less than the margin are written as near misses next to the eligible individuals (see eligibility.gen_eligibility()). None does not look for near misses
+near_miss = None
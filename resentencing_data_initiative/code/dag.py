@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import time
+
+
+def gen_order(stages):
+    """
+
+    Parameters
+    ----------
+    stages : dict
+        Function and names of the input stages by name of the stage, ex: {'prepare': (func, ['extract']), ...}
+
+    Returns
+    -------
+    order : list
+        Names of the stages in an order in which every stage comes after its inputs
+
+    """
+    order = []
+    done = set()
+    remaining = list(stages.keys())
+    while remaining:
+        ready = [name for name in remaining if all(dep in done for dep in stages[name][1])]
+        if not ready:
+            missing = {name: [dep for dep in stages[name][1] if dep not in stages] for name in remaining}
+            missing = {name: deps for name, deps in missing.items() if deps}
+            if missing:
+                raise ValueError('Stages depend on stages that are not declared: '+str(missing))
+            raise ValueError('Stages depend on each other in a cycle: '+', '.join(remaining))
+        order += ready
+        done.update(ready)
+        remaining = [name for name in remaining if name not in done]
+    return order
+
+
+def get_critical_path(stages,
+                      schedule):
+    """
+
+    Parameters
+    ----------
+    stages : dict
+        Function and names of the input stages by name of the stage (see run())
+    schedule : dict
+        Start and end time (s) of each stage (see run())
+
+    Returns
+    -------
+    path : list
+        Names of the stages on the longest chain of dependent stages, i.e. the stages that bound the total wall time however many workers are used
+
+    """
+    # Longest chain (in wall time) that ends at each stage
+    length = {}
+    previous = {}
+    for name in gen_order(stages):
+        duration = schedule[name]['end'] - schedule[name]['start']
+        deps = stages[name][1]
+        best = max(deps, key = lambda dep: length[dep]) if deps else None
+        length[name] = duration + (length[best] if best else 0)
+        previous[name] = best
+
+    # Walk back from the end of the longest chain
+    name = max(length, key = length.get)
+    path = []
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return path[::-1]
+
+
+def run(stages,
+        max_workers = 1,
+        run_report = None):
+    """
+
+    Parameters
+    ----------
+    stages : dict
+        Function and names of the input stages by name of the stage, ex: {'extract': (run_extract, []), 'prepare': (run_prepare, ['extract'])}
+        Each function is called with the outputs of its input stages in the order they are listed
+    max_workers : int, optional
+        Maximum number of stages that run at the same time. Stages run in threads, so they can share data without copying it but they should not modify the outputs of other stages
+        Default is 1, i.e. the stages run one after the other in the order they are declared.
+    run_report : list, optional
+        Records of the run (see report.track()). A 'schedule' record is added for every stage with its start and end time and whether it is on the critical path
+        Default is None.
+
+    Returns
+    -------
+    outputs : dict
+        Output of every stage by name
+
+    """
+    order = gen_order(stages)
+    outputs = {}
+    schedule = {}
+    start = time.perf_counter()
+
+    def timed(name):
+        schedule[name] = {'start': time.perf_counter() - start}
+        try:
+            return stages[name][0](*[outputs[dep] for dep in stages[name][1]])
+        finally:
+            schedule[name]['end'] = time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'stage') as executor:
+        running = {}
+        try:
+            while len(outputs) < len(order):
+                # Submit every stage whose inputs are ready (in the order they are declared)
+                for name in order:
+                    if name not in outputs and name not in running.values() and all(dep in outputs for dep in stages[name][1]):
+                        running[executor.submit(timed, name)] = name
+                # Wait for a stage to finish. Errors stop the run once the running stages are done
+                done, not_done = wait(running.keys(), return_when = FIRST_COMPLETED)
+                for future in done:
+                    outputs[running.pop(future)] = future.result()
+        except BaseException:
+            for future in running:
+                future.cancel()
+            raise
+
+    # Record the schedule and the critical path
+    path = get_critical_path(stages, schedule)
+    print('Critical path:', ' -> '.join(path), '('+str(round(sum(schedule[name]['end'] - schedule[name]['start'] for name in path), 2))+' s of '+str(round(time.perf_counter() - start, 2))+' s)')
+    if run_report is not None:
+        for name in order:
+            run_report.append({'stage': name,
+                               'rule id': 'schedule',
+                               'category': None,
+                               'input size': None,
+                               'output size': None,
+                               'inputs': stages[name][1],
+                               'start (s)': round(schedule[name]['start'], 4),
+                               'end (s)': round(schedule[name]['end'], 4),
+                               'critical path': name in path})
+
+    return outputs
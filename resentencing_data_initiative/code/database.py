@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+import eligibility
+import utils
+import report
+import store
+from scenarios import rules
+import pandas as pd
+import numpy as np
+import sqlite3
+import threading
+
+try:
+    import duckdb
+except ImportError:
+    # SQLite (from the standard library) is used instead
+    duckdb = None
+
+
+# Engines that can evaluate the rules besides pandas
+engines = ['sqlite', 'duckdb']
+
+# Connection with the prepared datasets loaded, the engine and the datasets it was loaded from (the datasets are loaded once for all the scenarios)
+con = None
+loaded = None
+# Connections are shared by the scenarios that run at the same time, so queries and temporary tables are guarded by a lock
+lock = threading.RLock()
+
+# Registry of the SQL compilers of the rules (see register())
+compilers = {}
+
+
+def quote(col):
+    """
+
+    Parameters
+    ----------
+    col : str
+        Name of a table or column, ex: 'offense cleaned'
+
+    Returns
+    -------
+    str
+        Quoted name that can be used in a query, ex: '"offense cleaned"'
+
+    """
+    return '"'+col.replace('"', '""')+'"'
+
+
+def connect(engine = 'sqlite'):
+    """
+
+    Parameters
+    ----------
+    engine : str, optional
+        'sqlite' or 'duckdb'. If duckdb is not installed, SQLite is used instead
+        Default is 'sqlite'.
+
+    Returns
+    -------
+    connection
+        In-memory database connection that can be used by any thread
+
+    """
+    if engine not in engines:
+        raise ValueError('Unknown engine '+str(engine)+'. Available engines are: '+', '.join(['pandas']+engines))
+    if engine == 'duckdb':
+        if duckdb is not None:
+            return duckdb.connect(':memory:')
+        print('Warning: duckdb is not installed, SQLite is used instead')
+    return sqlite3.connect(':memory:', check_same_thread = False)
+
+
+def write_table(con,
+                name,
+                df):
+    """
+
+    Parameters
+    ----------
+    con : connection
+        Database connection (see connect())
+    name : str
+        Name of the table
+    df : pandas dataframe
+        Data of the table. Missing values are stored as NULL
+
+    Returns
+    -------
+    None.
+
+    """
+    # Missing values are stored as NULL, so that they do not meet any condition (as in utils.compare())
+    df = df.astype({col: 'Float64' for col in df.columns if pd.api.types.is_float_dtype(df[col])})
+    if isinstance(con, sqlite3.Connection):
+        df.to_sql(name, con, index = False, if_exists = 'replace')
+    else:
+        con.register('df_view', df)
+        con.execute('CREATE OR REPLACE TABLE '+quote(name)+' AS SELECT * FROM df_view')
+        con.unregister('df_view')
+
+
+def load(demographics,
+         current_commits,
+         prior_commits,
+         id_label,
+         engine = 'sqlite'):
+    """
+
+    Parameters
+    ----------
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated (prepared with eligibility.prep_data())
+    current_commits : pandas dataframe
+        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense (prepared with eligibility.prep_data())
+    prior_commits : pandas dataframe
+        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense (prepared with eligibility.prep_data())
+    id_label : str
+        Name of the column with the CDCR IDs
+    engine : str, optional
+        'sqlite' or 'duckdb' (see connect())
+        Default is 'sqlite'.
+
+    Returns
+    -------
+    con : connection
+        Database with the columns that the rules read, indexed on the CDCR IDs and the offenses
+        The demographics table also has the position ('pos') of each individual in the demographics, so that the results are returned as a cohort (see store.gen_mask())
+        The datasets are only loaded again if other datasets are passed
+
+    """
+    global con, loaded
+    with lock:
+        if (con is not None) and (loaded is not None) and (loaded[0] == engine) and all(a is b for a, b in zip(loaded[1:], [demographics, current_commits, prior_commits])):
+            return con
+
+        id_label = utils.clean(id_label)
+        # Columns that any registered rule reads
+        requirements = eligibility.gen_requirements({rule: {'use': True} for rule in eligibility.el_rules.keys()}, id_label)
+        con = connect(engine)
+        for name, df in [('demographics', demographics), ('current_commits', current_commits), ('prior_commits', prior_commits)]:
+            cols = [col for col in requirements[name] if col in df.columns]
+            table = df[cols].reset_index(drop = True)
+            if name == 'demographics':
+                table.insert(0, 'pos', np.arange(len(df)))
+            write_table(con, name, table)
+            # Index the CDCR IDs and the offense columns that are joined
+            for col in [id_label]+[col for col in cols if col.endswith(' cleaned')]:
+                con.execute('CREATE INDEX '+quote(name+' '+col)+' ON '+quote(name)+' ('+quote(col)+')')
+        loaded = (engine, demographics, current_commits, prior_commits)
+        print('Datasets loaded into', type(con).__module__.split('.')[0], 'for', len(demographics), 'CDCR numbers')
+    return con
+
+
+def write_codes(con,
+                name,
+                codes):
+    """
+
+    Parameters
+    ----------
+    con : connection
+        Database connection (see connect())
+    name : str
+        Name of the temporary table, ex: 'codes r_4'
+    codes : list or set
+        Offense codes, ex: the implied ineligible offenses of a rule
+
+    Returns
+    -------
+    str
+        Quoted name of the temporary table with the distinct codes in its 'code' column (indexed)
+
+    """
+    con.execute('DROP TABLE IF EXISTS '+quote(name))
+    con.execute('CREATE TEMP TABLE '+quote(name)+' (code TEXT PRIMARY KEY)')
+    codes = sorted(set(str(code) for code in codes))
+    if codes:
+        con.executemany('INSERT INTO '+quote(name)+' VALUES (?)', [(code,) for code in codes])
+    return quote(name)
+
+
+def has_offense(commits,
+                cols,
+                table,
+                id_label):
+    """
+
+    Parameters
+    ----------
+    commits : str
+        Table with the offenses, i.e. 'current_commits' or 'prior_commits'
+    cols : list
+        Offense columns that are checked, ex: ['offense cleaned']
+    table : str
+        Quoted name of the temporary table with the codes (see write_codes())
+    id_label : str
+        Name of the column with the CDCR IDs
+
+    Returns
+    -------
+    str
+        Condition that is True for the individuals (alias d) with at least one of the codes in any of the columns
+
+    """
+    cond = ' OR '.join('c.'+quote(col)+' IN (SELECT code FROM '+table+')' for col in cols)
+    return 'EXISTS (SELECT 1 FROM '+quote(commits)+' c WHERE c.'+quote(id_label)+' = d.'+quote(id_label)+' AND ('+cond+'))'
+
+
+def num_sql(con,
+            data,
+            eligibility_conditions,
+            rule,
+            id_label):
+    """
+
+    Parameters
+    ----------
+    con : connection
+        Database connection with the prepared datasets (see load())
+    data : dict
+        Prepared datasets by name (see eligibility.num_rule())
+    eligibility_conditions : dict
+        Data on all the rules, whether they should be applied or not and other specifications
+    rule : str
+        Key of a rule with numerical conditions (from rules.num), ex: 'r_1'
+    id_label : str
+        Name of the column with the CDCR IDs
+
+    Returns
+    -------
+    str
+        Condition on the demographics table (alias d) that is True for the individuals that meet the rule. Missing values do not meet any condition
+
+    """
+    conditions = eligibility.num_conditions(eligibility_conditions, rule)
+    if not conditions:
+        return '1 = 1'
+    return ' AND '.join('d.'+quote(cond['variable'])+' '+cond['operator']+' '+repr(float(cond['threshold'])) for cond in conditions)
+
+
+def offense_sql(commits,
+                tables,
+                exclude = True,
+                fixed = False):
+    """
+
+    Parameters
+    ----------
+    See eligibility.offense_rule().
+
+    Returns
+    -------
+    compile : function
+        SQL compiler of the rule (see num_sql() for its parameters and output). The offenses of the rule are written to a temporary table and joined with the commitments
+
+    """
+    def compile(con, data, eligibility_conditions, rule, id_label):
+        offenses = eligibility.sel_offenses(data['sorting_criteria'], tables, eligibility_conditions, rule, fixed = fixed)
+        cond = has_offense(commits, ['offense cleaned'], write_codes(con, 'codes '+rule, offenses), id_label)
+        return 'NOT '+cond if exclude else cond
+    return compile
+
+
+def controlling_sql(con,
+                    data,
+                    eligibility_conditions,
+                    rule,
+                    id_label):
+    """
+
+    Parameters
+    ----------
+    See num_sql().
+
+    Returns
+    -------
+    str
+        Condition that is True for the individuals whose controlling offense is in Table F or its implied offenses
+
+    """
+    offenses = eligibility.sel_offenses(data['sorting_criteria'], ['Table F'], eligibility_conditions, rule, fixed = True)
+    return 'd."controlling offense cleaned" IN (SELECT code FROM '+write_codes(con, 'codes '+rule, offenses)+')'
+
+
+def enh_sql(con,
+            data,
+            eligibility_conditions,
+            rule,
+            id_label):
+    """
+
+    Parameters
+    ----------
+    See num_sql().
+
+    Returns
+    -------
+    str
+        Condition that is True for the individuals without a current offense or enhancement that matches any of the patterns of the rule
+        Each distinct code is matched with the patterns once (as in utils.match_patterns()), the matching codes are then joined with the commitments
+
+    """
+    cols = ['offense cleaned', 'off_enh1 cleaned', 'off_enh2 cleaned', 'off_enh3 cleaned', 'off_enh4 cleaned']
+    regex = utils.compile_patterns(eligibility_conditions[rule].get('patterns', rules.enh[rule]))
+    codes = set()
+    for col in cols:
+        codes.update(str(code) for code in data['current_commits'][col].dropna().unique() if regex.search(str(code)))
+    return 'NOT '+has_offense('current_commits', cols, write_codes(con, 'codes '+rule, codes), id_label)
+
+
+def r12_sql(con,
+            data,
+            eligibility_conditions,
+            rule,
+            id_label):
+    """
+
+    Parameters
+    ----------
+    See num_sql().
+
+    Returns
+    -------
+    str
+        Condition that is True for the individuals without an ineligible current offense (see eligibility.r12_rule())
+
+    """
+    # Ineligible offenses are generated as in the pandas engine, only the join is done in the database
+    inel_offenses = eligibility.r12_offenses(data['sorting_criteria'], eligibility_conditions, rule)
+    return 'NOT '+has_offense('current_commits', ['offense cleaned'], write_codes(con, 'codes '+rule, inel_offenses), id_label)
+
+
+def register(rule,
+             compile):
+    """
+
+    Parameters
+    ----------
+    rule : str
+        Key of the rule in the rule registry (see eligibility.register()), ex: 'r_1'
+    compile : function
+        Function called with the connection, the prepared datasets, the eligibility conditions, the key of the rule and the name of the ID column, which returns the SQL condition of the rule (see num_sql())
+
+    Returns
+    -------
+    None.
+
+    """
+    compilers[rule] = compile
+
+
+register('r_1', num_sql)
+register('r_2', num_sql)
+register('r_3', num_sql)
+register('r_4', offense_sql('current_commits', ['Table A', 'Table B', 'Table C', 'Table D']))
+register('r_5', offense_sql('prior_commits', ['Table C', 'Table D']))
+register('r_6', num_sql)
+register('r_7', offense_sql('current_commits', ['Table E', 'Table D']))
+register('r_8', offense_sql('prior_commits', ['Table D']))
+register('r_9', offense_sql('current_commits', ['Table F'], exclude = False, fixed = True))
+register('r_10', controlling_sql)
+register('r_11', enh_sql)
+register('r_12', r12_sql)
+register('r_13', num_sql)
+
+
+def apply_rules(demographics,
+                sorting_criteria,
+                current_commits,
+                prior_commits,
+                eligibility_conditions,
+                id_label,
+                el_cdcr_nums = None,
+                skip = [],
+                run_report = None,
+                stage = None,
+                engine = 'sqlite',
+                as_mask = False):
+    """
+    Parameters
+    ----------
+    See eligibility.apply_rules(). The rules are evaluated in a single query of the database engine instead of pandas
+    engine : str, optional
+        'sqlite' or 'duckdb' (see connect())
+        Default is 'sqlite'.
+
+    Returns
+    -------
+    el_cdcr_nums : list of strs or numpy array
+        List of CDCR numbers that meet all the rules in use (in the order of the demographics), or a boolean array if as_mask = True. Same result as eligibility.apply_rules()
+    """
+    demographics = store.gen_store(demographics, utils.clean(id_label), verbose = False)
+    data = {'demographics': demographics, 'sorting_criteria': sorting_criteria, 'current_commits': current_commits, 'prior_commits': prior_commits}
+    eligibility.check_inputs(data, eligibility_conditions, skip = skip)
+    mask = store.gen_mask(demographics, el_cdcr_nums)
+    in_use = [rule for rule in eligibility.el_rules.keys() if eligibility_conditions[rule]['use'] and (rule not in skip)]
+    missing = [rule for rule in in_use if rule not in compilers]
+    if missing:
+        raise ValueError('Rules '+', '.join(missing)+' cannot be evaluated with SQL. Register their SQL compilers (see database.register()) or use the pandas engine')
+
+    with lock:
+        # Load the prepared datasets (only once for all the scenarios that share them)
+        with report.track(run_report, stage = stage, rule_id = 'load database', input_size = len(demographics)) as record:
+            con = load(demographics, current_commits, prior_commits, id_label, engine = engine)
+            record['output size'] = len(demographics)
+
+        # Compile every rule in use to a condition on the demographics table (the offenses of each rule are written to temporary tables)
+        conds = []
+        for rule in in_use:
+            with report.track(run_report, stage = stage, rule_id = rule, category = eligibility_conditions[rule]['category']) as record:
+                record['cost'] = eligibility.el_rules[rule]['cost']
+                conds.append('('+compilers[rule](con, data, eligibility_conditions, rule, utils.clean(id_label))+')')
+
+        # Positions of the individuals that meet all the rules
+        with report.track(run_report, stage = stage, rule_id = 'sql rules', input_size = np.count_nonzero(mask)) as record:
+            query = 'SELECT d.pos FROM demographics d'+(' WHERE '+' AND '.join(conds) if conds else '')
+            pos = np.array([row[0] for row in con.execute(query).fetchall()], dtype = np.int64)
+            meets = np.zeros(len(demographics), dtype = bool)
+            meets[pos] = True
+            mask &= meets
+            record['output size'] = np.count_nonzero(mask)
+    print('Count of CDCR numbers that meet all the rules is: ', np.count_nonzero(mask), '\n')
+
+    if as_mask:
+        return mask
+    return store.get_ids(demographics, mask)
@@ -1,853 +1,857 @@
 # -*- coding: utf-8 -*-
 import helpers
 import utils
-import impl
+import report
+import store
+import tables as offense_tables
+import writer
 from scenarios import rules
 import pandas as pd
 import numpy as np
 import datetime
-from tqdm import tqdm
 import copy
 import os
 
 
-def viz_eligibility(el_cdcr_nums,  
-                    id_label,
-                    demographics,
-                    current_commits):
+def num_conditions(eligibility_conditions, 
+                   rule):
     """
 
     Parameters
     ----------
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing
-    demographics : pandas dataframe
-        Data on demographics of both juveniles and adults
-    current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    id_label : str
-        Name of the column with the CDCR IDs    
+    eligibility_conditions : dict
+        Data on all the rules, whether they should be applied or not and other specifications
+    rule : str
+        Key of a rule with numerical conditions (from rules.num), ex: 'r_1'
 
     Returns
     -------
-    None.
+    conditions : list of dicts
+        Variable, operator and threshold of each numerical condition of the rule. Thresholds passed in eligibility_conditions[rule]['thresholds'] replace the defaults in rules.num
+        Raises a ValueError if the thresholds are not a list with one number per condition of the rule
 
     """
+    conditions = copy.deepcopy(rules.num[rule])
+    # Replace the default thresholds with the ones specified in the scenario
+    if 'thresholds' in eligibility_conditions[rule]:
+        thresholds = eligibility_conditions[rule]['thresholds']
+        # One number per condition, ex: [14, 16] for r_6 (booleans are not accepted as numbers)
+        if (not isinstance(thresholds, (list, tuple))) or (len(thresholds) != len(conditions)) or any(isinstance(t, bool) or not isinstance(t, (int, float, np.number)) for t in thresholds):
+            raise ValueError('Thresholds of rule '+rule+' must be a list of '+str(len(conditions))+' number(s), one for each of: '+', '.join(cond['variable']+' '+cond['operator'] for cond in conditions)+'. Got: '+repr(thresholds))
+        for cond, threshold in zip(conditions, thresholds):
+            cond['threshold'] = threshold
+    return conditions
 
-    print('Top 20 offenses of individuals (from demographics data)')
-    print(demographics[demographics[id_label].isin(el_cdcr_nums)]['Description'].value_counts()[0:20])
 
-    print('Top 20 controlling offenses of individuals (from demographics data)')
-    demographics[demographics[id_label].isin(el_cdcr_nums)]['Controlling Offense'].value_counts()[0:20]
+def num_mask(demographics, 
+             conditions):
+    """
 
-    print('Top 20 current sentences of individuals (from current commits data)')
-    current_commits[current_commits[id_label].isin(el_cdcr_nums)]['Offense'].value_counts()[0:20]
+    Parameters
+    ----------
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated with the time variables (see helpers.gen_time_vars())
+    conditions : list of dicts
+        Variable, operator ('>=', '>', '<=' or '<') and threshold of each numerical condition (see num_conditions())
 
-    print('Sex offenses')
-    print(demographics[demographics[id_label].isin(el_cdcr_nums)]['Sex Registrant'].value_counts())
+    Returns
+    -------
+    mask : pandas series
+        Boolean values that are True for the individuals that meet ALL the conditions. Individuals with missing values do not meet any condition
 
-    print('Type of offenses')
-    print(demographics[demographics[id_label].isin(el_cdcr_nums)]['Offense Category'].value_counts())
+    """
+    mask = pd.Series(True, index = demographics.index)
+    for cond in conditions:
+        mask &= utils.compare(demographics[cond['variable']], cond['operator'], cond['threshold'])
+    return mask
 
-    return
 
-    
-def eligibility_r1(demographics, 
-                   sorting_criteria,
-                   current_commits, 
-                   prior_commits, 
-                   eligibility_conditions,
-                   id_label,
-                   el_cdcr_nums = None):
+def gen_distances(demographics, 
+                  eligibility_conditions, 
+                  id_label, 
+                  margin):
     """
+
     Parameters
     ----------
-    sorting_criteria : pandas dataframe
-        Data on offenses and their categories or tables
     demographics : pandas dataframe
-        Data on individuals currently incarcerated
-    current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
+        Data on individuals currently incarcerated with the time variables (see helpers.gen_time_vars())
     eligibility_conditions : dict
         Data on all the rules, whether they should be applied or not and other specifications
     id_label : str
         Name of the column with the CDCR IDs
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
-        Default is None.
+    margin : float
+        Share of each threshold within which an individual who does not meet it is a near miss, ex: 0.1 for 10%
+
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
-    """
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_1']['desc'])
-    print('Rule category: ', eligibility_conditions['r_1']['category'])
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        # Extracting CDCR numbers with eligible ages
-        el_cdcr_nums = demographics[(demographics['age in years'] >= 50) & (demographics[id_label].isin(el_cdcr_nums))][id_label].to_list()
-    # If this is the first eligibility condition being checked
-    else:
-        # Extracting CDCR numbers with eligible ages
-        el_cdcr_nums = demographics[(demographics['age in years'] >= 50)][id_label].to_list()
-    
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
+    distances : pandas dataframe
+        For each individual (same index as demographics) and each numerical condition of the rules in use: the signed distance to the threshold (positive or zero when it is met) and whether it is met
+        Also contains whether ALL the numerical conditions are met, whether the individual is a near miss (does not meet all of them, but every condition that is not met is within the margin) and the date when the individual will meet all of them (only if every condition that is not met is on a variable that increases with time)
 
+    """
+    distances = pd.DataFrame({id_label: demographics[id_label]}, index = demographics.index)
+    passes = pd.Series(True, index = demographics.index)
+    near = pd.Series(True, index = demographics.index)
+    # Years until all the conditions are met (NaN if a condition will never be met with time)
+    years_left = pd.Series(0.0, index = demographics.index)
+    
+    for rule in [r for r in rules.num.keys() if eligibility_conditions[r]['use']]:
+        for cond in num_conditions(eligibility_conditions, rule):
+            label = rule+': '+cond['variable']+' '+cond['operator']+' '+str(cond['threshold'])
+            values = demographics[cond['variable']]
+            # Signed distance, i.e. how far the value is on the eligible side of the threshold
+            if cond['operator'] in ['>=', '>']:
+                dist = values - cond['threshold']
+            else:
+                dist = cond['threshold'] - values
+            met = utils.compare(values, cond['operator'], cond['threshold'])
+            distances[label+' distance'] = dist
+            distances[label+' met'] = met
+            
+            passes &= met
+            # Conditions that are not met must be within the margin (missing values are never near)
+            near &= met | (-dist <= margin*abs(cond['threshold']))
+            # Only variables that increase with time will eventually meet a lower bound
+            if (cond['variable'] in rules.increasing) and (cond['operator'] in ['>=', '>']):
+                years_left = years_left.where(met, np.maximum(years_left, -dist))
+            else:
+                years_left = years_left.where(met, np.nan)
+    
+    distances['meets numerical rules'] = passes
+    distances['near miss'] = near & ~passes
+    distances['eta'] = (pd.Timestamp(datetime.date.today()) + pd.to_timedelta(np.ceil(years_left*365), unit = 'D')).where(distances['near miss'])
+    
+    return distances
 
-def eligibility_r2(demographics, 
-                   sorting_criteria,
-                   current_commits, 
-                   prior_commits, 
-                   eligibility_conditions,
-                   id_label,
-                   el_cdcr_nums = None):
+    
+def gen_enh_hits(current_commits, 
+                 eligibility_conditions, 
+                 rule, 
+                 id_label):
     """
+
     Parameters
     ----------
-    sorting_criteria : pandas dataframe
-        Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
     current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
+        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense (with the cleaned offense and enhancement columns)
     eligibility_conditions : dict
         Data on all the rules, whether they should be applied or not and other specifications
+    rule : str
+        Key of an enhancement rule (from rules.enh), ex: 'r_11'
     id_label : str
         Name of the column with the CDCR IDs
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
-        Default is None.
+
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
-    """
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_2']['desc'])
-    print('Rule category: ', eligibility_conditions['r_2']['category'])
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        # Extracting CDCR numbers that met the age criteria that also meet the time sentenced criteria
-        el_cdcr_nums = demographics[(demographics['aggregate sentence in years'] >= 20) & (demographics[id_label].isin(el_cdcr_nums))][id_label].to_list()
-    else:
-        el_cdcr_nums = demographics[(demographics['aggregate sentence in years'] >= 20)][id_label].to_list()
-    
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
+    hits : pandas dataframe
+        Whether any current offense or enhancement of each CDCR number matches the patterns of the rule and the matching codes (see utils.match_patterns())
+        Patterns passed in eligibility_conditions[rule]['patterns'] replace the defaults in rules.enh
 
+    """
+    return utils.match_patterns(data = current_commits, 
+                                id_label = id_label, 
+                                cols = ['offense cleaned', 'off_enh1 cleaned', 'off_enh2 cleaned', 'off_enh3 cleaned', 'off_enh4 cleaned'], 
+                                patterns = eligibility_conditions[rule].get('patterns', rules.enh[rule]))
 
-def eligibility_r3(demographics, 
-                   sorting_criteria,
-                   current_commits, 
-                   prior_commits, 
-                   eligibility_conditions,
-                   id_label,
-                   el_cdcr_nums = None):
+    
+def sel_offenses(sorting_criteria, 
+                 tables, 
+                 eligibility_conditions, 
+                 rule, 
+                 fixed = False):
     """
+
     Parameters
     ----------
     sorting_criteria : pandas dataframe
         Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
-    current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
+    tables : list
+        Tables of the sorting criteria to select offenses from, ex: ['Table C', 'Table D']
     eligibility_conditions : dict
         Data on all the rules, whether they should be applied or not and other specifications
-    id_label : str
-        Name of the column with the CDCR IDs    
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
-        Default is None.
+    rule : str
+        Key of the rule, ex: 'r_4'. Its implied ineligibility and permutations are taken from eligibility_conditions
+    fixed : boolean, optional
+        Specify whether the rule also specifies fixed positions and placeholders of the implied offenses
+        Default is False.
+
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
+    list
+        Cleaned offenses of the tables and their implied offenses (see tables.gen_index())
+
     """
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_3']['desc'])
-    print('Rule category: ', eligibility_conditions['r_3']['category'])
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        # Extracting CDCR numbers that met the age criteria that also meet the time served criteria
-        el_cdcr_nums = demographics[(demographics['time served in years'] >= 10) & (demographics[id_label].isin(el_cdcr_nums))][id_label].to_list() 
-    else:
-        el_cdcr_nums = demographics[(demographics['time served in years'] >= 10)][id_label].to_list() 
-    
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
+    index = offense_tables.gen_index(sorting_criteria, offense_tables.gen_spec(eligibility_conditions, rule, fixed = fixed))
+    return offense_tables.sel_offenses(index, offense_tables.gen_mask(index, tables))
 
 
-def eligibility_r4(demographics, 
-                   sorting_criteria,
-                   current_commits, 
-                   prior_commits, 
-                   eligibility_conditions,
-                   id_label,
-                   el_cdcr_nums = None):
+def table_hits(data, 
+               col, 
+               sorting_criteria, 
+               tables, 
+               eligibility_conditions, 
+               rule, 
+               fixed = False):
     """
+
     Parameters
     ----------
+    data : pandas dataframe
+        Prepared data with a column of cleaned offenses, ex: the current commitments
+    col : str
+        Name of the column with the cleaned offenses, ex: 'offense cleaned'
     sorting_criteria : pandas dataframe
         Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
-    current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
+    tables : list
+        Tables of the sorting criteria (or derived tables, see tables.derived) with the offenses of the rule, ex: ['Table C', 'Table D']
     eligibility_conditions : dict
         Data on all the rules, whether they should be applied or not and other specifications
-    id_label : str
-        Name of the column with the CDCR IDs    
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
-        Default is None.
-    
+    rule : str
+        Key of the rule, ex: 'r_4'. Its implied ineligibility and permutations are taken from eligibility_conditions
+    fixed : boolean, optional
+        Specify whether the rule also specifies fixed positions and placeholders of the implied offenses
+        Default is False.
+
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
+    numpy array
+        True for the rows whose offense is in one of the tables or is implied by one of their offenses
+
     """
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_4']['desc'])
-    print('Rule category: ', eligibility_conditions['r_4']['category'])
-    
-    # Extracting ineligible offenses from sorting criteria
-    inel_offenses = sorting_criteria[sorting_criteria['Table'].isin(['Table A', 'Table B', 'Table C', 'Table D'])]['Offenses'].tolist()
-    # Appending new offenses based on implied ineligibility
-    inel_offenses = impl.gen_impl_off(offenses = inel_offenses, 
-                                      impl_rel = eligibility_conditions['r_4']['implied ineligibility'],
-                                      perm = eligibility_conditions['r_4']['perm'], 
-                                      fix_pos = None, 
-                                      placeholder = None,
-                                      how = 'inclusive',
-                                      sep = '',
-                                      clean = True)
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        eval_cdcr_nums = el_cdcr_nums
-    else:
-        eval_cdcr_nums = demographics[id_label].unique()
-    
-    # Initialize list to capture eligible CDCR numbers
-    el_cdcr_nums_4 = []
-    # Loop through all the CDCR numbers to evaluate eligibility
-    for cdcr_num in tqdm(eval_cdcr_nums):
-        # Extract offenses of the CDCR number
-        offenses = current_commits[current_commits[id_label] == cdcr_num]['offense cleaned']
-        if len(utils.val_search(data = offenses, sel = inel_offenses)) == 0:
-            el_cdcr_nums_4.append(cdcr_num)
-    
-    # Store eligible CDCR numbers
-    el_cdcr_nums = el_cdcr_nums_4
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
-    
+    # The offenses are mapped to the bitmask of their tables once, and the rule is a bitwise test on the bitmasks
+    index = offense_tables.gen_index(sorting_criteria, offense_tables.gen_spec(eligibility_conditions, rule, fixed = fixed))
+    return (offense_tables.lookup(data, col, index) & offense_tables.gen_mask(index, tables)) != 0
+
 
-def eligibility_r5(demographics, 
-                   sorting_criteria,
-                   current_commits, 
-                   prior_commits, 
-                   eligibility_conditions,
-                   id_label,
-                   el_cdcr_nums = None):
+def gen_hits(data, 
+             commits, 
+             id_label, 
+             rows):
     """
+
     Parameters
     ----------
-    sorting_criteria : pandas dataframe
-        Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
-    current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
-    eligibility_conditions : dict
-        Data on all the rules, whether they should be applied or not and other specifications
+    data : dict
+        Prepared datasets by name (see prep_data())
+    commits : str
+        Dataset with the offenses, i.e. 'current_commits' or 'prior_commits'
     id_label : str
-        Name of the column with the CDCR IDs    
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
-        Default is None.
-    
+        Name of the column with the CDCR IDs
+    rows : numpy array
+        True for the matching rows of the offenses (see table_hits())
+
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
+    hit : numpy array
+        True for the individuals (rows of the demographics) with at least one matching offense
+
     """
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_5']['desc'])
-    print('Rule category: ', eligibility_conditions['r_5']['category'])
-    
-    # Extracting ineligible offenses from sorting criteria
-    inel_offenses = sorting_criteria[sorting_criteria['Table'].isin(['Table C', 'Table D'])]['Offenses'].tolist()
-    # Appending new offenses based on implied ineligibility
-    inel_offenses = impl.gen_impl_off(offenses = inel_offenses, 
-                                      impl_rel = eligibility_conditions['r_5']['implied ineligibility'],
-                                      perm = eligibility_conditions['r_5']['perm'], 
-                                      fix_pos = None, 
-                                      placeholder = None,
-                                      how = 'inclusive',
-                                      sep = '',
-                                      clean = True)
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        eval_cdcr_nums = el_cdcr_nums
-    else:
-        eval_cdcr_nums = demographics[id_label].unique()
-    
-    # Initialize list to capture eligible CDCR numbers
-    el_cdcr_nums_5 = []
-    for cdcr_num in tqdm(eval_cdcr_nums):
-        # Extract offenses of the CDCR number
-        offenses = prior_commits[prior_commits[id_label] == cdcr_num]['offense cleaned']
-        if len(utils.val_search(data = offenses, sel = inel_offenses)) == 0:
-            el_cdcr_nums_5.append(cdcr_num)
-    
-    # Store eligible CDCR numbers
-    el_cdcr_nums = el_cdcr_nums_5
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
+    # Rows of the offenses are mapped to the rows of the demographics once (see tables.locate())
+    pos = offense_tables.locate(data['demographics'], data[commits], id_label)[rows]
+    hit = np.zeros(len(data['demographics']), dtype = bool)
+    hit[pos[pos >= 0]] = True
+    return hit
 
 
-def eligibility_r6(demographics, 
-                    sorting_criteria,
-                    current_commits, 
-                    prior_commits, 
-                    eligibility_conditions,
-                    id_label,
-                    el_cdcr_nums = None):
+def num_rule(data, 
+             eligibility_conditions, 
+             rule, 
+             id_label,
+             explain = False):
     """
+
     Parameters
     ----------
-    sorting_criteria : pandas dataframe
-        Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
-    current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
+    data : dict
+        Prepared datasets by name, i.e. 'demographics', 'sorting_criteria', 'current_commits' and 'prior_commits' (see prep_data())
     eligibility_conditions : dict
         Data on all the rules, whether they should be applied or not and other specifications
+    rule : str
+        Key of a rule with numerical conditions (from rules.num), ex: 'r_1'
     id_label : str
         Name of the column with the CDCR IDs
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
-        Default is None.
-    
+    explain : boolean, optional
+        Specify whether to also return the offending codes of the individuals that do not meet the rule
+        Default is False.
+
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
-    """        
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_6']['desc'])
-    print('Rule category: ', eligibility_conditions['r_6']['category'])
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        # Extracting CDCR numbers that meet the age criteria
-        el_cdcr_nums = demographics[(demographics['age during offense'] < 16) & (demographics['age during offense'] >= 14) & (demographics[id_label].isin(el_cdcr_nums))][id_label].to_list()
-    else:
-        el_cdcr_nums = demographics[(demographics['age during offense'] < 16) & (demographics['age during offense'] >= 14)][id_label].to_list()
-    
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
+    meets : pandas series
+        Boolean values indexed by CDCR number (same index as the demographics) that are True for the individuals that meet the rule
+    codes : pandas series or None
+        Only returned if explain = True. Offending codes of the individuals that do not meet the rule, joined with ', ' and indexed by CDCR number (see utils.match_codes()). None for rules that do not check offenses
 
+    """
+    # Individuals that meet the numerical conditions of the rule (thresholds can be overridden in the scenario)
+    meets = num_mask(demographics = data['demographics'], conditions = num_conditions(eligibility_conditions, rule))
+    if explain:
+        return meets, None
+    return meets
 
-def eligibility_r7(demographics, 
-                    sorting_criteria,
-                    current_commits, 
-                    prior_commits, 
-                    eligibility_conditions,
-                    id_label,
-                    el_cdcr_nums = None):
+
+def offense_rule(commits, 
+                 tables, 
+                 exclude = True, 
+                 fixed = False):
     """
+
     Parameters
     ----------
-    sorting_criteria : pandas dataframe
-        Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
-    current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
-    eligibility_conditions : dict
-        Data on all the rules, whether they should be applied or not and other specifications
-    id_label : str
-        Name of the column with the CDCR IDs    
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
-        Default is None.
-    
+    commits : str
+        Dataset with the offenses that are checked, i.e. 'current_commits' or 'prior_commits'
+    tables : list
+        Tables of the sorting criteria with the offenses of the rule, ex: ['Table C', 'Table D']
+    exclude : boolean, optional
+        Specify whether individuals with at least one of the offenses do not meet the rule (True) or are the only ones that meet it (False)
+        Default is True.
+    fixed : boolean, optional
+        Specify whether the rule also specifies fixed positions and placeholders of the implied offenses (see sel_offenses())
+        Default is False.
+
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
-    """        
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_7']['desc'])
-    print('Rule category: ', eligibility_conditions['r_7']['category'])
-    
-    # Extracting ineligible offenses from sorting criteria
-    inel_offenses = sorting_criteria[sorting_criteria['Table'].isin(['Table E', 'Table D'])]['Offenses'].tolist()
-    inel_offenses = impl.gen_impl_off(offenses = inel_offenses, 
-                                      impl_rel = eligibility_conditions['r_7']['implied ineligibility'],
-                                      perm = eligibility_conditions['r_7']['perm'], 
-                                      fix_pos = None, 
-                                      placeholder = None,
-                                      how = 'inclusive',
-                                      sep = '',
-                                      clean = True)
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        eval_cdcr_nums = el_cdcr_nums
-    else:
-        eval_cdcr_nums = demographics[id_label].unique()
-        
-    # Extracting CDCR numbers that meet the age criteria and offense eligibility
-    el_cdcr_nums_7 = []
-    for cdcr_num in tqdm(eval_cdcr_nums):
-        # Extracting offenses of the CDCR number
-        offenses = current_commits[current_commits[id_label] == cdcr_num]['offense cleaned']
-        if len(utils.val_search(data = offenses, sel = inel_offenses)) == 0:
-            el_cdcr_nums_7.append(cdcr_num)
-    
-    # Store eligible CDCR numbers
-    el_cdcr_nums = el_cdcr_nums_7
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
+    evaluate : function
+        Evaluate function of the rule (see num_rule() for its parameters and output)
+
+    """
+    def evaluate(data, eligibility_conditions, rule, id_label, explain = False):
+        rows = table_hits(data[commits], 'offense cleaned', data['sorting_criteria'], tables, eligibility_conditions, rule, fixed = fixed)
+        # CDCR numbers with at least one of the offenses (single pass over the offenses, no per-person filtering)
+        if explain and exclude:
+            codes = utils.match_codes(data = data[commits], id_label = id_label, col = 'offense cleaned', sel = rows)
+            hit = data['demographics'].index.isin(codes.index)
+        else:
+            codes = None
+            hit = gen_hits(data, commits, id_label, rows)
+        meets = pd.Series(~hit if exclude else hit, index = data['demographics'].index)
+        # Individuals who do not meet an inclusive rule have none of the offenses, so there are no offending codes
+        if explain:
+            return meets, codes
+        return meets
+    return evaluate
 
 
-def eligibility_r8(demographics, 
-                   sorting_criteria,
-                   current_commits, 
-                   prior_commits, 
-                   eligibility_conditions,
-                   id_label,
-                   el_cdcr_nums = None):
+def controlling_rule(data, 
+                     eligibility_conditions, 
+                     rule, 
+                     id_label,
+                     explain = False):
     """
+
+    Parameters
+    ----------
+    See num_rule().
+
+    Returns
+    -------
+    meets : pandas series
+        True for the individuals whose controlling offense is in Table F or its implied offenses
+    codes : pandas series or None
+        Only returned if explain = True. Controlling offense of the individuals that do not meet the rule
+
+    """
+    # Controlling offenses are mapped to the bitmask of their tables
+    controlling = data['demographics']['controlling offense cleaned']
+    meets = pd.Series(table_hits(data['demographics'], 'controlling offense cleaned', data['sorting_criteria'], ['Table F'], eligibility_conditions, rule, fixed = True), index = controlling.index)
+    if explain:
+        return meets, controlling[~meets].dropna().astype(str)
+    return meets
+
+
+def enh_rule(data, 
+             eligibility_conditions, 
+             rule, 
+             id_label,
+             explain = False):
+    """
+
+    Parameters
+    ----------
+    See num_rule().
+
+    Returns
+    -------
+    meets : pandas series
+        True for the individuals without a current offense or enhancement that matches any of the patterns of the rule (see gen_enh_hits())
+    codes : pandas series or None
+        Only returned if explain = True. Matching offenses and enhancements of the individuals that do not meet the rule
+
+    """
+    hits = gen_enh_hits(current_commits = data['current_commits'], 
+                        eligibility_conditions = eligibility_conditions, 
+                        rule = rule, 
+                        id_label = id_label)
+    meets = pd.Series(~data['demographics'].index.isin(hits.index[hits['hit'].values]), index = data['demographics'].index)
+    if explain:
+        return meets, hits.loc[hits['hit'].values, 'matched codes']
+    return meets
+
+
+def r12_offenses(sorting_criteria, 
+                 eligibility_conditions, 
+                 rule):
+    """
+
     Parameters
     ----------
     sorting_criteria : pandas dataframe
         Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
-    current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
     eligibility_conditions : dict
         Data on all the rules, whether they should be applied or not and other specifications
+    rule : str
+        Key of the rule, ex: 'r_12'. Its implied ineligibility and permutations are taken from eligibility_conditions
+
+    Returns
+    -------
+    inel_offenses : list
+        Cleaned offenses in Table A, B, C or D (minus Table F and its implied offenses) and their implied offenses
+
+    """
+    # The offenses of Table A, B, C or D minus Table F and its implied offenses are a derived table of the index (see tables.derived)
+    return sel_offenses(sorting_criteria, list(offense_tables.derived.keys()), eligibility_conditions, rule)
+
+
+def r12_rule(data, 
+             eligibility_conditions, 
+             rule, 
+             id_label,
+             explain = False):
+    """
+
+    Parameters
+    ----------
+    See num_rule().
+
+    Returns
+    -------
+    meets : pandas series
+        True for the individuals without a current offense in Table A, B, C or D (minus Table F and its implied offenses) or their implied offenses
+    codes : pandas series or None
+        Only returned if explain = True. Ineligible current offenses of the individuals that do not meet the rule
+
+    """
+    rows = table_hits(data['current_commits'], 'offense cleaned', data['sorting_criteria'], list(offense_tables.derived.keys()), eligibility_conditions, rule)
+    # CDCR numbers with at least one ineligible offense
+    if explain:
+        codes = utils.match_codes(data = data['current_commits'], id_label = id_label, col = 'offense cleaned', sel = rows)
+        return pd.Series(~data['demographics'].index.isin(codes.index), index = data['demographics'].index), codes
+    hit = gen_hits(data, 'current_commits', id_label, rows)
+    return pd.Series(~hit, index = data['demographics'].index)
+
+
+# Registry of the eligibility rules in the order they are applied (see register())
+el_rules = {}
+
+# Columns added by prep_data() and the columns of the extracted data they are computed from
+derived = {'demographics': {'age in years': ['birthday'],
+                            'aggregate sentence in years': ['aggregate sentence in months'],
+                            'time served in years': ['offense end date'],
+                            'age during offense': ['birthday', 'offense end date'],
+                            'controlling offense cleaned': ['controlling offense']},
+           'current_commits': {'offense cleaned': ['offense'],
+                               'off_enh1 cleaned': ['off_enh1'],
+                               'off_enh2 cleaned': ['off_enh2'],
+                               'off_enh3 cleaned': ['off_enh3'],
+                               'off_enh4 cleaned': ['off_enh4']},
+           'prior_commits': {'offense cleaned': ['offense']}}
+
+
+def register(rule, 
+             inputs, 
+             cost, 
+             evaluate):
+    """
+
+    Parameters
+    ----------
+    rule : str
+        Key of the rule in the scenarios, ex: 'r_1'
+    inputs : dict
+        Columns of each dataset that the rule reads (after prep_data()), ex: {'demographics': ['age in years']}
+    cost : str
+        Cost class of the rule, i.e. 'low' (comparisons on the demographics), 'medium' (pattern matching on the offenses) or 'high' (generation of implied offenses)
+    evaluate : function
+        Function called with the prepared datasets, the eligibility conditions, the key of the rule and the name of the ID column, which returns whether each individual meets the rule (see num_rule())
+        It also takes explain = True, in which case it returns the offending codes of the individuals that do not meet the rule as well
+
+    Returns
+    -------
+    None.
+
+    """
+    el_rules[rule] = {'inputs': inputs, 'cost': cost, 'evaluate': evaluate}
+
+
+register('r_1', {'demographics': ['age in years']}, 'low', num_rule)
+register('r_2', {'demographics': ['aggregate sentence in years']}, 'low', num_rule)
+register('r_3', {'demographics': ['time served in years']}, 'low', num_rule)
+register('r_4', {'current_commits': ['offense cleaned'], 'sorting_criteria': ['Table', 'Offenses']}, 'high', offense_rule('current_commits', ['Table A', 'Table B', 'Table C', 'Table D']))
+register('r_5', {'prior_commits': ['offense cleaned'], 'sorting_criteria': ['Table', 'Offenses']}, 'high', offense_rule('prior_commits', ['Table C', 'Table D']))
+register('r_6', {'demographics': ['age during offense']}, 'low', num_rule)
+register('r_7', {'current_commits': ['offense cleaned'], 'sorting_criteria': ['Table', 'Offenses']}, 'high', offense_rule('current_commits', ['Table E', 'Table D']))
+register('r_8', {'prior_commits': ['offense cleaned'], 'sorting_criteria': ['Table', 'Offenses']}, 'high', offense_rule('prior_commits', ['Table D']))
+register('r_9', {'current_commits': ['offense cleaned'], 'sorting_criteria': ['Table', 'Offenses']}, 'high', offense_rule('current_commits', ['Table F'], exclude = False, fixed = True))
+register('r_10', {'demographics': ['controlling offense cleaned'], 'sorting_criteria': ['Table', 'Offenses']}, 'high', controlling_rule)
+register('r_11', {'current_commits': ['offense cleaned', 'off_enh1 cleaned', 'off_enh2 cleaned', 'off_enh3 cleaned', 'off_enh4 cleaned']}, 'medium', enh_rule)
+register('r_12', {'current_commits': ['offense cleaned'], 'sorting_criteria': ['Table', 'Offenses']}, 'high', r12_rule)
+register('r_13', {'demographics': ['time served in years']}, 'low', num_rule)
+
+
+def gen_requirements(eligibility_conditions, 
+                     id_label, 
+                     extracted = False):
+    """
+
+    Parameters
+    ----------
+    eligibility_conditions : dict or list of dicts
+        Conditions of one or more scenarios. Only the rules in use are taken into account
     id_label : str
-        Name of the column with the CDCR IDs    
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
-        Default is None.
-    
+        Name of the column with the CDCR IDs
+    extracted : boolean, optional
+        Specify whether to return the columns of the extracted data, i.e. the columns that the columns added by prep_data() are computed from (see derived)
+        Default is False.
+
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
+    requirements : dict
+        Sorted (cleaned) column names of each dataset that the rules in use read, ex: {'demographics': ['age in years', 'cdcno'], ...}
+
     """
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_8']['desc'])
-    print('Rule category: ', eligibility_conditions['r_8']['category'])
-    
-    # Extracting ineligible offenses from sorting criteria
-    inel_offenses = sorting_criteria[sorting_criteria['Table'].isin(['Table D'])]['Offenses'].tolist()
-    inel_offenses = impl.gen_impl_off(offenses = inel_offenses, 
-                                      impl_rel = eligibility_conditions['r_8']['implied ineligibility'],
-                                      perm = eligibility_conditions['r_8']['perm'], 
-                                      fix_pos = None, 
-                                      placeholder = None,
-                                      how = 'inclusive',
-                                      sep = '',
-                                      clean = True)
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        eval_cdcr_nums = el_cdcr_nums
-    else:
-        eval_cdcr_nums = demographics[id_label].unique()
-        
-    # Extracting CDCR numbers that met the age, time sentenced and current and prior offense eligibility criteria
-    el_cdcr_nums_8 = []
-    for cdcr_num in tqdm(eval_cdcr_nums):
-       offenses = prior_commits[prior_commits[id_label] == cdcr_num]['offense cleaned']
-       if len(utils.val_search(data = offenses, sel = inel_offenses)) == 0:
-           el_cdcr_nums_8.append(cdcr_num)
-    
-    # Store eligible CDCR numbers
-    el_cdcr_nums = el_cdcr_nums_8
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
+    if isinstance(eligibility_conditions, dict):
+        eligibility_conditions = [eligibility_conditions]
+    id_label = utils.clean(id_label)
+
+    requirements = {'demographics': {id_label}, 'current_commits': {id_label}, 'prior_commits': {id_label}, 'sorting_criteria': set()}
+    for el_cond in eligibility_conditions:
+        for rule in el_rules.keys():
+            if el_cond[rule]['use']:
+                for name, cols in el_rules[rule]['inputs'].items():
+                    requirements[name].update(cols)
 
+    # Replace the columns added by prep_data() with the columns they are computed from (the time variables are always added)
+    if extracted:
+        requirements['demographics'].update(['age in years', 'aggregate sentence in years', 'time served in years', 'age during offense'])
+        for name, cols in derived.items():
+            requirements[name] = set(src for col in requirements[name] for src in derived[name].get(col, [col]))
 
-def eligibility_r9(demographics, 
-                   sorting_criteria,
-                   current_commits, 
-                   prior_commits, 
-                   eligibility_conditions,
-                   id_label,
-                   el_cdcr_nums = None):
+    return {name: sorted(cols) for name, cols in requirements.items()}
+
+
+def prep_data(demographics, 
+              current_commits, 
+              prior_commits, 
+              id_label,
+              clean_col_names = True,
+              run_report = None,
+              stage = None,
+              requirements = None):
     """
     Parameters
     ----------
-    sorting_criteria : pandas dataframe
-        Data on offenses and their categories or tables
     demographics : pandas dataframe
         Data on individuals currently incarcerated
     current_commits : pandas dataframe
         Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
     prior_commits : pandas dataframe
         Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
-    eligibility_conditions : dict
-        Data on all the rules, whether they should be applied or not and other specifications
     id_label : str
         Name of the column with the CDCR IDs    
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
+    clean_col_names : boolean, optional
+        Specify whether to clean column names. Applies the utils.clean() function on the column headers
+        Default is True
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+    stage : str, optional
+        Name of the stage in the run report, ex: 'adult'
         Default is None.
+    requirements : dict, optional
+        Columns that the rules in use read (see gen_requirements()). Only the offense columns in it are cleaned
+        Default is None, i.e. all the offense columns are cleaned.
     
     Returns
     -------
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated with the time variables and the cleaned controlling offense, indexed by CDCR ID (see store.gen_store())
     errors : pandas dataframe
         Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
     """
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_9']['desc'])
-    print('Rule category: ', eligibility_conditions['r_9']['category'])
+    # Clean the column names 
+    if clean_col_names:
+        for df in [demographics, current_commits, prior_commits]:
+            df.columns = [utils.clean(col, remove = ['\n']) for col in df.columns]
+    else:
+        print('Since column names are not cleaned, several required variables for the eligibility model cannot be found')
+     
+    # Add all of the time variables to the demographic data necessary for classification - years served, sentence length, age, etc.
+    with report.track(run_report, stage = stage, rule_id = 'time variables', input_size = len(demographics)) as record:
+        demographics, errors = helpers.gen_time_vars(df = demographics, id_label = utils.clean(id_label), merge = True)
+        record['output size'] = len(demographics) - len(errors)
     
-    # Extracting specified offenses from sorting criteria
-    sel_offenses = sorting_criteria[sorting_criteria['Table'].isin(['Table F'])]['Offenses'].tolist()
-    sel_offenses = impl.gen_impl_off(offenses = sel_offenses, 
-                                     impl_rel = eligibility_conditions['r_9']['implied ineligibility'],
-                                     perm = eligibility_conditions['r_9']['perm'], 
-                                     fix_pos = eligibility_conditions['r_9']['fix positions'], 
-                                     placeholder = eligibility_conditions['r_9']['placeholder'],
-                                     how = 'inclusive',
-                                     sep = '',
-                                     clean = True)
+    # Offense columns to clean in each dataset (only the ones the rules in use read if requirements are passed)
+    names = {name: {src[0]: col for col, src in derived[name].items() if col.endswith(' cleaned') and (requirements is None or col in requirements[name])} for name in ['demographics', 'current_commits', 'prior_commits']}
     
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        eval_cdcr_nums = el_cdcr_nums
-    else:
-        eval_cdcr_nums = demographics[id_label].unique()
-        
-    # Extracting CDCR numbers that meet the age criteria and offense eligibility
-    el_cdcr_nums_9 = []
-    for cdcr_num in tqdm(eval_cdcr_nums):
-        # Extracting offenses of the CDCR number
-        offenses = current_commits[current_commits[id_label] == cdcr_num]['offense cleaned']
-        if len(utils.val_search(data = offenses, sel = sel_offenses)) >= 1:
-            el_cdcr_nums_9.append(cdcr_num)
+    # Clean offense data in all the commitment datasets
+    with report.track(run_report, stage = stage, rule_id = 'clean offenses', input_size = len(current_commits) + len(prior_commits)) as record:
+        # Clean offense data and enhancements data in current commits, offense data in prior commits and the controlling offense in demographics
+        for df, name in [(current_commits, 'current_commits'), (prior_commits, 'prior_commits'), (demographics, 'demographics')]:
+            if names[name]:
+                utils.clean_blk(data = df, names = names[name], inplace = True)
+        record['output size'] = len(current_commits) + len(prior_commits)
     
-    # Store eligible CDCR numbers
-    el_cdcr_nums = el_cdcr_nums_9   
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
+    # Index the demographics by CDCR ID so that the rows of any CDCR number can be looked up directly
+    demographics = store.gen_store(demographics, utils.clean(id_label))
     
-    return el_cdcr_nums
+    return demographics, errors
 
 
-def eligibility_r10(demographics, 
-                    sorting_criteria,
-                    current_commits, 
-                    prior_commits, 
-                    eligibility_conditions,
-                    id_label,
-                    el_cdcr_nums = None):
+def check_inputs(data, 
+                 eligibility_conditions, 
+                 skip = []):
     """
+
     Parameters
     ----------
-    sorting_criteria : pandas dataframe
-        Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
-    current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
+    data : dict
+        Prepared datasets by name (see num_rule())
     eligibility_conditions : dict
         Data on all the rules, whether they should be applied or not and other specifications
-    id_label : str
-        Name of the column with the CDCR IDs    
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
-        Default is None.
-    
+    skip : list, optional
+        Rules that are not applied even if they are in use, ex: ['r_1']
+        Default is [].
+
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-    
-    """        
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_10']['desc'])
-    print('Rule category: ', eligibility_conditions['r_10']['category'])
-    
-    # Extracting specified offenses from sorting criteria
-    sel_offenses = sorting_criteria[sorting_criteria['Table'].isin(['Table F'])]['Offenses'].tolist()
-    sel_offenses = impl.gen_impl_off(offenses = sel_offenses, 
-                                     impl_rel = eligibility_conditions['r_10']['implied ineligibility'],
-                                     perm = eligibility_conditions['r_10']['perm'], 
-                                     fix_pos = eligibility_conditions['r_10']['fix positions'], 
-                                     placeholder = eligibility_conditions['r_10']['placeholder'],
-                                     how = 'inclusive',
-                                     sep = '',
-                                     clean = True)
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        eval_cdcr_nums = el_cdcr_nums
-    else:
-        eval_cdcr_nums = demographics[id_label].unique()
-        
-    # Extracting CDCR numbers that meet the age criteria and offense eligibility
-    el_cdcr_nums_10 = []
-    for cdcr_num in tqdm(eval_cdcr_nums):
-        # Extracting offenses of the CDCR number
-        controlling_offense = demographics[demographics[id_label] == cdcr_num]['controlling offense cleaned'].values[0]
-        if controlling_offense in sel_offenses:
-            el_cdcr_nums_10.append(cdcr_num)
-    
-    # Store eligible CDCR numbers
-    el_cdcr_nums = el_cdcr_nums_10 
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
+    None.
+        Raises a ValueError if a rule in use reads a column that is missing
 
+    """
+    for rule in el_rules.keys():
+        if eligibility_conditions[rule]['use'] and (rule not in skip):
+            for name, cols in el_rules[rule]['inputs'].items():
+                missing = [col for col in cols if col not in data[name].columns]
+                if missing:
+                    raise ValueError('Rule '+rule+' reads columns that are missing in '+name+': '+', '.join(missing)+'. Prepare the data with prep_data() and the requirements of the rules in use (see gen_requirements())')
 
-def eligibility_r11(demographics, 
-                    sorting_criteria,
-                    current_commits, 
-                    prior_commits, 
-                    eligibility_conditions,
-                    id_label,
-                    el_cdcr_nums = None):
+
+def apply_rules(demographics, 
+                sorting_criteria,
+                current_commits, 
+                prior_commits, 
+                eligibility_conditions,
+                id_label,
+                el_cdcr_nums = None,
+                skip = [],
+                run_report = None,
+                stage = None,
+                exclusions = None,
+                as_mask = False):
     """
     Parameters
     ----------
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated (prepared with prep_data())
     sorting_criteria : pandas dataframe
         Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
     current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
+        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense (prepared with prep_data())
     prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
+        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense (prepared with prep_data())
     eligibility_conditions : dict
         Data on all the rules, whether they should be applied or not and other specifications
     id_label : str
         Name of the column with the CDCR IDs    
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
+    el_cdcr_nums : list or numpy array, optional
+        CDCR numbers to evaluate, or a boolean array with one value per row of the prepared demographics (see store.gen_mask()). An empty cohort stays empty, i.e. no rule is evaluated
+        Default is None, i.e. the entire population is evaluated.
+    skip : list, optional
+        Rules that should not be applied even if they are in use, ex: ['r_1']
+        Default is [].
+    run_report : list, optional
+        Records of the run (see report.track())
         Default is None.
+    stage : str, optional
+        Name of the stage in the run report, ex: 'adult'
+        Default is None.
+    exclusions : dict, optional
+        If passed, the rule that excluded each CDCR number is stored in it, ex: {'A12345': 'r_4'}
+        Default is None.
+    as_mask : boolean, optional
+        Specify whether to return the cohort as a boolean array over the rows of the prepared demographics instead of a list of CDCR numbers (see store.get_ids())
+        Default is False.
     
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-    
-    """        
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_11']['desc'])
-    print('Rule category: ', eligibility_conditions['r_11']['category'])
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        eval_cdcr_nums = el_cdcr_nums
-    else:
-        eval_cdcr_nums = demographics[id_label].unique()
-        
-    # Extracting CDCR numbers that meet the age criteria and offense eligibility
-    el_cdcr_nums_11 = []
-    for cdcr_num in tqdm(eval_cdcr_nums):
-        # Extracting offenses of the CDCR number
-        offenses = current_commits[current_commits[id_label] == cdcr_num][['offense cleaned', 'off_enh1 cleaned', 'off_enh2 cleaned', 'off_enh3 cleaned', 'off_enh4 cleaned']].values.flatten()
-        # If sel offenses is not in any of the offenses (contains and not matches exactly)
-        if len(utils.val_search(data = offenses, sel = ['12022'], how = 'contains')) == 0:
-            el_cdcr_nums_11.append(cdcr_num)
-    
-    # Store eligible CDCR numbers
-    el_cdcr_nums = el_cdcr_nums_11 
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
+    el_cdcr_nums : list of strs or numpy array
+        List of CDCR numbers that meet all the rules in use (in the order of the demographics), or a boolean array if as_mask = True
+    """
+    # Index the demographics by CDCR ID (the rules return whether each individual meets them by CDCR ID)
+    demographics = store.gen_store(demographics, utils.clean(id_label), verbose = False)
+    data = {'demographics': demographics, 'sorting_criteria': sorting_criteria, 'current_commits': current_commits, 'prior_commits': prior_commits}
+    
+    # Check that the columns the rules in use declare are available before any rule is applied
+    check_inputs(data, eligibility_conditions, skip = skip)
+    
+    # Cohort as a boolean array over the rows of the demographics, so that rules are combined without looking up CDCR numbers
+    mask = store.gen_mask(demographics, el_cdcr_nums)
+    count = np.count_nonzero(mask)
+    
+    # Check all eligibility conditions in the order they are specified
+    for rule in el_rules.keys():
+        if eligibility_conditions[rule]['use'] and (rule not in skip):
+            # Nobody is left to evaluate
+            if count == 0:
+                print('No CDCR numbers are left, the remaining rules are not evaluated \n')
+                break
+            print('Finding CDCR numbers that meet rule: ', eligibility_conditions[rule]['desc'])
+            print('Rule category: ', eligibility_conditions[rule]['category'])
+            with report.track(run_report, 
+                              stage = stage, 
+                              rule_id = rule, 
+                              category = eligibility_conditions[rule]['category'],
+                              input_size = count) as record:
+                record['cost'] = el_rules[rule]['cost']
+                # Evaluate the rule on the whole population at once and keep the CDCR numbers that meet it
+                meets = el_rules[rule]['evaluate'](data, eligibility_conditions, rule, utils.clean(id_label))
+                if not meets.index.equals(demographics.index):
+                    meets = meets.reindex(demographics.index, fill_value = False)
+                meets = meets.values.astype(bool)
+                # Record the CDCR numbers excluded by the rule
+                if exclusions is not None:
+                    exclusions.update(dict.fromkeys(store.get_ids(demographics, mask & ~meets), rule))
+                mask &= meets
+                count = np.count_nonzero(mask)
+                record['output size'] = count
+            print('Count of CDCR numbers that meet rule is: ', count, '\n')
+    
+    if as_mask:
+        return mask
+    return store.get_ids(demographics, mask)
 
 
-def eligibility_r12(demographics, 
-                    sorting_criteria,
-                    current_commits, 
-                    prior_commits, 
-                    eligibility_conditions,
-                    id_label,
-                    el_cdcr_nums = None):
+def gen_explanations(demographics, 
+                     sorting_criteria,
+                     current_commits, 
+                     prior_commits, 
+                     eligibility_conditions,
+                     id_label,
+                     run_report = None,
+                     stage = None):
     """
     Parameters
     ----------
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated (prepared with prep_data())
     sorting_criteria : pandas dataframe
         Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
     current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
+        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense (prepared with prep_data())
     prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
+        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense (prepared with prep_data())
     eligibility_conditions : dict
         Data on all the rules, whether they should be applied or not and other specifications
     id_label : str
         Name of the column with the CDCR IDs    
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+    stage : str, optional
+        Name of the stage in the run report, ex: 'adult'
         Default is None.
     
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
-    """        
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_12']['desc'])
-    print('Rule category: ', eligibility_conditions['r_12']['category'])
-    
-    # Extracting ineligible offenses from sorting criteria
-    inel_offenses = utils.clean_blk(sorting_criteria[sorting_criteria['Table'].isin(['Table A', 'Table B', 'Table C', 'Table D'])]['Offenses'].tolist())
-    # Implied ineligible offenses for table F
-    f_inel_offenses = impl.gen_impl_off(offenses = sorting_criteria[sorting_criteria['Table'] == 'Table F']['Offenses'].tolist(), 
-                                        impl_rel = {'all': ['/att', '(664)', '2nd', "(ss)"]},
-                                        perm = 4,                        
-                                        fix_pos = {"2nd": 0, "(ss)": 0}, 
-                                        placeholder = {"ss": ['a', 'b', 'c']}, 
-                                        how = 'inclusive',
-                                        clean = True, 
-                                        sep = '')
-    # Combining all ineligible offenses
-    inel_offenses = list(set(inel_offenses).difference(set(f_inel_offenses)))
-    
-    # Generating implied offenses for baseline ineligible offenses and combining results
-    inel_offenses = impl.gen_impl_off(offenses = inel_offenses, 
-                                      impl_rel = eligibility_conditions['r_12']['implied ineligibility'],
-                                      perm = eligibility_conditions['r_12']['perm'], 
-                                      fix_pos = None, 
-                                      placeholder = None,
-                                      how = 'inclusive',
-                                      sep = '',
-                                      clean = True)
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        eval_cdcr_nums = el_cdcr_nums
-    else:
-        eval_cdcr_nums = demographics[id_label].unique()
-        
-    # Extracting CDCR numbers that meet the age criteria and offense eligibility
-    el_cdcr_nums_12 = []
-    for cdcr_num in tqdm(eval_cdcr_nums):
-        # Extracting offenses of the CDCR number
-        offenses = current_commits[current_commits[id_label] == cdcr_num]['offense cleaned']
-        if len(utils.val_search(data = offenses, sel = inel_offenses)) == 0:
-            el_cdcr_nums_12.append(cdcr_num)
-    
-    # Store eligible CDCR numbers
-    el_cdcr_nums = el_cdcr_nums_12
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
-    
-    return el_cdcr_nums
+    explanations : pandas dataframe
+        Indexed by CDCR number for the entire population. Whether each individual meets each rule in use (one boolean column per rule) and whether they meet all of them ('eligible')
+        For the rules that check offenses, the offending codes of the individuals that do not meet the rule are in a '<rule> offending codes' column, ex: 'r_4 offending codes'
+    """
+    # Index the demographics by CDCR ID (the rules return whether each individual meets them by CDCR ID)
+    demographics = store.gen_store(demographics, utils.clean(id_label), verbose = False)
+    data = {'demographics': demographics, 'sorting_criteria': sorting_criteria, 'current_commits': current_commits, 'prior_commits': prior_commits}
+    check_inputs(data, eligibility_conditions)
+    
+    # Evaluate every rule in use on the entire population, i.e. the rules are not applied as successive filters
+    meets = {}
+    codes = {}
+    for rule in el_rules.keys():
+        if eligibility_conditions[rule]['use']:
+            print('Explaining rule: ', eligibility_conditions[rule]['desc'])
+            with report.track(run_report, 
+                              stage = stage, 
+                              rule_id = rule, 
+                              category = eligibility_conditions[rule]['category'],
+                              input_size = len(demographics)) as record:
+                record['cost'] = el_rules[rule]['cost']
+                rule_meets, rule_codes = el_rules[rule]['evaluate'](data, eligibility_conditions, rule, utils.clean(id_label), explain = True)
+                meets[rule] = rule_meets.reindex(demographics.index, fill_value = False).values.astype(bool)
+                # Offending codes are only kept for the individuals who do not meet the rule
+                if rule_codes is not None:
+                    codes[rule+' offending codes'] = rule_codes.reindex(demographics.index).where(~meets[rule]).values
+                record['output size'] = int(meets[rule].sum())
+    
+    # The eligible cohort is the individuals who meet all the rules in use
+    explanations = pd.DataFrame(meets, index = pd.Index(demographics.index, name = utils.clean(id_label)))
+    explanations['eligible'] = explanations.all(axis = 1)
+    for col, vals in codes.items():
+        explanations[col] = vals
+    print('Count of CDCR numbers that meet all the rules is: ', int(explanations['eligible'].sum()), '\n')
+    
+    return explanations
 
 
-def eligibility_r13(demographics, 
-                    sorting_criteria,
-                    current_commits, 
-                    prior_commits, 
-                    eligibility_conditions,
-                    id_label,
-                    el_cdcr_nums = None):
+def gen_reasons(explanations, 
+                cdcr_num, 
+                eligibility_conditions = None):
     """
     Parameters
     ----------
-    sorting_criteria : pandas dataframe
-        Data on offenses and their categories or tables
-    demographics : pandas dataframe
-        Data on individuals currently incarcerated
-    current_commits : pandas dataframe
-        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
-    prior_commits : pandas dataframe
-        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
-    eligibility_conditions : dict
-        Data on all the rules, whether they should be applied or not and other specifications
-    id_label : str
-        Name of the column with the CDCR IDs    
-    el_cdcr_nums: list
-        CDCR numbers that already meet eligibility conditions. Only these CDCR numbers will be evaluated under the current rule. 
+    explanations : pandas dataframe
+        Whether each individual meets each rule (see gen_explanations())
+    cdcr_num : str
+        CDCR number to explain, ex: 'A12345'
+    eligibility_conditions : dict, optional
+        Conditions of the scenario. If passed, the description and category of each rule are added
         Default is None.
+    
     Returns
     -------
-    errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
-    el_cdcr_nums : list of strs
-        List of CDCR numbers that are eligible for resentencing 
-        
+    reasons : pandas dataframe
+        Rules that the individual does not meet and their offending codes. Empty if the individual is eligible
     """
-    print('Finding CDCR numbers that meet rule: ', eligibility_conditions['r_13']['desc'])
-    print('Rule category: ', eligibility_conditions['r_13']['category'])
-    
-    # If existing eligible CDCR numbers are passed
-    if el_cdcr_nums:
-        el_cdcr_nums = demographics[(demographics['time served in years'] >= 15) & (demographics[id_label].isin(el_cdcr_nums))][id_label].to_list() 
-    else:
-        el_cdcr_nums = demographics[(demographics['time served in years'] >= 15)][id_label].to_list() 
-    
-    print('Count of CDCR numbers that meet rule is: ', len(el_cdcr_nums), '\n')
+    if cdcr_num not in explanations.index:
+        raise KeyError('CDCR number '+str(cdcr_num)+' is not in the explanations')
+    row = explanations.loc[cdcr_num]
+    
+    # Rules that are not met, in the order they are applied
+    failed = [rule for rule in el_rules.keys() if (rule in explanations.columns) and (not row[rule])]
+    reasons = pd.DataFrame({'rule id': failed, 
+                            'offending codes': [row.get(rule+' offending codes') for rule in failed]})
+    if eligibility_conditions is not None:
+        reasons.insert(1, 'desc', [eligibility_conditions[rule]['desc'] for rule in failed])
+        reasons.insert(2, 'category', [eligibility_conditions[rule]['category'] for rule in failed])
+    return reasons
+
+
+def read_explanations(read_path):
+    """
+    Parameters
+    ----------
+    read_path : str
+        Full path of the Parquet file with the explanations, ex: output_folder/adult_explanations.parquet. The pickle file with the same name is read instead if pyarrow was not installed when they were written (see writer.write_parquet())
     
-    return el_cdcr_nums
+    Returns
+    -------
+    explanations : pandas dataframe or None
+        Whether each individual meets each rule (see gen_explanations()). None if the file does not exist
+    """
+    pickle_path = os.path.splitext(read_path)[0]+'.pkl'
+    if os.path.exists(read_path):
+        return pd.read_parquet(read_path)
+    elif os.path.exists(pickle_path):
+        return pd.read_pickle(pickle_path)
+    return None
 
 
 def gen_eligibility(demographics, 
@@ -862,7 +866,12 @@ def gen_eligibility(demographics,
                     county_name = None, 
                     month = None,
                     to_excel = False, 
-                    write_path = None):
+                    write_path = None,
+                    run_report = None,
+                    near_miss = None,
+                    prepared = False,
+                    explain = False,
+                    engine = 'pandas'):
     """
     Parameters
     ----------
@@ -899,190 +908,160 @@ def gen_eligibility(demographics,
     write_path : str, optional 
         Specify the full path where the Excel outputs should be written. 
         If to_excel = True but write_path = None, data outputs are written to the county_name/month/output/date folder by default. To avoid this behavior, pass a value to write_path.
+    run_report : list, optional
+        Records of the run (see report.track()). If passed, a record with the cohort size, wall time, CPU time and peak memory is appended for data preparation and for every rule applied
+        Default is None.
+    near_miss : float, optional
+        Margin as a share of each numerical threshold, ex: 0.1 for 10%. If passed, individuals who meet all the other rules and miss the numerical thresholds by less than the margin are returned as near misses. The numerical rules are then evaluated first on the entire population and the other rules are applied once on the individuals who meet or nearly meet them
+        Default is None.
+    prepared : boolean, optional
+        Specify whether the data was already prepared with prep_data(), ex: once for all the scenarios. If True, the data is not cleaned and prepared again
+        Default is False.
+    explain : boolean, optional
+        Specify whether to evaluate every rule on the entire population (see gen_explanations()) and write whether each individual meets each rule with the offending codes to [pop_label]_explanations.parquet
+        The eligible individuals are then the ones who meet all the rules
+        Default is False.
+    engine : str, optional
+        Engine that evaluates the rules: 'pandas', or 'sqlite' or 'duckdb' to load the prepared data into an in-memory database and evaluate the rules in a single query (see database.py). The explanations are always computed with pandas
+        Default is 'pandas'.
     
     Returns
     -------
     errors : pandas dataframe
-        Data in the demographics dataframe for which time variables could not be computed
+        Data in the demographics dataframe for which time variables could not be computed. None if the data was already prepared
     el_cdcr_nums : list of strs
         List of CDCR numbers that are eligible for resentencing 
+    near_misses : pandas dataframe
+        Only returned if near_miss is passed. Distance of each near miss to every numerical threshold, whether it is met and the date when all the thresholds will be met (eta)
     """
     
     print('Executing population selection steps')
     
-    # Clean the column names 
-    if clean_col_names:
-        for df in [demographics, current_commits, prior_commits]:
-            df.columns = [utils.clean(col, remove = ['\n']) for col in df.columns]
+    # Clean the data and add the time variables
+    if prepared:
+        errors = None
     else:
-        print('Since column names are not cleaned, several required variables for the eligibility model cannot be found')
-     
-    # Add all of the time variables to the demographic data necessary for classification - years served, sentence length, age, etc.
-    demographics, errors = helpers.gen_time_vars(df = demographics, id_label = utils.clean(id_label), merge = True)
-    
-    # Initialize list of eligible CDCR numbers
-    el_cdcr_nums = demographics[utils.clean(id_label)].unique().tolist()
-    
-    # Clean offense data and enhancements data in current commits   
-    utils.clean_blk(data = current_commits, 
-                    names = {'offense': 'offense cleaned',
-                             'off_enh1': 'off_enh1 cleaned',
-                             'off_enh2': 'off_enh2 cleaned',
-                             'off_enh3': 'off_enh3 cleaned',
-                             'off_enh4': 'off_enh4 cleaned'}, 
-                    inplace = True)
-    # Clean offense data and enhancements data in prior commits
-    utils.clean_blk(data = prior_commits, 
-                    names = {'offense': 'offense cleaned'}, 
-                    inplace = True)
-    # Clean offense data in demographics
-    utils.clean_blk(data = demographics, 
-                    names = {'controlling offense': 'controlling offense cleaned'}, 
-                    inplace = True)
+        demographics, errors = prep_data(demographics = demographics, 
+                                         current_commits = current_commits, 
+                                         prior_commits = prior_commits, 
+                                         id_label = id_label, 
+                                         clean_col_names = clean_col_names, 
+                                         run_report = run_report, 
+                                         stage = pop_label,
+                                         requirements = gen_requirements(eligibility_conditions, id_label))
+    
+    # Initialize the eligible cohort with the entire population, as a boolean array over the rows of the prepared demographics (see store.gen_mask())
+    demographics = store.gen_store(demographics, utils.clean(id_label), verbose = False)
+    el_mask = store.gen_mask(demographics)
     
     print('This scenario is tagged with: ', eligibility_conditions['lenience'], ' degree of leniency in the selection process or eligibility determination')
     
-    # Check all eligibility conditions
-    if eligibility_conditions['r_1']['use']:
-        el_cdcr_nums = eligibility_r1(demographics = demographics, 
-                                      sorting_criteria = sorting_criteria,
-                                      current_commits = current_commits, 
-                                      prior_commits = prior_commits, 
-                                      eligibility_conditions = eligibility_conditions,
+    # If near misses are requested, evaluate the numerical rules on everyone and keep the individuals who meet them or nearly meet them
+    if near_miss is not None:
+        with report.track(run_report, stage = pop_label, rule_id = 'numerical distances', input_size = len(el_mask)) as record:
+            distances = gen_distances(demographics = demographics, 
+                                      eligibility_conditions = eligibility_conditions, 
                                       id_label = utils.clean(id_label), 
-                                      el_cdcr_nums = el_cdcr_nums)
-        
-    if eligibility_conditions['r_2']['use']:
-        el_cdcr_nums = eligibility_r2(demographics = demographics, 
-                                      sorting_criteria = sorting_criteria,
-                                      current_commits = current_commits, 
-                                      prior_commits = prior_commits, 
-                                      eligibility_conditions = eligibility_conditions,
-                                      id_label = utils.clean(id_label),
-                                      el_cdcr_nums = el_cdcr_nums)
-        
-    if eligibility_conditions['r_3']['use']:
-        el_cdcr_nums = eligibility_r3(demographics = demographics, 
-                                      sorting_criteria = sorting_criteria,
-                                      current_commits = current_commits, 
-                                      prior_commits = prior_commits, 
-                                      eligibility_conditions = eligibility_conditions,
-                                      id_label = utils.clean(id_label),
-                                      el_cdcr_nums = el_cdcr_nums)
-        
-    if eligibility_conditions['r_4']['use']:
-        el_cdcr_nums = eligibility_r4(demographics = demographics, 
-                                      sorting_criteria = sorting_criteria,
-                                      current_commits = current_commits, 
-                                      prior_commits = prior_commits, 
-                                      eligibility_conditions = eligibility_conditions,
-                                      id_label = utils.clean(id_label),
-                                      el_cdcr_nums = el_cdcr_nums)
-    
-    if eligibility_conditions['r_5']['use']:
-        el_cdcr_nums = eligibility_r5(demographics = demographics, 
-                                      sorting_criteria = sorting_criteria,
-                                      current_commits = current_commits, 
-                                      prior_commits = prior_commits, 
-                                      eligibility_conditions = eligibility_conditions,
-                                      id_label = utils.clean(id_label),
-                                      el_cdcr_nums = el_cdcr_nums)
-        
-    if eligibility_conditions['r_6']['use']:
-        el_cdcr_nums = eligibility_r6(demographics = demographics, 
-                                      sorting_criteria = sorting_criteria,
-                                      current_commits = current_commits, 
-                                      prior_commits = prior_commits, 
-                                      eligibility_conditions = eligibility_conditions,
-                                      id_label = utils.clean(id_label),
-                                      el_cdcr_nums = el_cdcr_nums)
-        
-    if eligibility_conditions['r_7']['use']:
-        el_cdcr_nums = eligibility_r7(demographics = demographics, 
-                                      sorting_criteria = sorting_criteria,
-                                      current_commits = current_commits, 
-                                      prior_commits = prior_commits, 
-                                      eligibility_conditions = eligibility_conditions,
-                                      id_label = utils.clean(id_label),
-                                      el_cdcr_nums = el_cdcr_nums)
-        
-    if eligibility_conditions['r_8']['use']:
-        el_cdcr_nums = eligibility_r8(demographics = demographics, 
-                                      sorting_criteria = sorting_criteria,
-                                      current_commits = current_commits, 
-                                      prior_commits = prior_commits, 
-                                      eligibility_conditions = eligibility_conditions,
-                                      id_label = utils.clean(id_label),
-                                      el_cdcr_nums = el_cdcr_nums)
-        
-    if eligibility_conditions['r_9']['use']:
-        el_cdcr_nums = eligibility_r9(demographics = demographics, 
-                                      sorting_criteria = sorting_criteria,
-                                      current_commits = current_commits, 
-                                      prior_commits = prior_commits, 
-                                      eligibility_conditions = eligibility_conditions,
-                                      id_label = utils.clean(id_label),
-                                      el_cdcr_nums = el_cdcr_nums) 
-        
-    if eligibility_conditions['r_10']['use']:
-        el_cdcr_nums = eligibility_r10(demographics = demographics, 
+                                      margin = near_miss)
+            el_mask = (distances['meets numerical rules'] | distances['near miss']).values
+            record['output size'] = np.count_nonzero(el_mask)
+    
+    # Evaluate every rule on the entire population and keep the individuals who meet all of them (numerical rules are already applied if near misses are requested)
+    if explain:
+        explanations = gen_explanations(demographics = demographics, 
+                                        sorting_criteria = sorting_criteria,
+                                        current_commits = current_commits, 
+                                        prior_commits = prior_commits, 
+                                        eligibility_conditions = eligibility_conditions,
+                                        id_label = id_label, 
+                                        run_report = run_report,
+                                        stage = pop_label)
+        skip = list(rules.num.keys()) if near_miss is not None else []
+        el_mask &= explanations[[rule for rule in el_rules.keys() if (rule in explanations.columns) and (rule not in skip)]].all(axis = 1).values
+    # Evaluate the rules in an in-memory database (numerical rules are already applied if near misses are requested)
+    elif engine != 'pandas':
+        import database
+        el_mask = database.apply_rules(demographics = demographics, 
                                        sorting_criteria = sorting_criteria,
                                        current_commits = current_commits, 
                                        prior_commits = prior_commits, 
                                        eligibility_conditions = eligibility_conditions,
-                                       id_label = utils.clean(id_label),
-                                       el_cdcr_nums = el_cdcr_nums)
-        
-    if eligibility_conditions['r_11']['use']:
-        el_cdcr_nums = eligibility_r11(demographics = demographics, 
-                                       sorting_criteria = sorting_criteria,
-                                       current_commits = current_commits, 
-                                       prior_commits = prior_commits, 
-                                       eligibility_conditions = eligibility_conditions,
-                                       id_label = utils.clean(id_label),
-                                       el_cdcr_nums = el_cdcr_nums)
-        
-    if eligibility_conditions['r_12']['use']:
-        el_cdcr_nums = eligibility_r12(demographics = demographics, 
-                                       sorting_criteria = sorting_criteria,
-                                       current_commits = current_commits, 
-                                       prior_commits = prior_commits, 
-                                       eligibility_conditions = eligibility_conditions,
-                                       id_label = utils.clean(id_label),
-                                       el_cdcr_nums = el_cdcr_nums)
-        
-    if eligibility_conditions['r_13']['use']:
-        el_cdcr_nums = eligibility_r13(demographics = demographics, 
-                                       sorting_criteria = sorting_criteria,
-                                       current_commits = current_commits, 
-                                       prior_commits = prior_commits, 
-                                       eligibility_conditions = eligibility_conditions,
-                                       id_label = utils.clean(id_label),
-                                       el_cdcr_nums = el_cdcr_nums)
-        
+                                       id_label = id_label, 
+                                       el_cdcr_nums = el_mask,
+                                       skip = list(rules.num.keys()) if near_miss is not None else [],
+                                       run_report = run_report,
+                                       stage = pop_label,
+                                       engine = engine,
+                                       as_mask = True)
+    # Check all eligibility conditions in the order they are specified (numerical rules are already applied if near misses are requested)
+    else:
+        el_mask = apply_rules(demographics = demographics, 
+                              sorting_criteria = sorting_criteria,
+                              current_commits = current_commits, 
+                              prior_commits = prior_commits, 
+                              eligibility_conditions = eligibility_conditions,
+                              id_label = id_label, 
+                              el_cdcr_nums = el_mask,
+                              skip = list(rules.num.keys()) if near_miss is not None else [],
+                              run_report = run_report,
+                              stage = pop_label,
+                              as_mask = True)
+    
+    # Split the individuals who meet all the other rules into eligible individuals and near misses
+    if near_miss is not None:
+        near_misses = distances[el_mask & distances['near miss'].values]
+        el_mask &= distances['meets numerical rules'].values
+        print('Count of CDCR numbers that nearly meet the numerical rules (within', str(100*near_miss)+'%) and meet all other rules is: ', len(near_misses), '\n')
+    
+    # CDCR numbers of the eligible cohort (in the order of the demographics)
+    el_cdcr_nums = store.get_ids(demographics, el_mask)
+    
     # Write demophraphics and current commits of eligible individuals to Excel output
     if to_excel:
-        if write_path:
-            pass
-        else:
-            write_path = '/'.join(l for l in [read_path, county_name, month, 'output', 'date of execution', utils.get_todays_date(sep = '_')] if l)
+        with report.track(run_report, stage = pop_label, rule_id = 'write output', input_size = len(el_cdcr_nums)) as record:
+            if write_path:
+                pass
+            else:
+                write_path = utils.get_write_path(read_path = read_path, county_name = county_name, month = month)
         
-        # If directory does not exist, then first create it
+            # If directory does not exist, then first create it
+            if not os.path.exists(write_path):
+                os.makedirs(write_path)
+            
+            # Select the data to write now, the files are written in the background if the writer is started (see writer.start())
+            cohort = demographics[el_mask]
+            commits = current_commits[current_commits[utils.clean(id_label)].isin(set(el_cdcr_nums))]
+            conditions = pd.DataFrame.from_dict(eligibility_conditions, orient='index')
+            inputs = pd.DataFrame.from_dict({'input': read_path, 'county name': county_name, 'month': month}, orient='index')
+            
+            # Write data to excel files
+            for data, file_name, label in [(cohort, pop_label+'_eligible_demographics.xlsx', 'Demographics'), 
+                                           (commits, pop_label+'_eligible_currentcommits.xlsx', 'Current commits')]:
+                writer.submit(writer.write_excel, 
+                              sheets = {'Cohort': (data, False), 'Conditions': (conditions, True), 'Input': (inputs, True)}, 
+                              write_path = write_path+'/'+file_name, 
+                              label = label+' of eligible individuals')
+            
+            # Write near misses with their distance to each threshold
+            if near_miss is not None:
+                writer.submit(writer.write_excel, 
+                              sheets = {'Sheet1': (near_misses, False)}, 
+                              write_path = write_path+'/'+pop_label+'_near_miss.xlsx', 
+                              label = 'Near misses')
+            record['output size'] = len(el_cdcr_nums)
+    
+    # Write whether each individual meets each rule (in the background if the writer is started)
+    if explain:
+        if not write_path:
+            write_path = utils.get_write_path(read_path = read_path, county_name = county_name, month = month)
         if not os.path.exists(write_path):
             os.makedirs(write_path)
-            
-        # Write data to excel files
-        with pd.ExcelWriter(write_path+'/'+pop_label+'_eligible_demographics.xlsx') as writer:
-            demographics[demographics[utils.clean(id_label)].isin(el_cdcr_nums)].to_excel(writer, sheet_name = 'Cohort', index = False)
-            pd.DataFrame.from_dict(eligibility_conditions, orient='index').to_excel(writer, sheet_name = 'Conditions', index = True)
-            pd.DataFrame.from_dict({'input': read_path, 'county name': county_name, 'month': month}, orient='index').to_excel(writer, sheet_name = 'Input', index = True)
-        print('Demographics of eligible individuals written to: ', write_path+'/'+pop_label+'_eligible_demographics.xlsx')
-
-        with pd.ExcelWriter(write_path+'/'+pop_label+'_eligible_currentcommits.xlsx') as writer:
-            current_commits[current_commits[utils.clean(id_label)].isin(el_cdcr_nums)].to_excel(writer, sheet_name = 'Cohort', index = False)
-            pd.DataFrame.from_dict(eligibility_conditions, orient='index').to_excel(writer, sheet_name = 'Conditions', index = True)
-            pd.DataFrame.from_dict({'input': read_path, 'county name': county_name, 'month': month}, orient='index').to_excel(writer, sheet_name = 'Input', index = True)
-        print('Current commits of eligible individuals written to: ', write_path+'/'+pop_label+'_eligible_currentcommits.xlsx')
+        writer.submit(writer.write_parquet, 
+                      data = explanations, 
+                      write_path = write_path+'/'+pop_label+'_explanations.parquet', 
+                      label = 'Explanations of eligibility')
     
+    if near_miss is not None:
+        return errors, el_cdcr_nums, near_misses
     return errors, el_cdcr_nums
             
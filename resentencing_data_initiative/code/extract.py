@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 import helpers
-import pandas as pd
-import numpy as np
-import datetime
-from tqdm import tqdm
-import copy
-import os
+
+
+# Input files by dataset name, in the order they are extracted and returned (the sorting criteria are shared by all the months of a county)
+files = {'sorting_criteria': 'Criteria/sorting_criteria.xlsx',
+         'demographics': 'Demographics.xlsx',
+         'merit_credit': 'EducationMeritCredits.xlsx',
+         'milestone_credit': 'MilestoneCompletionCredits.xlsx',
+         'rehab_credit': 'RehabilitativeAchievementCredits.xlsx',
+         'voced_credit': 'VocEd_TrainingCerts.xlsx',
+         'rv_report': 'RulesViolationReports.xlsx',
+         'current_commits': 'CurrentCommitments.xlsx',
+         'prior_commits': 'PriorCommitments.xlsx'}
 
 
 def get_input(read_path, 
@@ -13,7 +19,9 @@ def get_input(read_path,
               county_name, 
               count = 9, 
               write_path = None, 
-              pickle = False):
+              pickle = False,
+              cache = False,
+              usecols = None):
     """
 
     Parameters
@@ -33,6 +41,13 @@ def get_input(read_path,
     pickle: boolean, optional
         Specify whether to store dataframe output as a pickle file or not
         Default is False.
+    cache : boolean, optional
+        Specify whether to reuse the pickle outputs of an earlier extraction for the files that did not change (see helpers.extract_data())
+        Default is False.
+    usecols : dict, optional
+        Cleaned names of the columns to read by dataset name, ex: {'demographics': ['cdcno', 'birthday'], 'current_commits': None}. None reads all the columns of a dataset
+        Datasets that are not in the dict are not read and are returned as None, ex: the credit tables when no summary is generated
+        Default is None, i.e. all the columns of all the datasets are read.
         
     Returns
     -------
@@ -58,85 +73,23 @@ def get_input(read_path,
     """
     print('Executing data extraction steps')
     
-    # Criteria for selection
-    sorting_criteria = helpers.extract_data(main_path = read_path, 
-                                            county_name = county_name, 
-                                            file_name = 'Criteria/sorting_criteria.xlsx', 
-                                            write_path = write_path, 
-                                            pickle = False) 
-    print('\n Extraction 1/'+str(count)+' complete \n')
-    
-    # Demographics of individuals incarcerated
-    demographics = helpers.extract_data(main_path = read_path, 
-                                        county_name = county_name, 
-                                        file_name = 'Demographics.xlsx', 
-                                        month = month,
-                                        write_path = write_path,
-                                        pickle = pickle)
-    print('\n Extraction 2/'+str(count)+' complete \n')
-    
-    # Education merit
-    merit_credit = helpers.extract_data(main_path = read_path, 
-                                        county_name = county_name, 
-                                        file_name = 'EducationMeritCredits.xlsx', 
-                                        month = month,
-                                        write_path = write_path,
-                                        pickle = pickle)
-    print('\n Extraction 3/'+str(count)+' complete \n')
-    
-    # Milestone credit
-    milestone_credit = helpers.extract_data(main_path = read_path, 
-                                            county_name = county_name, 
-                                            file_name = 'MilestoneCompletionCredits.xlsx', 
-                                            month = month,
-                                            write_path = write_path,
-                                            pickle = pickle)
-    print('\n Extraction 4/'+str(count)+' complete \n')
-    
-    # Rehab credit
-    rehab_credit = helpers.extract_data(main_path = read_path, 
-                                        county_name = county_name, 
-                                        file_name = 'RehabilitativeAchievementCredits.xlsx', 
-                                        month = month,
-                                        write_path = write_path,
-                                        pickle = pickle)
-    print('\n Extraction 5/'+str(count)+' complete \n')
-    
-    # Vocational education credit
-    voced_credit = helpers.extract_data(main_path = read_path, 
-                                        county_name = county_name, 
-                                        file_name = 'VocEd_TrainingCerts.xlsx', 
-                                        month = month,
-                                        write_path = write_path,
-                                        pickle = pickle)
-    print('\n Extraction 6/'+str(count)+' complete \n')
-    
-    # Rule violations
-    rv_report = helpers.extract_data(main_path = read_path, 
-                                     county_name = county_name, 
-                                     file_name = 'RulesViolationReports.xlsx', 
-                                     month = month,
-                                     write_path = write_path,
-                                     pickle = pickle)
-    print('\n Extraction 7/'+str(count)+' complete \n')
-    
-    # Current commitments
-    current_commits = helpers.extract_data(main_path = read_path, 
-                                           county_name = county_name, 
-                                           file_name = 'CurrentCommitments.xlsx', 
-                                           month = month,
-                                           write_path = write_path,
-                                           pickle = pickle)
-    print('\n Extraction 8/'+str(count)+' complete \n')
-    
-    # Previous commitments
-    prior_commits = helpers.extract_data(main_path = read_path, 
-                                         county_name = county_name, 
-                                         file_name = 'PriorCommitments.xlsx', 
-                                         month = month,
-                                         write_path = write_path,
-                                         pickle = pickle)
-    print('\n Extraction 9/'+str(count)+' complete \n')
+    datasets = {}
+    for i, (name, file_name) in enumerate(files.items()):
+        # Skip the datasets that are not needed
+        if (usecols is not None) and (name not in usecols):
+            datasets[name] = None
+            print('\n Extraction '+str(i+1)+'/'+str(count)+' skipped ('+file_name+' is not needed) \n')
+            continue
+        
+        # The sorting criteria are in the county folder and are not pickled
+        datasets[name] = helpers.extract_data(main_path = read_path, 
+                                              county_name = county_name, 
+                                              file_name = file_name, 
+                                              month = None if name == 'sorting_criteria' else month,
+                                              write_path = write_path,
+                                              pickle = pickle and (name != 'sorting_criteria'),
+                                              cache = cache,
+                                              usecols = usecols.get(name) if usecols is not None else None)
+        print('\n Extraction '+str(i+1)+'/'+str(count)+' complete \n')
     
-    return sorting_criteria, demographics, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report, current_commits, prior_commits 
-    
\ No newline at end of file
+    return tuple(datasets[name] for name in files.keys())
@@ -2,8 +2,6 @@
 import pandas as pd
 import numpy as np
 import datetime
-from tqdm import tqdm
-import copy
 import os
 import utils
 
@@ -13,7 +11,9 @@ def extract_data(main_path,
                  file_name, 
                  month = None, 
                  write_path = None, 
-                 pickle = False): 
+                 pickle = False,
+                 cache = False,
+                 usecols = None): 
     """
 
     Parameters
@@ -33,6 +33,12 @@ def extract_data(main_path,
     pickle : boolean, optional
         Specify whether to store dataframe output as a pickle file or not
         Default is False.
+    cache : boolean, optional
+        Specify whether to reuse the pickle output of an earlier extraction. The pickle is reused if the file has the same size and modification time as when it was pickled and the pickle has all the columns in usecols, otherwise the file is read and pickled again
+        Default is False.
+    usecols : list, optional
+        Cleaned names of the columns to read (see utils.clean()), ex: ['cdcno', 'offense']. The other columns are dropped while the file is read
+        Default is None, i.e. all the columns are read.
         
     Returns
     -------
@@ -42,33 +48,44 @@ def extract_data(main_path,
     """
     # Create the path to read data from (all inputs that are not NoneType)
     read_path = '/'.join(l for l in [main_path, county_name, month, file_name] if l)
-    # Read into a dataframe
-    df = pd.read_excel(read_path)
-    print('Extracted data from: '+read_path)
+    # Create the path of the pickle output (input folder of the county_name + month folder if no write path is passed)
+    pickle_path = '/'.join([write_path or '/'.join(l for l in [main_path, county_name, month] if l), 'input', file_name.split('.')[0]+'.pkl'])
+    
+    # Keep a column if its cleaned name is in usecols
+    if usecols is not None:
+        usecols = set(usecols)
+        keep = lambda col: utils.clean(col, remove = ['\n']) in usecols
+    else:
+        keep = None
+    
+    # Reuse the pickle output if the file did not change since it was pickled and it has all the columns that are needed
+    if cache:
+        stat = os.stat(read_path)
+        source = [stat.st_size, stat.st_mtime_ns, sorted(usecols) if usecols is not None else None]
+        if os.path.exists(pickle_path):
+            df = pd.read_pickle(pickle_path)
+            cached = df.attrs.pop('source', None)
+            if (cached is not None) and (cached[:2] == source[:2]) and ((cached[2] is None) or ((usecols is not None) and usecols.issubset(cached[2]))):
+                print('Extracted data from cache: '+pickle_path)
+                return df[[col for col in df.columns if keep(col)]] if keep else df
+        pickle = True
+    
+    # Read into a dataframe (only the columns that are needed are kept)
+    df = pd.read_excel(read_path, usecols = keep)
+    print('Extracted data from: '+read_path+(' ('+str(len(df.columns))+' columns)' if keep else ''))
     
     # If pickle output is specified
     if pickle:
-        # If no write path is passed
-        if not write_path:
-            # Create a write path based on the inputs
-            write_path = '/'.join(l for l in [main_path, county_name, month, 'input'] if l) 
-            
-            # If directory does not exist, then first create it
-            if not os.path.exists(write_path):
-                os.makedirs(write_path)                                              
-            
-            # Pickle the dataframe
-            df.to_pickle(write_path+'/'+file_name.split('.')[0]+'.pkl')
-            print('Pickled input written to: '+write_path+'/'+file_name.split('.')[0]+'.pkl')
+        # If directory does not exist, then first create it
+        if not os.path.exists(os.path.dirname(pickle_path)):
+            os.makedirs(os.path.dirname(pickle_path))
         
-        elif write_path:
-            # If directory does not exist, then first create it
-            if not os.path.exists(write_path+'/'+'input'):
-                os.makedirs(write_path+'/'+'input')
-            
-            # Pickle the dataframe
-            df.to_pickle('/'.join([write_path, 'input', file_name.split('.')[0]+'.pkl']))
-            print('Pickled input written to: '+ str('/'.join([write_path, 'input', file_name.split('.')[0]+'.pkl'])))
+        # Pickle the dataframe (with the size and modification time of the file if it is cached)
+        if cache:
+            df.attrs['source'] = source
+        df.to_pickle(pickle_path)
+        df.attrs.pop('source', None)
+        print('Pickled input written to: '+pickle_path)
     
     return df
   
@@ -100,22 +117,23 @@ def gen_time_vars(df,
     df.columns = [utils.clean(col, remove = ['\n']) for col in df.columns]
     
     # Check if all columns needed for calcualtion are present in the dataframe
-    if all(col in df.columns for col in [utils.clean(id_label), 'birthday', 'aggregate sentence in months', 'offense end date']):
-        pass
-    else:
-        print('Variables needed for calculation are missing in demographics dataframe')
-        return   
+    missing = [col for col in [utils.clean(id_label), 'birthday', 'aggregate sentence in months', 'offense end date'] if col not in df.columns]
+    if missing:
+        raise ValueError('Variables needed for calculation are missing in demographics dataframe: '+', '.join(missing)+' (see quality.check_data())')
     
     # Get the present date
     present_date = datetime.datetime.now()
+    # Parse the dates once
+    birthday = pd.to_datetime(df['birthday'], errors = 'coerce')
+    offense_end = pd.to_datetime(df['offense end date'], errors = 'coerce')
     # Sentence duration in years
     df['aggregate sentence in years'] = df['aggregate sentence in months']/12
     # Age of individual
-    df['age in years'] = [x.days/365 for x in present_date - pd.to_datetime(df['birthday'], errors = 'coerce')]
+    df['age in years'] = (present_date - birthday).dt.days/365
     # Sentence served in years
-    df['time served in years'] = [x.days/365 for x in present_date - pd.to_datetime(df['offense end date'], errors = 'coerce')]
+    df['time served in years'] = (present_date - offense_end).dt.days/365
     # Age at the time of offense
-    df['age during offense'] = [x.days/365 for x in pd.to_datetime(df['offense end date'], errors = 'coerce') - pd.to_datetime(df['birthday'], errors = 'coerce')]
+    df['age during offense'] = (offense_end - birthday).dt.days/365
   
     # Store all the time columns calculated above
     calc_t_cols = ['aggregate sentence in years', 'age in years', 'time served in years', 'age during offense']
@@ -130,6 +148,68 @@ def gen_time_vars(df,
         return df[[id_label, 'birthday', 'aggregate sentence in months', 'offense end date']+calc_t_cols], utils.incorrect_time(df = df, cols = calc_t_cols)
         
 
+def iter_summary(df, 
+                 id_label, 
+                 current_commits, 
+                 prior_commits, 
+                 merit_credit, 
+                 milestone_credit,
+                 rehab_credit, 
+                 voced_credit, 
+                 rv_report, 
+                 merge = True,
+                 batch_size = None):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Data with CDCR numbers to generate summaries for (see gen_summary())
+    id_label : str
+        Name of the column with the CDCR IDs (cleaned)
+    current_commits, prior_commits, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report : pandas dataframes
+        Data with cleaned column names (see gen_summary())
+    merge : boolean
+        Specify whether to yield the input dataframe with summary columns or a separate dataframe with just the summary columns
+        Default is True
+    batch_size : int, optional
+        Number of CDCR numbers to summarize at a time
+        Default is None, i.e. all CDCR numbers are summarized at once.
+        
+    Yields
+    ------
+    batch : pandas dataframe
+        Summaries of the next batch of CDCR numbers, in the order of df. Only one batch is held in memory at a time, so the batches can be written as they are generated (see writer.write_stream())
+
+    """
+    cdcr_nums = df[id_label]
+    if not batch_size:
+        batch_size = max(len(cdcr_nums), 1)
+    
+    # CDCR numbers that participated in any programming
+    prog_cdcr_nums = set(merit_credit[id_label]).union(milestone_credit[id_label], rehab_credit[id_label], voced_credit[id_label])
+    
+    # Get summary variables for each batch of CDCR numbers (an empty cohort yields a single empty batch)
+    for i in range(0, max(len(cdcr_nums), 1), batch_size):
+        batch = df.iloc[i:i+batch_size]
+        chunk = cdcr_nums.iloc[i:i+batch_size]
+        # Rule violation reports, one block of 'name: value' lines per report
+        ext = rv_report.loc[rv_report[id_label].isin(chunk), [id_label, 'rule violation date', 'division', 'rule violation']]
+        ext = ext.assign(report = 'rule violation date: '+ext['rule violation date'].astype(object).map(str)+'\n'+'division: '+ext['division'].map(str)+'\n'+'rule violation: '+ext['rule violation'].map(str))
+        # Store summary variables in a dataframe aligned with the input (current and previous convictions, programming and rule violations)
+        summary = pd.DataFrame({'current convictions': join_by_id(data = current_commits, id_label = id_label, cdcr_nums = chunk, col = 'offense', sep = ', ').values,
+                                'prior convictions': join_by_id(data = prior_commits, id_label = id_label, cdcr_nums = chunk, col = 'offense', sep = ', ').values,
+                                'programming': np.where(chunk.isin(prog_cdcr_nums), 'Yes', 'No'),
+                                'rules violations': join_by_id(data = ext, id_label = id_label, cdcr_nums = chunk, col = 'report', sep = '\n\n').values}, 
+                               index = batch.index)
+        
+        # Yield the input dataframe with summary variables or only the summary variables
+        if merge: 
+            yield pd.concat([batch, summary], axis = 1)
+        else:
+            yield pd.concat([batch[[id_label]], summary], axis = 1)
+
+
 def gen_summary(df, 
                 id_label, 
                 current_commits, 
@@ -140,7 +220,8 @@ def gen_summary(df,
                 voced_credit, 
                 rv_report, 
                 clean_col_names = True,
-                merge = True):
+                merge = True,
+                chunk_size = None):
     """
 
     Parameters
@@ -169,6 +250,9 @@ def gen_summary(df,
     merge : boolean
         Specify whether to return input dataframe with summary columns or a separate dataframe with just the summary columns
         Default is True
+    chunk_size : int, optional
+        Number of CDCR numbers to summarize at a time. Limits the size of the intermediate data when the cohort is large. The chunks are combined in memory, so the peak memory is still about twice the size of the summary (see iter_summary() to write the chunks one at a time)
+        Default is None, i.e. all CDCR numbers are summarized at once.
         
     Returns
     -------
@@ -178,43 +262,52 @@ def gen_summary(df,
     """
     # Clean the column names 
     if clean_col_names:
-        for df in [current_commits, prior_commits, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report]:
-            df.columns = [utils.clean(col, remove = ['\n']) for col in df.columns]
+        # Shallow copies are renamed, since other stages can read the same datasets at the same time
+        current_commits, prior_commits, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report = [data.set_axis([utils.clean(col, remove = ['\n']) for col in data.columns], axis = 1, copy = False) for data in [current_commits, prior_commits, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report]]
     else:
         print('Since column names are not cleaned, several required variables for summary generation cannot be found')
     
-    # Initialize lists for other variables
-    current_conv = []
-    prior_conv = []
-    programming = []
-    rvr = []
-    
-    # Get summary variables for each CDCR number
-    for cdcr_num in df[utils.clean(id_label)]:
-      # Current convictions
-      current_conv.append(', '.join(current_commits[current_commits[utils.clean(id_label)] == cdcr_num]['offense'].tolist()))
-      # Previous convictions
-      prior_conv.append(', '.join(prior_commits[prior_commits[utils.clean(id_label)] == cdcr_num]['offense'].tolist()))
-      # Participation in programming
-      if (cdcr_num in merit_credit[utils.clean(id_label)]) or (cdcr_num in milestone_credit[utils.clean(id_label)]) or (cdcr_num in rehab_credit[utils.clean(id_label)]) or (cdcr_num in voced_credit[utils.clean(id_label)]):
-        programming.append('Yes')
-      else:
-        programming.append('No')
-      # Rule violation reports
-      ext = rv_report[rv_report[utils.clean(id_label)] == cdcr_num][['rule violation date', 'division', 'rule violation']].reset_index(drop = True).to_dict('index')
-      rvr.append("\n\n".join("\n".join(k_b + ': ' + str(v_b) for k_b, v_b in v_a.items()) for k_a, v_a in ext.items()))
-    
-    # Store lists in dataframe
-    df['current convictions'] = current_conv
-    df['prior convictions'] = prior_conv
-    df['programming'] = programming
-    df['rules violations'] = rvr
-    
-    # Return the input dataframe with summary variables
-    if merge: 
-        return df
-    # Return only the summary variables
-    else:
-        return df[[utils.clean(id_label), 'current convictions', 'prior convictions', 'programming', 'rules violations']]
+    # Summarize the chunks of CDCR numbers and combine them
+    return pd.concat(list(iter_summary(df = df, 
+                                       id_label = utils.clean(id_label), 
+                                       current_commits = current_commits, 
+                                       prior_commits = prior_commits, 
+                                       merit_credit = merit_credit, 
+                                       milestone_credit = milestone_credit, 
+                                       rehab_credit = rehab_credit, 
+                                       voced_credit = voced_credit, 
+                                       rv_report = rv_report, 
+                                       merge = merge,
+                                       batch_size = chunk_size)))
+
+
+def join_by_id(data, 
+               id_label, 
+               cdcr_nums, 
+               col, 
+               sep):
+    """
 
-    
\ No newline at end of file
+    Parameters
+    ----------
+    data : pandas dataframe
+        Data wherein each row pertains to a single record (ex: offense) of a CDCR number
+    id_label : str
+        Name of the column with the CDCR IDs
+    cdcr_nums : pandas series
+        CDCR numbers to join the records of
+    col : str
+        Name of the column in data with the records to join
+    sep : str
+        Separator between the records of a CDCR number
+
+    Returns
+    -------
+    pandas series
+        Joined records of each CDCR number in the order of cdcr_nums (empty string if a CDCR number has no records)
+
+    """
+    # Only group the rows of the selected CDCR numbers
+    sel = data.loc[data[id_label].isin(cdcr_nums), [id_label, col]]
+    joined = sel[col].astype(str).groupby(sel[id_label], sort = False, observed = True).agg(sep.join)
+    return cdcr_nums.map(joined).fillna('')
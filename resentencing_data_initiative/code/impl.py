@@ -102,4 +102,32 @@ def gen_impl_val(impl, sep, perm, fix_pos, placeholder):
     # If there are no placeholders return the original list of strings
     return list(set(sel))
         
-        
\ No newline at end of file
+        
+
+def gen_impl_map(offenses, 
+                 impl_rel, 
+                 perm, 
+                 fix_pos = None, 
+                 placeholder = None,
+                 sep = ''):
+    
+    # Generate the implied values of every relation once
+    impl_val = {rel: gen_impl_val(impl = impl_rel[rel], 
+                                  sep = sep, 
+                                  perm = perm, 
+                                  fix_pos = fix_pos, 
+                                  placeholder = placeholder) for rel in impl_rel.keys()}
+    
+    # Map each (cleaned) offense to itself and its implied offenses, as gen_impl_off() would for a list with that offense
+    impl_map = {}
+    for off in set(offenses):
+        # Exceptions are only implied by their own relation, all the other offenses by the relation that applies to 'all'
+        if (off != 'all') and (off in impl_rel):
+            impl_off = [off+iv for iv in impl_val[off]]
+        elif 'all' in impl_rel:
+            impl_off = [off+iv for iv in impl_val['all']]
+        else:
+            impl_off = []
+        impl_map[off] = set([off]+impl_off)
+    
+    return impl_map
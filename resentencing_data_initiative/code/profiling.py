@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+import cProfile
+import pstats
+import tracemalloc
+import functools
+import os
+import io
+import threading
+
+
+# Number of times each stage has been profiled (used to name the outputs of repeated calls)
+counts = {}
+# Name of the stage that is currently being profiled by each thread (stages can run in parallel threads, see dag.run()). Stages called within it are captured by its profile
+active = threading.local()
+# Number of stages that are recording memory allocations. tracemalloc traces every thread, so it is stopped when the last of them finishes
+tracing = 0
+# Whether tracemalloc was started here (it is not stopped if it was started by the caller)
+owned = False
+lock = threading.Lock()
+
+
+def enabled(flag = None):
+    """
+
+    Parameters
+    ----------
+    flag : boolean, optional
+        Value of the profiling flag passed on the command line or in config.py. If None, only the environment variable is checked
+        Default is None.
+
+    Returns
+    -------
+    boolean
+        True if profiling is requested by the flag or by the THREE_STRIKES_PROFILE environment variable
+
+    """
+    return bool(flag) or os.environ.get('THREE_STRIKES_PROFILE', '').lower() in ['1', 'true', 'yes']
+
+
+def wrap(func,
+         stage,
+         write_path,
+         memory = False,
+         top = 30):
+    """
+
+    Parameters
+    ----------
+    func : function
+        Function of the pipeline stage to profile, ex: helpers.gen_time_vars
+    stage : str
+        Name of the stage, used to name the output files
+    write_path : str
+        Full path of the folder where the profiles should be written
+    memory : boolean, optional
+        Specify whether to also record memory allocations with tracemalloc
+        Default is False.
+    top : int, optional
+        Number of functions and allocation sites to include in the text reports
+        Default is 30.
+
+    Returns
+    -------
+    function
+        Function with the same behavior as func that writes a .prof file, a text summary of the profile and (if memory = True) the top allocation sites every time it is called
+
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        global tracing, owned
+
+        # Stages called from within a stage that is already being profiled by the same thread are part of its profile
+        if getattr(active, 'stage', None):
+            return func(*args, **kwargs)
+
+        # Name the outputs after the stage and the number of times it has been called (stages of parallel threads get different numbers)
+        with lock:
+            counts[stage] = counts.get(stage, 0) + 1
+            name = write_path+'/'+stage+'_'+str(counts[stage])
+            # Only the first of the stages that record memory starts tracing, and the last one stops it
+            # The peak is reset by every stage, so the peak of stages that run at the same time includes the allocations of the others
+            if memory:
+                if tracing == 0:
+                    owned = not tracemalloc.is_tracing()
+                    if owned:
+                        tracemalloc.start()
+                tracemalloc.reset_peak()
+                tracing += 1
+
+        # The profiler only records the calls of the calling thread
+        # Python 3.12 and later allow a single profiler at a time, so a stage that starts while another thread profiles runs without a profile
+        profiler = cProfile.Profile()
+        active.stage = stage
+        try:
+            profiler.enable()
+        except ValueError:
+            print('Warning: stage', stage, 'is not profiled because another stage is being profiled at the same time. Use --workers 1 to profile every stage')
+            profiler = None
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            active.stage = None
+
+            # Write the raw profile (can be opened with snakeviz or pstats) and a text summary of the most expensive functions
+            if profiler is not None:
+                profiler.dump_stats(name+'.prof')
+                stream = io.StringIO()
+                pstats.Stats(profiler, stream = stream).sort_stats('cumulative').print_stats(top)
+                with open(name+'_prof.txt', 'w') as f:
+                    f.write(stream.getvalue())
+
+            # Write the lines of code that allocated the most memory
+            if memory:
+                with lock:
+                    snapshot = tracemalloc.take_snapshot()
+                    current, peak = tracemalloc.get_traced_memory()
+                    tracing -= 1
+                    if (tracing == 0) and owned:
+                        tracemalloc.stop()
+                with open(name+'_alloc.txt', 'w') as f:
+                    f.write('Peak traced memory (mb): '+str(round(peak/(1024*1024), 2))+'\n\n')
+                    for s in snapshot.statistics('lineno')[:top]:
+                        f.write(str(s)+'\n')
+            if profiler is not None:
+                print('Profile of stage', stage, 'written to: ', name+'.prof')
+
+    return wrapper
+
+
+def install(write_path,
+            flag = None,
+            memory = None):
+    """
+
+    Parameters
+    ----------
+    write_path : str
+        Full path of the output folder. Profiles are written to its 'profile' sub-folder
+    flag : boolean, optional
+        Value of the profiling flag passed on the command line or in config.py. Profiling is also switched on by the THREE_STRIKES_PROFILE environment variable
+        Default is None.
+    memory : boolean, optional
+        Specify whether to record memory allocations with tracemalloc. Also switched on by the THREE_STRIKES_PROFILE_MEMORY environment variable
+        Default is None.
+
+    Returns
+    -------
+    boolean
+        True if the pipeline stages were wrapped with profilers
+        If profiling is not requested, nothing is wrapped and the stages run without any overhead
+
+    """
+    if not enabled(flag):
+        return False
+
+    # Imported here so that this module can be loaded without the pipeline modules
+    import extract
+    import helpers
+    import utils
+    import tables
+    import eligibility
+
+    memory = bool(memory) or os.environ.get('THREE_STRIKES_PROFILE_MEMORY', '').lower() in ['1', 'true', 'yes']
+    write_path = write_path+'/profile'
+
+    # If directory does not exist, then first create it
+    if not os.path.exists(write_path):
+        os.makedirs(write_path)
+
+    # Replace the module attributes so that every caller picks up the wrapped stage
+    for module, name in [(extract, 'get_input'),
+                         (helpers, 'gen_time_vars'),
+                         (utils, 'clean_blk'),
+                         (tables, 'gen_index'),
+                         (helpers, 'gen_summary')]:
+        if not hasattr(getattr(module, name), '__wrapped__'):
+            setattr(module, name, wrap(getattr(module, name), stage = name, write_path = write_path, memory = memory))
+
+    # Rules are evaluated through the evaluate functions of the rule registry
+    for rule in eligibility.el_rules.keys():
+        func = eligibility.el_rules[rule]['evaluate']
+        if not hasattr(func, '__wrapped__'):
+            eligibility.el_rules[rule]['evaluate'] = wrap(func, stage = 'eligibility_'+rule, write_path = write_path, memory = memory)
+
+    print('Profiling of pipeline stages is switched on. Profiles are written to: ', write_path)
+
+    return True
@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import warnings
+import json
+import os
+import utils
+
+
+# Columns that every extracted dataset must have (cleaned names, see utils.clean()), besides the CDCR ID column
+# The datasets are listed in naming_convention/file_names.txt and their variables in the README. The columns that the rules and summaries of a run read are added to these (see run.get_usecols())
+schema = {'sorting_criteria': ['Table', 'Offenses'],
+          'demographics': ['birthday', 'offense end date', 'aggregate sentence in months'],
+          'current_commits': [],
+          'prior_commits': [],
+          'merit_credit': [],
+          'milestone_credit': [],
+          'rehab_credit': [],
+          'voced_credit': [],
+          'rv_report': []}
+
+# Expected type of the columns that are parsed by the pipeline (the other columns are read as text)
+kinds = {'birthday': 'date',
+         'offense end date': 'date',
+         'offense begin date': 'date',
+         'rule violation date': 'date',
+         'aggregate sentence in months': 'number'}
+
+
+def gen_required(id_label,
+                 usecols = None):
+    """
+
+    Parameters
+    ----------
+    id_label : str
+        Name of the column with the CDCR IDs
+    usecols : dict, optional
+        Cleaned columns that the stages of the run read by dataset name (see run.get_usecols()). Datasets that are not in it are not checked
+        Default is None, i.e. every dataset is checked against the schema.
+
+    Returns
+    -------
+    required : dict
+        Cleaned names of the columns that each dataset must have, by dataset name
+
+    """
+    required = {}
+    for name, cols in schema.items():
+        if (usecols is not None) and (name not in usecols):
+            continue
+        extra = usecols.get(name) if usecols is not None else None
+        # The sorting criteria do not have CDCR IDs
+        ids = [] if name == 'sorting_criteria' else [utils.clean(id_label)]
+        required[name] = list(dict.fromkeys(ids+cols+(extra or [])))
+    return required
+
+
+def record(checks,
+           name,
+           col,
+           check,
+           severity,
+           count,
+           rows,
+           examples = None):
+    """
+
+    Parameters
+    ----------
+    checks : list
+        Results of the checks (see check_data()). The result is only added if count > 0
+    name : str
+        Name of the dataset, ex: 'demographics'
+    col : str or None
+        Name of the column that was checked
+    check : str
+        Description of the check, ex: 'values are not dates'
+    severity : str
+        'error' (the run is stopped, see raise_errors()) or 'warning'
+    count : int
+        Number of rows (or IDs) that failed the check
+    rows : int
+        Number of rows (or IDs) that were checked
+    examples : list, optional
+        Examples of values that failed the check
+        Default is None.
+
+    Returns
+    -------
+    None.
+
+    """
+    if count:
+        checks.append({'dataset': name,
+                       'column': col,
+                       'check': check,
+                       'severity': severity,
+                       'count': int(count),
+                       'rows': int(rows),
+                       'rate (%)': round(100*count/rows, 2) if rows else None,
+                       'examples': [str(val) for val in examples[:5]] if examples is not None else None})
+
+
+def check_data(datasets,
+               id_label,
+               usecols = None,
+               min_parse_rate = 0.99):
+    """
+
+    Parameters
+    ----------
+    datasets : dict
+        Extracted datasets by name (see run.run_extract())
+    id_label : str
+        Name of the column with the CDCR IDs
+    usecols : dict, optional
+        Cleaned columns that the stages of the run read by dataset name (see run.get_usecols()). Only these datasets are checked and their columns are required
+        Default is None, i.e. every dataset is checked against the schema.
+    min_parse_rate : float, optional
+        Share of the values of a date or number column that have to parse. Values that do not parse become missing and the individuals are then excluded by the rules that compare them
+        Default is 0.99.
+
+    Returns
+    -------
+    report : pandas dataframe
+        One row per failed check, with the dataset, column, severity ('error' or 'warning'), number and share of the rows that failed and examples of the values
+        Every check is done on whole columns at once
+
+    """
+    checks = []
+    id_col = utils.clean(id_label)
+    required = gen_required(id_label, usecols = usecols)
+
+    # Column names are compared after cleaning, as in eligibility.prep_data()
+    data = {}
+    for name, cols in required.items():
+        df = datasets.get(name)
+        if df is None:
+            record(checks, name, None, 'dataset is missing', 'error', 1, 1)
+            continue
+        if name != 'sorting_criteria':
+            df = df.set_axis([utils.clean(col, remove = ['\n']) for col in df.columns], axis = 1, copy = False)
+        data[name] = df
+        missing = [col for col in cols if col not in df.columns]
+        record(checks, name, ', '.join(missing), 'required columns are missing', 'error', len(missing), len(cols), examples = missing)
+        if (name == 'demographics') and df.empty:
+            record(checks, name, None, 'dataset is empty', 'error', 1, 1)
+
+    # Missing values and types of the CDCR IDs and of the columns that are parsed (other columns, ex: the enhancements, are often empty)
+    for name, df in data.items():
+        for col in required[name]:
+            kind = kinds.get(col)
+            if (col not in df.columns) or ((kind is None) and (col != id_col)):
+                continue
+            values = df[col]
+            present = values.notna()
+            record(checks, name, col, 'missing values', 'warning', len(df) - present.sum(), len(df))
+            if kind is None:
+                continue
+            # Values are parsed as the pipeline parses them, so that the share of values that become missing is the share the rules lose
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                parsed = pd.to_datetime(values, errors = 'coerce') if kind == 'date' else pd.to_numeric(values, errors = 'coerce')
+            failed = present & parsed.isna()
+            count = failed.sum()
+            if count:
+                record(checks, name, col, 'values are not '+('dates' if kind == 'date' else 'numbers'), 'error' if count > (1 - min_parse_rate)*present.sum() else 'warning', count, present.sum(), examples = values[failed].unique().tolist())
+
+    # CDCR IDs that appear in more than one row of the demographics (only the first row is used, see store.gen_store())
+    demographics = data.get('demographics')
+    if (demographics is not None) and (id_col in demographics.columns):
+        ids = demographics[id_col]
+        dup = ids.duplicated(keep = 'first')
+        record(checks, 'demographics', id_col, 'duplicate CDCR IDs', 'warning', dup.sum(), len(ids), examples = ids[dup].unique().tolist())
+
+        # CDCR IDs of the other datasets that are not in the demographics (their rows are ignored by the rules and summaries)
+        for name, df in data.items():
+            if (name in ['demographics', 'sorting_criteria']) or (id_col not in df.columns):
+                continue
+            orphan = ~df[id_col].isin(ids)
+            record(checks, name, id_col, 'CDCR IDs are not in the demographics', 'warning', orphan.sum(), len(df), examples = df.loc[orphan.values, id_col].unique().tolist())
+
+        # Individuals without a current commitment
+        if ('current_commits' in data) and (id_col in data['current_commits'].columns):
+            unmatched = ~ids.isin(data['current_commits'][id_col])
+            record(checks, 'demographics', id_col, 'CDCR IDs have no current commitment', 'warning', unmatched.sum(), len(ids), examples = ids[unmatched].unique().tolist())
+
+    return pd.DataFrame(checks, columns = ['dataset', 'column', 'check', 'severity', 'count', 'rows', 'rate (%)', 'examples'])
+
+
+def write_report(report,
+                 write_path,
+                 file_name = 'data_quality.json'):
+    """
+
+    Parameters
+    ----------
+    report : pandas dataframe
+        Results of the checks (see check_data())
+    write_path : str
+        Full path of the folder where the report should be written, i.e. next to the Excel outputs
+    file_name : str, optional
+        Name of the report file
+        Default is 'data_quality.json'
+
+    Returns
+    -------
+    None.
+
+    """
+    # If directory does not exist, then first create it
+    if not os.path.exists(write_path):
+        os.makedirs(write_path)
+
+    with open(write_path+'/'+file_name, 'w') as f:
+        json.dump(report.to_dict(orient = 'records'), f, indent = 2, default = str)
+    print('Data quality report written to: ', write_path+'/'+file_name)
+
+
+def raise_errors(report):
+    """
+
+    Parameters
+    ----------
+    report : pandas dataframe
+        Results of the checks (see check_data())
+
+    Returns
+    -------
+    None.
+        Prints the warnings and raises a ValueError with all the errors, so that the run stops before any rule is applied
+
+    """
+    messages = {'error': [], 'warning': []}
+    for row in report.to_dict(orient = 'records'):
+        message = row['dataset']+(' - '+row['column'] if row['column'] else '')+': '+row['check']+' ('+str(row['count'])+' of '+str(row['rows'])+')'
+        if row['examples']:
+            message += ', ex: '+', '.join(row['examples'])
+        messages[row['severity']].append(message)
+
+    for message in messages['warning']:
+        print('Warning: ', message)
+    if messages['error']:
+        raise ValueError('The extracted data failed the data quality checks:\n'+'\n'.join(messages['error']))
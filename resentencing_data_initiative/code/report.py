@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import time
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+# Peak memory of the stages that are currently being tracked in each thread (innermost stage last)
+# Stages that run at the same time (see dag.py) share the memory of the process, so their readings include each other
+local = threading.local()
+# Number of threads with a stage that is being tracked. The high-water mark of the process is only reset when a single thread tracks stages, so that a stage does not erase the peak of a stage of another thread
+threads = 0
+lock = threading.Lock()
+
+
+def get_peaks():
+    """
+
+    Returns
+    -------
+    list
+        Peak memory of the stages that are currently being tracked in the calling thread
+
+    """
+    if not hasattr(local, 'peaks'):
+        local.peaks = []
+    return local.peaks
+
+
+def rss():
+    """
+
+    Returns
+    -------
+    float or None
+        Current resident set size of the process in MB
+        Returns None on platforms without /proc (the peak is then measured with the resource module)
+
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*os.sysconf('SC_PAGE_SIZE')/(1024*1024)
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def peak_rss():
+    """
+
+    Returns
+    -------
+    float or None
+        Peak resident set size (high-water mark) of the process in MB since it was last reset with reset_peak_rss()
+        Returns None on platforms where neither /proc nor the resource module is available
+
+    """
+    # Linux keeps a resettable high-water mark
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS reports bytes
+    if sys.platform == 'darwin':
+        return maxrss/(1024*1024)
+    return maxrss/1024
+
+
+def reset_peak_rss():
+    """
+
+    Returns
+    -------
+    boolean
+        True if the high-water mark of the process was reset to its current resident set size (Linux only)
+        Elsewhere the peak of a stage can only be measured if it exceeds the peak of all earlier stages
+
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+@contextmanager
+def track(run_report,
+          stage,
+          rule_id = None,
+          category = None,
+          input_size = None):
+    """
+
+    Parameters
+    ----------
+    run_report : list or None
+        List of records to append the record of this stage to. If None, nothing is measured or recorded
+    stage : str
+        Name of the pipeline stage, ex: 'extract' or 'adult'
+    rule_id : str, optional
+        Key of the rule in the scenario, ex: 'r_1'
+        Default is None.
+    category : str or list, optional
+        Category of the rule (from rules.cat)
+        Default is None.
+    input_size : int, optional
+        Number of CDCR numbers (or rows) passed into the stage
+        Default is None.
+
+    Yields
+    ------
+    record : dict
+        Record of the stage. The caller should set record['output size'] before the block exits
+        The CPU time is the time of the calling thread. The peak memory is the peak of the process, so 'concurrent' is True if stages of other threads were tracked at the same time and their memory is included (use --workers 1 to measure the peak of every stage on its own)
+
+    """
+    global threads
+
+    # Initialize the record
+    record = {'stage': stage,
+              'rule id': rule_id,
+              'category': category,
+              'input size': input_size,
+              'output size': None}
+
+    # Do not measure anything if a report is not requested
+    if run_report is None:
+        yield record
+        return
+
+    # Take readings before the stage is executed
+    peaks = get_peaks()
+    with lock:
+        if not peaks:
+            threads += 1
+        concurrent = threads > 1
+        rss_start = rss()
+        # Only reset the high-water mark if no stage of another thread is measuring it
+        reset = (not concurrent) and reset_peak_rss()
+        if (rss_start is None) or not (reset or concurrent):
+            rss_start = peak_rss()
+    peaks.append(rss_start)
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+
+    try:
+        yield record
+    finally:
+        # Take readings after the stage is executed
+        record['wall time (s)'] = round(time.perf_counter() - wall_start, 4)
+        record['cpu time (s)'] = round(time.thread_time() - cpu_start, 4)
+        # The high-water mark may have been reset by a nested stage, so the peaks of nested stages are taken into account
+        peak = peak_rss()
+        nested_peak = peaks.pop()
+        with lock:
+            concurrent = concurrent or threads > 1
+            if not peaks:
+                threads -= 1
+        record['concurrent'] = concurrent
+        if peak is not None:
+            peak = max(peak, nested_peak)
+            if peaks:
+                peaks[-1] = max(peaks[-1], peak)
+        record['peak rss (mb)'] = round(peak, 2) if peak is not None else None
+        record['peak memory delta (mb)'] = round(peak - rss_start, 2) if peak is not None else None
+        run_report.append(record)
+
+
+def funnel(run_report):
+    """
+
+    Parameters
+    ----------
+    run_report : list
+        Records generated with track()
+
+    Returns
+    -------
+    df : pandas dataframe
+        Funnel table with one row per stage or rule, the cohort size before and after it and the share of the cohort retained
+
+    """
+    df = pd.DataFrame(run_report)
+    if df.empty:
+        return df
+
+    # Cohort sizes are missing for some stages
+    for col in ['input size', 'output size']:
+        df[col] = pd.to_numeric(df[col]).astype('Int64')
+    
+    # Share of the input cohort retained by each rule
+    df['retained (%)'] = (100*df['output size']/df['input size']).astype('float').round(2)
+    # Share of the total run time spent in each stage or rule (rules are nested in their scenario stage, so only stages add up to the total)
+    total = df.loc[df['rule id'].isna(), 'wall time (s)'].sum()
+    df['wall time (%)'] = (100*df['wall time (s)']/total).round(2)
+
+    return df
+
+
+def write_report(run_report,
+                 write_path,
+                 file_name = 'run_report.json'):
+    """
+
+    Parameters
+    ----------
+    run_report : list
+        Records generated with track()
+    write_path : str
+        Full path of the folder where the report should be written, i.e. next to the Excel outputs
+    file_name : str, optional
+        Name of the report file
+        Default is 'run_report.json'
+
+    Returns
+    -------
+    df : pandas dataframe
+        Funnel table of the run
+
+    """
+    # If directory does not exist, then first create it
+    if not os.path.exists(write_path):
+        os.makedirs(write_path)
+
+    # Write the records to a json file
+    with open(write_path+'/'+file_name, 'w') as f:
+        json.dump(run_report, f, indent = 2, default = str)
+    print('Run report written to: ', write_path+'/'+file_name)
+
+    # Render the funnel table
+    df = funnel(run_report)
+    if not df.empty:
+        print(df[['stage', 'rule id', 'category', 'input size', 'output size', 'retained (%)', 'wall time (s)', 'cpu time (s)', 'peak memory delta (mb)', 'wall time (%)']].to_string(index = False))
+
+    return df
@@ -1,169 +1,995 @@
 # -*- coding: utf-8 -*-
-import helpers
-import utils
 import config
-from scenarios import adult
-from scenarios import juvenile
-from scenarios import robbery
-from scenarios import rules
-from scenarios import utils
-import extract 
-import eligibility
-import summary
-import pandas as pd
-import numpy as np
-import datetime
-from tqdm import tqdm
-import copy
+import argparse
+import importlib
+import json
+import time
 import os
 
-print('\n######################################################################')
-print('################################## START ###############################')
-print('########################################################################')
-
-# Extract all the relevant datasets from the path
-sorting_criteria, demographics, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report, current_commits, prior_commits = extract.get_input(read_path = config.read_data_path, 
-                                                                                                                                                          month = config.month,
-                                                                                                                                                          county_name = config.county_name, 
-                                                                                                                                                          pickle = False) 
-
-print('\n######################################################################')
-print('################################ COMPLETE ##############################')
-print('########################################################################')
-
-print('\n######################################################################')
-print('################################## START ###############################')
-print('########################################################################')
-
-# Identify eligible CDCR numbers for adults and juveniles
-errors, adult_el_cdcr_nums = eligibility.gen_eligibility(demographics = demographics, 
-                                                         sorting_criteria = sorting_criteria,
-                                                         current_commits = current_commits, 
-                                                         prior_commits = prior_commits, 
-                                                         read_path = config.read_data_path, 
-                                                         county_name = config.county_name, 
-                                                         month = config.month,
-                                                         eligibility_conditions = adult.el_cond,
-                                                         pop_label = adult.el_cond['population'],
-                                                         id_label = config.id_label, 
-                                                         to_excel = True)
-
-print('\n######################################################################')
-print('################################ COMPLETE ##############################')
-print('########################################################################')
-
-print('\n######################################################################')
-print('################################## START ###############################')
-print('########################################################################')
-
-errors, juvenile_el_cdcr_nums = eligibility.gen_eligibility(demographics = demographics, 
-                                                            sorting_criteria = sorting_criteria,
-                                                            current_commits = current_commits, 
-                                                            prior_commits = prior_commits, 
-                                                            read_path = config.read_data_path, 
-                                                            county_name = config.county_name, 
-                                                            month = config.month,
-                                                            eligibility_conditions = juvenile.el_cond,
-                                                            pop_label = juvenile.el_cond['population'],
-                                                            id_label = config.id_label, 
-                                                            to_excel = True)
-
-print('\n######################################################################')
-print('################################ COMPLETE ##############################')
-print('########################################################################')
-
-print('\n######################################################################')
-print('################################## START ###############################')
-print('########################################################################')
-
-errors, rob_el_cdcr_nums = eligibility.gen_eligibility(demographics = demographics, 
-                                                       sorting_criteria = sorting_criteria,
-                                                       current_commits = current_commits, 
-                                                       prior_commits = prior_commits, 
-                                                       read_path = config.read_data_path, 
-                                                       county_name = config.county_name, 
-                                                       month = config.month,
-                                                       eligibility_conditions = robbery.el_cond,
-                                                       pop_label = robbery.el_cond['offense type'],
-                                                       id_label = config.id_label, 
-                                                       to_excel = True)
-
-print('\n######################################################################')
-print('################################ COMPLETE ##############################')
-print('########################################################################')
-
-print('\n######################################################################')
-print('################################## START ###############################')
-print('########################################################################')
-
-# Generate summaries of eligible individuals in the CDCR system
-adult_summary = summary.gen_summary(cdcr_nums = adult_el_cdcr_nums, 
-                                    demographics = demographics,
-                                    current_commits = current_commits, 
-                                    prior_commits = prior_commits, 
-                                    merit_credit = merit_credit, 
-                                    milestone_credit = milestone_credit, 
-                                    rehab_credit = rehab_credit, 
-                                    voced_credit = voced_credit, 
-                                    rv_report = rv_report, 
-                                    read_path = config.read_data_path,
-                                    county_name = config.county_name, 
-                                    month = config.month,
-                                    pop_label = adult.el_cond['population'],
-                                    id_label = config.id_label, 
-                                    write_path = None,
-                                    to_excel = True)
-
-print('\n######################################################################')
-print('################################ COMPLETE ##############################')
-print('########################################################################')
-
-print('\n######################################################################')
-print('################################## START ###############################')
-print('########################################################################')
-
-juvenile_summary = summary.gen_summary(cdcr_nums = juvenile_el_cdcr_nums, 
-                                       demographics = demographics,
-                                       current_commits = current_commits, 
-                                       prior_commits = prior_commits, 
-                                       merit_credit = merit_credit, 
-                                       milestone_credit = milestone_credit, 
-                                       rehab_credit = rehab_credit, 
-                                       voced_credit = voced_credit, 
-                                       rv_report = rv_report, 
-                                       read_path = config.read_data_path,
-                                       county_name = config.county_name, 
-                                       month = config.month,
-                                       id_label = config.id_label, 
-                                       pop_label = juvenile.el_cond['population'], 
-                                       write_path = None,
-                                       to_excel = True)
-
-print('\n######################################################################')
-print('################################ COMPLETE ##############################')
-print('########################################################################')
-
-print('\n######################################################################')
-print('################################## START ###############################')
-print('########################################################################')
-
-rob_summary = summary.gen_summary(cdcr_nums = rob_el_cdcr_nums, 
-                                  demographics = demographics,
-                                  current_commits = current_commits, 
-                                  prior_commits = prior_commits, 
-                                  merit_credit = merit_credit, 
-                                  milestone_credit = milestone_credit, 
-                                  rehab_credit = rehab_credit, 
-                                  voced_credit = voced_credit, 
-                                  rv_report = rv_report, 
-                                  read_path = config.read_data_path,
-                                  county_name = config.county_name, 
-                                  month = config.month,
-                                  id_label = config.id_label,
-                                  pop_label = robbery.el_cond['offense type'], 
-                                  write_path = None,
-                                  to_excel = True)
-
-print('\n######################################################################')
-print('################################ COMPLETE ##############################')
-print('########################################################################')
+# Only light modules are imported here so that --help and small commands start quickly
+# The pipeline modules (and pandas) are imported by the commands that need them
+
+
+# Scenarios that can be run and the key of el_cond used to label their outputs
+scenario_labels = {'adult': 'population',
+                   'juvenile': 'population',
+                   'robbery': 'offense type'}
+
+# Settings that can be passed with flags or in a json config file (defaults are taken from config.py)
+settings = ['read_data_path', 'county_name', 'month', 'id_label', 'profile', 'profile_memory', 'memory_budget_mb', 'max_pending_writes', 'cache_inputs', 'checkpoint', 'max_workers', 'engine', 'summary_stream', 'summary_batch_size', 'processes', 'check_quality', 'min_parse_rate', 'near_miss']
+
+
+def banner(status):
+    """
+
+    Parameters
+    ----------
+    status : str
+        Status of the stage, i.e. 'START' or 'COMPLETE'
+
+    Returns
+    -------
+    None.
+
+    """
+    lines = {'START': '################################## START ###############################',
+             'COMPLETE': '################################ COMPLETE ##############################'}
+    print('\n######################################################################')
+    print(lines[status])
+    print('########################################################################')
+
+
+def load_config(args):
+    """
+
+    Parameters
+    ----------
+    args : argparse namespace
+        Parsed command line arguments
+
+    Returns
+    -------
+    cfg : dict
+        Settings of the run. Values in config.py are overridden by the json config file (--config), which is overridden by the flags
+
+    """
+    # Defaults from config.py
+    cfg = {key: getattr(config, key, None) for key in settings}
+
+    # Values from the config file
+    if getattr(args, 'config', None):
+        with open(args.config) as f:
+            file_cfg = json.load(f)
+        unknown = set(file_cfg.keys()) - set(settings)
+        if unknown:
+            raise ValueError('Unknown settings in config file: '+', '.join(sorted(unknown))+'. Available settings are: '+', '.join(settings))
+        cfg.update(file_cfg)
+
+    # Values from the flags
+    for key in settings:
+        val = getattr(args, key, None)
+        if val is not None:
+            cfg[key] = val
+
+    return cfg
+
+
+def get_scenarios(names):
+    """
+
+    Parameters
+    ----------
+    names : list
+        Names of the scenarios to run, ex: ['adult', 'robbery']. 'all' runs every scenario
+
+    Returns
+    -------
+    scenarios : list of tuples
+        Name, output label and eligibility conditions (el_cond) of each scenario
+
+    """
+    if (not names) or ('all' in names):
+        names = list(scenario_labels.keys())
+    scenarios = []
+    for name in names:
+        el_cond = importlib.import_module('scenarios.'+name).el_cond
+        scenarios.append((name, el_cond[scenario_labels[name]], el_cond))
+    return scenarios
+
+
+def get_write_path(cfg):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+
+    Returns
+    -------
+    str
+        Output folder of the run
+
+    """
+    import utils
+    return utils.get_write_path(read_path = cfg['read_data_path'], county_name = cfg['county_name'], month = cfg['month'])
+
+
+def get_usecols(cfg,
+                command,
+                args):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    command : str
+        Subcommand, ex: 'all' or 'validate'
+    args : argparse namespace
+        Parsed command line arguments
+
+    Returns
+    -------
+    usecols : dict or None
+        Cleaned columns to read by dataset name (see extract.get_input()), ex: {'demographics': ['age in years', 'cdcno', ...], 'merit_credit': ['cdcno']}
+        None if all the columns of all the datasets are read, ex: for the validate and extract commands
+
+    """
+    if command not in ['all', 'eligibility', 'summary']:
+        return None
+    import eligibility
+    import summary
+    import utils
+
+    # Columns that the rules of the scenarios read (the sorting criteria are always read in full)
+    usecols = eligibility.gen_requirements([el_cond for name, label, el_cond in get_scenarios(getattr(args, 'scenario', None))], cfg['id_label'], extracted = True)
+    usecols['sorting_criteria'] = None
+    # The Excel outputs of the eligible cohorts have all the demographics and current commitments
+    if getattr(args, 'to_excel', True):
+        usecols['demographics'] = None
+        usecols['current_commits'] = None
+    # Columns of the summaries
+    if command in ['all', 'summary']:
+        for name, cols in summary.cols.items():
+            if (cols is None) or (usecols.get(name, []) is None):
+                usecols[name] = None
+            else:
+                usecols[name] = sorted(set(usecols.get(name, [])).union(cols, [utils.clean(cfg['id_label'])]))
+    # The cohort report and the sub-cohorts profile all the columns of the demographics and commitments
+    if getattr(args, 'cohort_report', False) or getattr(args, 'subcohorts', 0):
+        for name in ['demographics', 'current_commits', 'prior_commits']:
+            usecols[name] = None
+    return usecols
+
+
+def run_extract(cfg,
+                run_report = None,
+                pickle = False,
+                usecols = None):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+    pickle : boolean, optional
+        Specify whether to store the extracted datasets as pickle files
+        Default is False.
+    usecols : dict, optional
+        Cleaned columns to read by dataset name (see get_usecols()). The datasets that are not in it are not read
+        Default is None, i.e. all the columns of all the datasets are read.
+
+    Returns
+    -------
+    datasets : dict
+        Extracted datasets by name
+
+    """
+    import extract
+    import report
+    import utils
+
+    banner('START')
+    # Extract all the relevant datasets from the path
+    with report.track(run_report, stage = 'extract') as record:
+        data = extract.get_input(read_path = cfg['read_data_path'],
+                                 month = cfg['month'],
+                                 county_name = cfg['county_name'],
+                                 pickle = pickle,
+                                 cache = cfg['cache_inputs'],
+                                 usecols = usecols)
+        datasets = dict(zip(['sorting_criteria', 'demographics', 'merit_credit', 'milestone_credit', 'rehab_credit', 'voced_credit', 'rv_report', 'current_commits', 'prior_commits'], data))
+        record['output size'] = len(datasets['demographics'])
+
+    # Warn if the extracted data alone is estimated to exceed the memory budget
+    utils.check_memory_budget(stage = 'extract',
+                              est_mb = sum(utils.est_memory(df) for name, df in datasets.items() if (name != 'sorting_criteria') and (df is not None)),
+                              budget_mb = cfg['memory_budget_mb'])
+    banner('COMPLETE')
+
+    return datasets
+
+
+def run_quality(cfg,
+                datasets,
+                usecols = None,
+                run_report = None,
+                write_path = None):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    datasets : dict
+        Extracted datasets (see run_extract())
+    usecols : dict, optional
+        Cleaned columns that the stages of the run read by dataset name (see get_usecols()). They are required in the extracted datasets
+        Default is None, i.e. the datasets are checked against the schema (see quality.schema).
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+    write_path : str, optional
+        Full path of the folder where the data quality report is written
+        Default is None, i.e. the report is not written.
+
+    Returns
+    -------
+    datasets : dict
+        Extracted datasets, unchanged. Raises a ValueError if they fail the data quality checks, before any rule is applied (see quality.check_data())
+
+    """
+    import quality
+    import report
+
+    with report.track(run_report, stage = 'quality', input_size = len(datasets['demographics']) if datasets.get('demographics') is not None else None) as record:
+        checks = quality.check_data(datasets, 
+                                    id_label = cfg['id_label'], 
+                                    usecols = usecols, 
+                                    min_parse_rate = cfg['min_parse_rate'])
+        record['errors'] = int((checks['severity'] == 'error').sum())
+        record['warnings'] = int((checks['severity'] == 'warning').sum())
+    if write_path is not None:
+        quality.write_report(checks, write_path = write_path)
+    quality.raise_errors(checks)
+
+    return datasets
+
+
+def run_prepare(cfg,
+                datasets,
+                scenarios = None,
+                run_report = None):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    datasets : dict
+        Extracted datasets (see run_extract())
+    scenarios : list of tuples, optional
+        Scenarios that are run (see get_scenarios()). Only the offense columns that their rules read are cleaned (see eligibility.gen_requirements())
+        Default is None, i.e. all the offense columns are cleaned.
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+
+    Returns
+    -------
+    datasets : dict
+        Extracted datasets with the demographics indexed by CDCR ID and with the time variables, and the offenses cleaned (see eligibility.prep_data()). The data is prepared once for all the scenarios
+
+    """
+    import eligibility
+    import report
+    import utils
+
+    # Clean the column names of every dataset once, on shallow copies, so that the later stages that run at the same time only read them (see dag.run())
+    datasets = {name: df if (df is None) or (name == 'sorting_criteria') else df.set_axis([utils.clean(col, remove = ['\n']) for col in df.columns], axis = 1, copy = False) for name, df in datasets.items()}
+    requirements = eligibility.gen_requirements([el_cond for name, label, el_cond in scenarios], cfg['id_label']) if scenarios else None
+    with report.track(run_report, stage = 'prepare') as record:
+        datasets['demographics'], errors = eligibility.prep_data(demographics = datasets['demographics'],
+                                                                 current_commits = datasets['current_commits'],
+                                                                 prior_commits = datasets['prior_commits'],
+                                                                 id_label = cfg['id_label'],
+                                                                 run_report = run_report,
+                                                                 stage = 'prepare',
+                                                                 requirements = requirements)
+        record['output size'] = len(datasets['demographics'])
+
+    return datasets
+
+
+def run_scenario(cfg,
+                 datasets,
+                 label,
+                 el_cond,
+                 run_report = None,
+                 to_excel = True,
+                 write_path = None,
+                 prepared = False,
+                 explain = False):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    datasets : dict
+        Extracted datasets (see run_extract())
+    label : str
+        Output label of the scenario, ex: 'adult'
+    el_cond : dict
+        Eligibility conditions of the scenario
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+    to_excel : boolean, optional
+        Specify whether to write the eligible CDCR numbers to Excel
+        Default is True.
+    write_path : str, optional
+        Full path of the folder where the outputs are written
+        Default is None, i.e. the default output folder (see utils.get_write_path()).
+    prepared : boolean, optional
+        Specify whether the datasets were already prepared (see run_prepare())
+        Default is False.
+    explain : boolean, optional
+        Specify whether to write whether each individual meets each rule (see eligibility.gen_explanations())
+        Default is False.
+
+    Returns
+    -------
+    list
+        Eligible CDCR numbers of the scenario
+
+    """
+    import eligibility
+    import checkpoint
+    import report
+    import shared
+
+    def identify():
+        # Identify eligible CDCR numbers for the scenario
+        with report.track(run_report, stage = label) as record:
+            kwargs = dict(read_path = cfg['read_data_path'],
+                          county_name = cfg['county_name'],
+                          month = cfg['month'],
+                          eligibility_conditions = el_cond,
+                          pop_label = label,
+                          id_label = cfg['id_label'],
+                          to_excel = to_excel,
+                          write_path = write_path,
+                          prepared = prepared,
+                          explain = explain,
+                          engine = cfg['engine'],
+                          near_miss = cfg['near_miss'])
+            if shared.pool is not None and prepared:
+                # Run the scenario in a worker process, on the prepared data it mapped when it started (see shared.py)
+                errors, cdcr_nums, records = shared.pool.submit(shared.run_eligibility, **kwargs).result()
+                if run_report is not None:
+                    run_report.extend(records)
+            else:
+                # The near misses are also returned if a margin is set (they are written with the eligible individuals)
+                res = eligibility.gen_eligibility(demographics = datasets['demographics'],
+                                                  sorting_criteria = datasets['sorting_criteria'],
+                                                  current_commits = datasets['current_commits'],
+                                                  prior_commits = datasets['prior_commits'],
+                                                  run_report = run_report,
+                                                  **kwargs)
+                errors, cdcr_nums = res[:2]
+            record['output size'] = len(cdcr_nums)
+        return cdcr_nums
+
+    banner('START')
+    # Reuse the eligible CDCR numbers of an earlier run with the same conditions (see checkpoint.py)
+    cdcr_nums = checkpoint.run('eligibility '+label, 
+                               identify, 
+                               key = checkpoint.get_key(el_cond, to_excel, explain, cfg['near_miss']), 
+                               background = True)
+    banner('COMPLETE')
+
+    return cdcr_nums
+
+
+def run_eligibility(cfg,
+                    datasets,
+                    scenarios,
+                    run_report = None,
+                    to_excel = True,
+                    write_path = None,
+                    prepared = False):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    datasets : dict
+        Extracted datasets (see run_extract())
+    scenarios : list of tuples
+        Scenarios to run (see get_scenarios())
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+    to_excel : boolean, optional
+        Specify whether to write the eligible CDCR numbers to Excel
+        Default is True.
+    write_path : str, optional
+        Full path of the folder where the outputs are written
+        Default is None, i.e. the default output folder (see utils.get_write_path()).
+    prepared : boolean, optional
+        Specify whether the datasets were already prepared (see run_prepare())
+        Default is False.
+
+    Returns
+    -------
+    el_cdcr_nums : dict
+        Eligible CDCR numbers by output label of the scenario
+
+    """
+    el_cdcr_nums = {}
+    for name, label, el_cond in scenarios:
+        el_cdcr_nums[label] = run_scenario(cfg, datasets, label, el_cond, run_report = run_report, to_excel = to_excel, write_path = write_path, prepared = prepared)
+    return el_cdcr_nums
+
+
+def run_why(cfg,
+            args):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    args : argparse namespace
+        Parsed command line arguments, with the CDCR number (cdcr_num) and the output folder (output)
+
+    Returns
+    -------
+    None.
+        Prints the rules of each scenario that the CDCR number does not meet and the offending codes
+
+    """
+    import eligibility
+
+    # Output folders of the month, most recent first (or the folder that is passed)
+    if args.output:
+        folders = [args.output]
+    else:
+        output_path = os.path.dirname(get_write_path(cfg))
+        folders = sorted([entry.path for entry in os.scandir(output_path) if entry.is_dir()], key = os.path.getmtime, reverse = True) if os.path.exists(output_path) else []
+
+    for name, label, el_cond in get_scenarios(args.scenario):
+        # Explanations of the most recent run of the scenario with --explain
+        explanations = None
+        for folder in folders:
+            explanations = eligibility.read_explanations(folder+'/'+label+'_explanations.parquet')
+            if explanations is not None:
+                break
+        if explanations is None:
+            print('Warning: no explanations found for', label, '. Run the eligibility with --explain first')
+            continue
+        if args.cdcr_num not in explanations.index:
+            print(label+':', args.cdcr_num, 'is not in the population of the run in', folder)
+            continue
+
+        reasons = eligibility.gen_reasons(explanations, args.cdcr_num, el_cond)
+        if reasons.empty:
+            print(label+':', args.cdcr_num, 'is eligible')
+        else:
+            print(label+':', args.cdcr_num, 'is not eligible because of', len(reasons), 'rule(s)')
+            print(reasons.to_string(index = False))
+
+
+def run_cohort_summary(cfg,
+                       datasets,
+                       label,
+                       cdcr_nums,
+                       run_report = None,
+                       to_excel = True,
+                       write_path = None):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    datasets : dict
+        Extracted datasets (see run_extract())
+    label : str
+        Output label of the scenario, ex: 'adult'
+    cdcr_nums : list
+        Eligible CDCR numbers of the scenario (see run_scenario())
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+    to_excel : boolean, optional
+        Specify whether to write the summary to Excel
+        Default is True.
+    write_path : str, optional
+        Full path of the folder where the outputs are written
+        Default is None, i.e. the default output folder (see utils.get_write_path()).
+
+    Returns
+    -------
+    pandas dataframe or str
+        Summary of the eligible individuals of the scenario, or the full path of the file it was streamed to (see config.summary_stream and config.memory_budget_mb)
+
+    """
+    import summary
+    import checkpoint
+    import report
+
+    def summarize():
+        # Generate summaries of eligible individuals in the CDCR system
+        with report.track(run_report, stage = label+' summary') as record:
+            df = summary.gen_summary(cdcr_nums = cdcr_nums,
+                                     demographics = datasets['demographics'],
+                                     current_commits = datasets['current_commits'],
+                                     prior_commits = datasets['prior_commits'],
+                                     merit_credit = datasets['merit_credit'],
+                                     milestone_credit = datasets['milestone_credit'],
+                                     rehab_credit = datasets['rehab_credit'],
+                                     voced_credit = datasets['voced_credit'],
+                                     rv_report = datasets['rv_report'],
+                                     read_path = cfg['read_data_path'],
+                                     county_name = cfg['county_name'],
+                                     month = cfg['month'],
+                                     pop_label = label,
+                                     id_label = cfg['id_label'],
+                                     write_path = write_path,
+                                     to_excel = to_excel,
+                                     run_report = run_report,
+                                     memory_budget = cfg['memory_budget_mb'],
+                                     stream = cfg['summary_stream'],
+                                     batch_size = cfg['summary_batch_size'])
+            # The summary is streamed to a file if config.summary_stream is set or if it exceeds the memory budget
+            record['output size'] = len(cdcr_nums) if isinstance(df, str) else len(df)
+        return df
+
+    banner('START')
+    # Reuse the summary of an earlier run of the same cohort (see checkpoint.py). The memory budget and the batch size decide whether the summary is streamed and how, so they are part of the key
+    df = checkpoint.run('summary '+label, 
+                        summarize, 
+                        key = checkpoint.get_key(cdcr_nums, to_excel, cfg['summary_stream'], cfg['memory_budget_mb'], cfg['summary_batch_size']), 
+                        background = True)
+    banner('COMPLETE')
+
+    return df
+
+
+def run_summary(cfg,
+                datasets,
+                el_cdcr_nums,
+                run_report = None,
+                to_excel = True,
+                write_path = None):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    datasets : dict
+        Extracted datasets (see run_extract())
+    el_cdcr_nums : dict
+        Eligible CDCR numbers by output label of the scenario (see run_eligibility())
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+    to_excel : boolean, optional
+        Specify whether to write the summaries to Excel
+        Default is True.
+    write_path : str, optional
+        Full path of the folder where the outputs are written
+        Default is None, i.e. the default output folder (see utils.get_write_path()).
+
+    Returns
+    -------
+    summaries : dict
+        Summaries of the eligible individuals by output label of the scenario
+
+    """
+    summaries = {}
+    for label, cdcr_nums in el_cdcr_nums.items():
+        summaries[label] = run_cohort_summary(cfg, datasets, label, cdcr_nums, run_report = run_report, to_excel = to_excel, write_path = write_path)
+    return summaries
+
+
+def run_validate(cfg,
+                 datasets,
+                 scenarios,
+                 reference,
+                 column,
+                 run_report = None,
+                 write_path = None):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    datasets : dict
+        Extracted datasets (see run_extract())
+    scenarios : list of tuples
+        Scenarios to validate (see get_scenarios())
+    reference : str
+        Full path of an Excel or csv file with externally identified eligible CDCR numbers
+    column : str
+        Name of the column of the reference file with the CDCR numbers
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+    write_path : str, optional
+        Folder to write the mismatches of each scenario to
+        Default is None.
+
+    Returns
+    -------
+    res : dict
+        Mismatched CDCR numbers by output label of the scenario (see validation.compare())
+
+    """
+    import validation
+    import report
+
+    # Read the externally identified CDCR numbers
+    ref_cdcr_nums = validation.read_reference(read_path = reference, column = column)
+
+    # Compare them with the CDCR numbers identified by each scenario
+    res = {}
+    for name, label, el_cond in scenarios:
+        banner('START')
+        print('Validating scenario: ', label)
+        with report.track(run_report, stage = label+' validation', input_size = len(ref_cdcr_nums)) as record:
+            el_cdcr_nums, res[label] = validation.validate(ref_cdcr_nums = ref_cdcr_nums,
+                                                           demographics = datasets['demographics'],
+                                                           sorting_criteria = datasets['sorting_criteria'],
+                                                           current_commits = datasets['current_commits'],
+                                                           prior_commits = datasets['prior_commits'],
+                                                           eligibility_conditions = el_cond,
+                                                           id_label = cfg['id_label'],
+                                                           pop_label = label,
+                                                           write_path = write_path)
+            record['output size'] = len(res[label])
+        banner('COMPLETE')
+
+    return res
+
+
+def run_bench(cfg,
+              n,
+              scenarios,
+              summaries = True):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    n : int
+        Number of individuals in the synthetic population
+    scenarios : list of tuples
+        Scenarios to run (see get_scenarios())
+    summaries : boolean, optional
+        Specify whether to also time the summaries
+        Default is True.
+
+    Returns
+    -------
+    run_report : list
+        Records of the run (see report.track())
+
+    """
+    import synthetic
+    import report
+    import shared
+
+    run_report = []
+    # Generate a synthetic population with the same columns as the raw data
+    with report.track(run_report, stage = 'synthetic data') as record:
+        data = synthetic.gen_data(n = n)
+        datasets = dict(zip(['sorting_criteria', 'demographics', 'merit_credit', 'milestone_credit', 'rehab_credit', 'voced_credit', 'rv_report', 'current_commits', 'prior_commits'], data))
+        record['output size'] = n
+
+    # Time the scenarios and summaries without writing any outputs (the synthetic data uses the 'CDCNo' ID column)
+    cfg = dict(cfg, id_label = 'CDCNo')
+    if not cfg['processes']:
+        el_cdcr_nums = run_eligibility(cfg, datasets, scenarios, run_report = run_report, to_excel = False)
+    else:
+        # Compare starting the worker processes with the prepared data pickled to every worker and mapped from a single export (see shared.py)
+        datasets = run_prepare(cfg, datasets, scenarios = scenarios, run_report = run_report)
+        # The comparison is a stage of its own, so that its rows are nested in it like the rules in their scenario (see report.funnel())
+        with report.track(run_report, stage = 'workers') as record:
+            results = shared.measure(datasets, max_workers = cfg['processes'])
+            record['output size'] = len(results)
+        for res in results:
+            run_report.append({'stage': 'workers',
+                               'rule id': res['mode'],
+                               'category': None,
+                               'input size': None,
+                               'output size': res['workers'],
+                               'wall time (s)': res['spin-up (s)'],
+                               'export (s)': res['export (s)'],
+                               'total rss (mb)': res['total rss (MB)'],
+                               'total pss (mb)': res['total pss (MB)']})
+        # Run the scenarios in the worker processes
+        shared.start(datasets, max_workers = cfg['processes'])
+        try:
+            el_cdcr_nums = run_eligibility(cfg, datasets, scenarios, run_report = run_report, to_excel = False, prepared = True)
+        finally:
+            shared.stop()
+    if summaries:
+        run_summary(cfg, datasets, el_cdcr_nums, run_report = run_report, to_excel = False)
+
+    return run_report
+
+
+def gen_parser():
+    """
+
+    Returns
+    -------
+    parser : argparse parser
+        Parser of the command line with one sub-command per pipeline stage
+
+    """
+    # Options shared by all the sub-commands
+    # Options that are not passed are left out of the parsed arguments, so that they can be passed before or after the sub-command
+    common = argparse.ArgumentParser(add_help = False, argument_default = argparse.SUPPRESS)
+    common.add_argument('--config', help = 'json file with settings (keys as in config.py), overrides config.py')
+    common.add_argument('--read-path', dest = 'read_data_path', help = 'Full path of the data (all parent folders)')
+    common.add_argument('--county', dest = 'county_name', help = "Name of the county folder, ex: 'Los Angeles'")
+    common.add_argument('--month', help = 'Sub-folder of the county folder with the data of a month')
+    common.add_argument('--id-label', dest = 'id_label', help = 'Name of the column with the CDCR IDs')
+    common.add_argument('--memory-budget', dest = 'memory_budget_mb', type = float, help = 'Memory budget in MB for the large stages')
+    common.add_argument('--cache', dest = 'cache_inputs', action = 'store_const', const = True, help = 'Reuse the pickled inputs of an earlier run for the input files that did not change')
+    common.add_argument('--workers', dest = 'max_workers', type = int, help = 'Maximum number of stages that run at the same time, ex: the scenarios once the data is prepared')
+    common.add_argument('--processes', type = int, help = 'Number of worker processes that run the scenarios. The prepared data is exported once and mapped read-only by every worker (see shared.py)')
+    common.add_argument('--engine', choices = ['pandas', 'sqlite', 'duckdb'], help = 'Engine that evaluates the rules (see database.py)')
+    common.add_argument('--skip-quality', dest = 'check_quality', action = 'store_const', const = False, help = 'Do not check the extracted data before the rules are applied (see quality.py)')
+    common.add_argument('--no-checkpoint', dest = 'checkpoint', action = 'store_const', const = False, help = 'Do not checkpoint the output of every stage')
+    common.add_argument('--sync-writes', dest = 'max_pending_writes', action = 'store_const', const = 0, help = 'Write the outputs immediately instead of in the background')
+    common.add_argument('--profile', action = 'store_const', const = True, help = 'Write cProfile profiles of the pipeline stages')
+    common.add_argument('--profile-memory', dest = 'profile_memory', action = 'store_const', const = True, help = 'Also record memory allocations of the profiled stages')
+    scenario = argparse.ArgumentParser(add_help = False)
+    scenario.add_argument('--scenario', action = 'append', choices = list(scenario_labels.keys())+['all'], help = 'Scenario to run (can be repeated). Default is all')
+    output = argparse.ArgumentParser(add_help = False)
+    output.add_argument('--resume', nargs = '?', const = True, help = 'Continue the most recent run of the month (or the run in the output folder that is passed) from its first incomplete stage')
+    output.add_argument('--no-excel', dest = 'to_excel', action = 'store_false', help = 'Do not write the outputs to Excel')
+    output.add_argument('--cohort-report', dest = 'cohort_report', action = 'store_true', help = 'Write the distributions of each eligible cohort side by side (see cohort.py)')
+    output.add_argument('--stream-summary', dest = 'summary_stream', choices = ['xlsx', 'jsonl', 'csv', 'parquet'], help = 'Write the summaries in batches to a file of this format instead of holding them in memory')
+    output.add_argument('--explain', action = 'store_true', help = 'Evaluate every rule on the entire population and write whether each individual meets each rule with the offending codes (see the why command)')
+    output.add_argument('--near-miss', dest = 'near_miss', type = float, metavar = 'MARGIN', help = 'Also identify the individuals who meet all the other rules and miss the numerical thresholds by less than this share of each threshold, ex: 0.1 (see config.near_miss)')
+    output.add_argument('--subcohorts', type = int, default = 0, help = 'Split each eligible cohort into this many sub-cohorts of similar individuals (see similarity.py)')
+
+    parser = argparse.ArgumentParser(description = 'Identify individuals eligible for resentencing', parents = [common])
+    sub = parser.add_subparsers(dest = 'command')
+    sub.add_parser('all', parents = [common, output], help = 'Extract the data, identify eligible individuals and summarize them (default)')
+    p = sub.add_parser('extract', parents = [common], help = 'Extract the datasets and store them as pickle files')
+    p = sub.add_parser('eligibility', parents = [common, scenario, output], help = 'Identify eligible individuals')
+    p = sub.add_parser('summary', parents = [common, scenario, output], help = 'Identify and summarize eligible individuals')
+    p = sub.add_parser('validate', parents = [common, scenario], help = 'Compare eligible individuals with an external list')
+    p.add_argument('--reference', required = True, help = 'Excel or csv file with externally identified eligible CDCR numbers')
+    p.add_argument('--column', required = True, help = 'Column of the reference file with the CDCR numbers')
+    p = sub.add_parser('why', parents = [common, scenario], help = 'Explain why a CDCR number is not eligible, using the explanations of an earlier run with --explain')
+    p.add_argument('cdcr_num', help = 'CDCR number to explain')
+    p.add_argument('--output', help = 'Output folder of the run with the explanations. Default is the most recent run of the month with explanations')
+    p = sub.add_parser('bench', parents = [common, scenario], help = 'Time the pipeline on a synthetic population')
+    p.add_argument('--n', type = int, default = 100000, help = 'Size of the synthetic population. Default is 100000')
+    p.add_argument('--no-summary', dest = 'summaries', action = 'store_false', help = 'Only time the scenarios')
+    p.add_argument('--write-path', help = 'Folder to write the run report (and profiles) to')
+    p = sub.add_parser('watch', parents = [common, scenario, output], help = 'Run the pipeline whenever a complete month folder lands in the county folder')
+    p.add_argument('--interval', type = float, default = 30, help = 'Seconds between two scans of the county folder. Default is 30')
+    p.add_argument('--settle', type = float, default = 120, help = 'Seconds without changes to the files of a month before it is run. Default is 120')
+    p.add_argument('--polls', type = int, help = 'Number of scans after which the watcher stops. Default is to watch until interrupted')
+
+    return parser
+
+
+def main(argv = None):
+    """
+
+    Parameters
+    ----------
+    argv : list, optional
+        Command line arguments
+        Default is None, i.e. sys.argv.
+
+    Returns
+    -------
+    None.
+
+    """
+    args = gen_parser().parse_args(argv)
+    command = args.command or 'all'
+    cfg = load_config(args)
+
+    import profiling
+    import report
+
+    # The benchmark runs on synthetic data, so it does not need the data folders
+    if command == 'bench':
+        write_path = args.write_path or os.getcwd()+'/bench'
+        profiling.install(write_path = write_path, flag = cfg['profile'], memory = cfg['profile_memory'])
+        start = time.perf_counter()
+        run_report = run_bench(cfg, n = args.n, scenarios = get_scenarios(args.scenario), summaries = args.summaries)
+        print('Benchmark of', args.n, 'individuals completed in', round(time.perf_counter() - start, 2), 's')
+        if args.write_path:
+            report.write_report(run_report, write_path = write_path)
+        else:
+            print(report.funnel(run_report)[['stage', 'rule id', 'input size', 'output size', 'wall time (s)', 'cpu time (s)', 'peak memory delta (mb)']].to_string(index = False))
+        return
+
+    # Explain the eligibility of a CDCR number from the outputs of an earlier run
+    if command == 'why':
+        run_why(cfg, args)
+        return
+
+    # Run the pipeline for every new month folder of the county, reusing the inputs that did not change
+    if command == 'watch':
+        import watcher
+        watcher.watch(read_path = cfg['read_data_path'], 
+                      county_name = cfg['county_name'], 
+                      run = lambda month: run_pipeline(dict(cfg, month = month, cache_inputs = True), args, command = 'all', profile = False), 
+                      interval = args.interval, 
+                      settle = args.settle, 
+                      polls = getattr(args, 'polls', None))
+        return
+
+    run_pipeline(cfg, args, command = command)
+
+
+def run_pipeline(cfg,
+                 args,
+                 command,
+                 profile = True):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    args : argparse namespace
+        Parsed command line arguments
+    command : str
+        Subcommand, ex: 'all' or 'validate'
+    profile : boolean, optional
+        Specify whether to wrap the pipeline stages with profilers if requested. The watcher runs the pipeline several times in one process, so it does not wrap them
+        Default is True.
+
+    Returns
+    -------
+    None.
+
+    """
+    import profiling
+    import report
+    import writer
+    import checkpoint
+    import shared
+
+    write_path = get_write_path(cfg)
+    # Continue the most recent run of the month (--resume) or the run in the folder that is passed (--resume PATH)
+    resume = getattr(args, 'resume', None)
+    if resume is True:
+        write_path = checkpoint.find_latest(os.path.dirname(write_path)) or write_path
+    elif resume:
+        write_path = resume
+    # Wrap the pipeline stages with profilers if requested (--profile, config.profile or the THREE_STRIKES_PROFILE environment variable)
+    if profile:
+        profiling.install(write_path = write_path, flag = cfg['profile'], memory = cfg['profile_memory'])
+
+    # Initialize the records of the run (timings and cohort sizes of every stage and rule)
+    run_report = []
+    # Write the outputs in the background while the next stage runs
+    if cfg['max_pending_writes']:
+        writer.start(max_pending = cfg['max_pending_writes'])
+    # Checkpoint the output of every stage to the checkpoint sub-folder of the outputs
+    if cfg['checkpoint'] or resume:
+        checkpoint.start(write_path, 
+                         inputs = checkpoint.get_inputs(cfg['read_data_path'], cfg['county_name'], cfg['month'], settings = {'id_label': cfg['id_label']}), 
+                         resume = bool(resume))
+    try:
+        run_stages(cfg, args, command, run_report = run_report, write_path = write_path)
+    finally:
+        # Wait for the outputs that are still being written (the checkpoints are saved after the outputs of their stage). Errors of the background writes are raised here
+        try:
+            writer.stop(run_report)
+        finally:
+            try:
+                checkpoint.stop()
+            finally:
+                shared.stop()
+
+    # Write the run report (timings and cohort sizes of every stage and rule) next to the Excel outputs
+    report.write_report(run_report, write_path = write_path)
+
+
+def run_stages(cfg, 
+               args, 
+               command, 
+               run_report, 
+               write_path):
+    """
+
+    Parameters
+    ----------
+    cfg : dict
+        Settings of the run (see load_config())
+    args : argparse namespace
+        Parsed command line arguments
+    command : str
+        Subcommand, ex: 'all' or 'validate'
+    run_report : list
+        Records of the run (see report.track())
+    write_path : str
+        Full path of the folder where the outputs are written
+
+    Returns
+    -------
+    None.
+
+    """
+    import checkpoint
+    import shared
+    import dag
+
+    # Stages of the pipeline with the stages they take as inputs. Stages whose inputs are ready run at the same time (see dag.py)
+    # Every stage is loaded from its checkpoint if it was completed by the run that is resumed (see checkpoint.py)
+    # Only the columns that the stages of the run read are extracted (the key makes a resumed run extract again if they changed)
+    usecols = get_usecols(cfg, command, args)
+    stages = {'extract': (lambda: checkpoint.run('extract', lambda: run_extract(cfg, run_report = run_report, pickle = command == 'extract', usecols = usecols), key = checkpoint.get_key(usecols)), [])}
+    # Check the extracted data before any rule is applied (the later stages take the checked datasets)
+    source = 'extract'
+    if cfg['check_quality'] and command != 'extract':
+        stages['quality'] = (lambda datasets: run_quality(cfg, datasets, usecols = usecols, run_report = run_report, write_path = write_path), ['extract'])
+        source = 'quality'
+
+    if command == 'validate':
+        stages['validate'] = (lambda datasets: run_validate(cfg, datasets, get_scenarios(args.scenario), reference = args.reference, column = args.column, run_report = run_report, write_path = write_path), [source])
+    elif command in ['all', 'eligibility', 'summary']:
+        to_excel = getattr(args, 'to_excel', True)
+        scenarios = get_scenarios(getattr(args, 'scenario', None))
+        labels = [label for name, label, el_cond in scenarios]
+        # Prepare the data once for all the scenarios (the key makes a resumed run prepare again if the extracted columns changed)
+        stages['prepare'] = (lambda datasets: checkpoint.run('prepare', lambda: run_prepare(cfg, datasets, scenarios = scenarios, run_report = run_report), key = checkpoint.get_key(usecols, [el_cond for name, label, el_cond in scenarios])), [source])
+        # Export the prepared data once for the worker processes that run the scenarios
+        if cfg['processes']:
+            stages['share'] = (lambda datasets: shared.start(datasets, max_workers = cfg['processes']), ['prepare'])
+        for name, label, el_cond in scenarios:
+            # Scenarios only depend on the prepared data and each summary only on its scenario
+            stages[label] = (lambda datasets, *share, label = label, el_cond = el_cond: run_scenario(cfg, datasets, label, el_cond, run_report = run_report, to_excel = to_excel, write_path = write_path, prepared = True, explain = getattr(args, 'explain', False)), ['prepare']+(['share'] if cfg['processes'] else []))
+            if command in ['all', 'summary']:
+                stages[label+' summary'] = (lambda datasets, cdcr_nums, label = label: run_cohort_summary(cfg, datasets, label, cdcr_nums, run_report = run_report, to_excel = to_excel, write_path = write_path), ['prepare', label])
+            # Split the eligible cohort into sub-cohorts of similar individuals
+            if getattr(args, 'subcohorts', 0):
+                import similarity
+                stages[label+' subcohorts'] = (lambda datasets, cdcr_nums, label = label: similarity.gen_subcohorts(cdcr_nums, 
+                                                                                                                    demographics = datasets['demographics'], 
+                                                                                                                    current_commits = datasets['current_commits'], 
+                                                                                                                    prior_commits = datasets['prior_commits'], 
+                                                                                                                    id_label = cfg['id_label'], 
+                                                                                                                    n_clusters = args.subcohorts, 
+                                                                                                                    write_path = write_path, 
+                                                                                                                    pop_label = label, 
+                                                                                                                    run_report = run_report), ['prepare', label])
+        # Profile the eligible cohorts side by side
+        if getattr(args, 'cohort_report', False):
+            import cohort
+            stages['cohort report'] = (lambda datasets, *cdcr_nums: cohort.gen_profiles(dict(zip(labels, cdcr_nums)), 
+                                                                                         demographics = datasets['demographics'], 
+                                                                                         current_commits = datasets['current_commits'], 
+                                                                                         id_label = cfg['id_label'], 
+                                                                                         write_path = write_path, 
+                                                                                         run_report = run_report), ['prepare']+labels)
+
+    dag.run(stages, max_workers = cfg['max_workers'], run_report = run_report)
+
+if __name__ == '__main__':
+    main()
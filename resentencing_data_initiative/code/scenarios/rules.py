@@ -20,3 +20,20 @@ cat = {'age related': [r_1, r_6],
        'prior offenses related': [r_5, r_8],
        'controlling offense related': [r_10], 
        'enhancement related': [r_11]}
+
+# Numerical conditions of the rules, i.e. the variable in the demographics data, the comparison and the default threshold
+# A scenario can override the thresholds of a rule by passing 'thresholds' (one value per condition) in el_cond, ex: 'r_1': {'use': True, 'thresholds': [55], ...}
+num = {'r_1': [{'variable': 'age in years', 'operator': '>=', 'threshold': 50}],
+       'r_2': [{'variable': 'aggregate sentence in years', 'operator': '>=', 'threshold': 20}],
+       'r_3': [{'variable': 'time served in years', 'operator': '>=', 'threshold': 10}],
+       'r_6': [{'variable': 'age during offense', 'operator': '>=', 'threshold': 14}, 
+               {'variable': 'age during offense', 'operator': '<', 'threshold': 16}],
+       'r_13': [{'variable': 'time served in years', 'operator': '>=', 'threshold': 15}]}
+
+# Time variables that increase by one every year (used to estimate when an individual will meet a threshold)
+increasing = ['age in years', 'time served in years']
+
+# Code patterns of the enhancement rules, i.e. individuals with a current offense or enhancement that matches any of the patterns do not meet the rule
+# Patterns are matched against the cleaned codes as substrings ('contains'), prefixes ('prefix') or regular expressions ('regex')
+# A scenario can override the patterns of a rule by passing 'patterns' in el_cond, ex: 'r_11': {'use': True, 'patterns': {'contains': ['12022', '667.5']}, ...}
+enh = {'r_11': {'contains': ['12022']}}
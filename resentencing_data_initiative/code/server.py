@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import eligibility
+import store
+import config
+from scenarios import adult
+from scenarios import juvenile
+from scenarios import robbery
+from scenarios import rules
+import scenarios.utils
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from collections import OrderedDict
+import threading
+import argparse
+import json
+import copy
+import re
+import time
+import numpy as np
+
+
+# Built-in scenarios that requests can start from
+scenario_conds = {'adult': adult.el_cond,
+                  'juvenile': juvenile.el_cond,
+                  'robbery': robbery.el_cond}
+
+# Prepared datasets held in memory for the lifetime of the server
+data = {}
+# Results of recent scenarios as boolean arrays over the demographics (least recently used first, see store.gen_mask()) and the lock that guards them
+cache = OrderedDict()
+cache_lock = threading.Lock()
+cache_size = 128
+
+
+def load(read_path = None,
+         month = None,
+         county_name = None,
+         id_label = config.id_label,
+         synthetic_n = None):
+    """
+
+    Parameters
+    ----------
+    read_path : str, optional
+        Full path of the data (all parent folders)
+        Default is None.
+    month : str, optional
+        Year and month for which data should be extracted, ex: '2023_06'
+        Default is None.
+    county_name : str, optional
+        Name of the county folder to extract data for, ex: 'Los Angeles County'
+        Default is None.
+    id_label : str, optional
+        Name of the column with the CDCR IDs
+        Default is config.id_label.
+    synthetic_n : int, optional
+        If passed, a synthetic population of this size is used instead of the files (see synthetic.gen_data())
+        Default is None.
+
+    Returns
+    -------
+    data : dict
+        Prepared datasets, i.e. demographics with time variables and commitments with cleaned and indexed offenses
+
+    """
+    # Extract the datasets once
+    if synthetic_n:
+        import synthetic
+        datasets = synthetic.gen_data(synthetic_n)
+    else:
+        import extract
+        # Only the columns that the rules read are extracted (any rule can be used by a request)
+        usecols = eligibility.gen_requirements({rule: {'use': True} for rule in eligibility.el_rules.keys()}, id_label, extracted = True)
+        usecols['sorting_criteria'] = None
+        datasets = extract.get_input(read_path = read_path, month = month, county_name = county_name, usecols = usecols)
+    sorting_criteria, demographics, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report, current_commits, prior_commits = datasets
+
+    # Clean the data and add the time variables once
+    demographics, errors = eligibility.prep_data(demographics = demographics,
+                                                 current_commits = current_commits,
+                                                 prior_commits = prior_commits,
+                                                 id_label = id_label)
+
+    # Index the cleaned offenses, i.e. store each code once and search the integer codes instead of the strings
+    for df, cols in [(current_commits, ['offense cleaned', 'off_enh1 cleaned', 'off_enh2 cleaned', 'off_enh3 cleaned', 'off_enh4 cleaned']),
+                     (prior_commits, ['offense cleaned']),
+                     (demographics, ['controlling offense cleaned'])]:
+        for col in cols:
+            df[col] = df[col].astype('category')
+
+    data.update({'sorting_criteria': sorting_criteria,
+                 'demographics': demographics,
+                 'current_commits': current_commits,
+                 'prior_commits': prior_commits,
+                 'id_label': id_label,
+                 'cdcr_nums': demographics.index.tolist()})
+    with cache_lock:
+        cache.clear()
+
+    print('Datasets loaded and prepared for', len(data['cdcr_nums']), 'CDCR numbers')
+    return data
+
+
+def gen_conditions(payload):
+    """
+
+    Parameters
+    ----------
+    payload : dict
+        Scenario definition with the same shape as el_cond in the scenario files
+        Can also start from a built-in scenario and change some rules, ex: {'scenario': 'robbery', 'conditions': {'r_11': {'use': False}}}
+
+    Returns
+    -------
+    el_cond : dict
+        Complete scenario definition, i.e. every rule has 'use', 'desc' and 'category' values
+
+    """
+    # The scenario definition must be a JSON object
+    if not isinstance(payload, dict):
+        raise ValueError('Request body must be a JSON object, ex: {"scenario": "robbery"}')
+    if not isinstance(payload.get('conditions', {}), dict):
+        raise ValueError('conditions must be a JSON object')
+
+    # Start from a built-in scenario if one is named
+    base = payload.get('scenario')
+    if base and base not in scenario_conds:
+        raise ValueError('Scenario '+str(base)+' is not available. Available scenarios are: '+', '.join(scenario_conds.keys()))
+    el_cond = copy.deepcopy(scenario_conds[base]) if base else {'population': 'custom', 'lenience': 'custom', 'offense type': 'all'}
+
+    # Apply the conditions passed in the request
+    conditions = payload.get('conditions', {k: v for k, v in payload.items() if k not in ['scenario', 'counts_only']})
+    for key, val in conditions.items():
+        if (key in eligibility.el_rules) and isinstance(val, dict):
+            el_cond.setdefault(key, {}).update(val)
+        else:
+            el_cond[key] = val
+
+    # Rules that are not specified are not used, and descriptions and categories are taken from the rules file
+    for rule in eligibility.el_rules.keys():
+        el_cond.setdefault(rule, {'use': False})
+        el_cond[rule].setdefault('use', False)
+        el_cond[rule].setdefault('desc', getattr(rules, rule))
+        el_cond[rule].setdefault('category', scenarios.utils.dict_search(rules.cat, getattr(rules, rule)))
+
+    return el_cond
+
+
+def evaluate(payload):
+    """
+
+    Parameters
+    ----------
+    payload : dict
+        Scenario definition (see gen_conditions())
+
+    Returns
+    -------
+    res : dict
+        Population label, count and list of eligible CDCR numbers, evaluation time in milliseconds and whether the result was cached
+
+    """
+    start = time.perf_counter()
+    el_cond = gen_conditions(payload)
+    key = json.dumps(el_cond, sort_keys = True, default = str)
+
+    # Return the result of a recent identical scenario
+    with cache_lock:
+        cached = key in cache
+        if cached:
+            cache.move_to_end(key)
+            el_mask = cache[key]
+
+    if not cached:
+        # Datasets are only read, so requests can be evaluated concurrently
+        el_mask = eligibility.apply_rules(demographics = data['demographics'],
+                                          sorting_criteria = data['sorting_criteria'],
+                                          current_commits = data['current_commits'],
+                                          prior_commits = data['prior_commits'],
+                                          eligibility_conditions = el_cond,
+                                          id_label = data['id_label'],
+                                          as_mask = True)
+        with cache_lock:
+            cache[key] = el_mask
+            # Evict the least recently used results
+            while len(cache) > cache_size:
+                cache.popitem(last = False)
+
+    res = {'population': el_cond['population'],
+           'count': np.count_nonzero(el_mask),
+           'elapsed (ms)': round(1000*(time.perf_counter() - start), 2),
+           'cached': cached}
+    if not payload.get('counts_only'):
+        res['cdcr_nums'] = store.get_ids(data['demographics'], el_mask)
+    return res
+
+
+class Handler(BaseHTTPRequestHandler):
+    """
+    Handles GET /health, GET /scenarios and POST /eligibility
+    """
+    def send_json(self, code, body):
+        out = json.dumps(body, default = str).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, {'status': 'ok', 'population': len(data.get('cdcr_nums', [])), 'cached scenarios': len(cache)})
+        elif self.path == '/scenarios':
+            self.send_json(200, scenario_conds)
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path != '/eligibility':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            self.send_json(200, evaluate(payload))
+        except (ValueError, KeyError, TypeError, re.error) as e:
+            # Invalid scenario definitions, ex: an unknown scenario or an invalid pattern
+            self.send_json(400, {'error': str(e)})
+        except Exception as e:
+            # Every request gets a response, even if the scenario could not be evaluated
+            self.send_json(500, {'error': type(e).__name__+': '+str(e)})
+
+
+def serve(host = '127.0.0.1',
+          port = 8050):
+    """
+
+    Parameters
+    ----------
+    host : str, optional
+        Address to listen on. The default only accepts requests from the same machine
+        Default is '127.0.0.1'.
+    port : int, optional
+        Port to listen on
+        Default is 8050.
+
+    Returns
+    -------
+    None.
+
+    """
+    server = ThreadingHTTPServer((host, port), Handler)
+    print('Serving eligibility requests on http://'+host+':'+str(port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Serve what-if eligibility scenarios on a population held in memory')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8050)
+    parser.add_argument('--cache-size', type = int, default = cache_size, help = 'Number of recent scenario results to keep')
+    parser.add_argument('--synthetic', type = int, default = None, help = 'Serve a synthetic population of this size instead of the data in config.py')
+    args = parser.parse_args()
+
+    cache_size = args.cache_size
+    load(read_path = config.read_data_path,
+         month = config.month,
+         county_name = config.county_name,
+         id_label = config.id_label,
+         synthetic_n = args.synthetic)
+    serve(host = args.host, port = args.port)
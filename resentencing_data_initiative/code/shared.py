@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import pickle
+import shutil
+import tempfile
+import time
+import os
+
+
+# Datasets that the scenarios read once the data is prepared (see run.run_prepare())
+names = ['sorting_criteria', 'demographics', 'current_commits', 'prior_commits']
+
+# Worker processes that run the scenarios on the shared datasets (None means the scenarios run in the main process)
+pool = None
+# Folder of the exported datasets that the workers map, and whether it is removed when the pool is stopped
+folder = None
+remove = False
+# Datasets mapped by this process (set in the worker processes, see attach()) and the time they were ready
+datasets = None
+ready_time = None
+
+
+def export(datasets,
+           write_path,
+           names = names):
+    """
+
+    Parameters
+    ----------
+    datasets : dict
+        Datasets by name, ex: the prepared datasets (see run.run_prepare())
+    write_path : str
+        Full path of the folder where the datasets are exported
+    names : list, optional
+        Names of the datasets to export. Datasets that are None are skipped
+        Default is the datasets that the scenarios read.
+
+    Returns
+    -------
+    write_path : str
+        Full path of the folder with the exported datasets (see load())
+
+    """
+    os.makedirs(write_path, exist_ok = True)
+    meta = {}
+    for name in names:
+        df = datasets.get(name)
+        if df is None:
+            continue
+        # Every column (and every level of the index) is saved to its own .npy file, which can be mapped without reading it
+        # Columns of Python objects, ex: strings, cannot be mapped, so their values are replaced by codes into the list of their unique values
+        # The codes of object columns are saved with the integer type that pandas uses for that many categories, so that load() can wrap them without copying them
+        cols = [('index', i, df.index.get_level_values(i)) for i in range(df.index.nlevels)]+[('column', i, df.iloc[:, i]) for i in range(df.shape[1])]
+        info = []
+        for kind, i, values in cols:
+            file_name = name+'_'+kind+'_'+str(i)+'.npy'
+            dtype = values.dtype
+            if isinstance(dtype, np.dtype) and dtype.kind in 'biufmM':
+                np.save(os.path.join(write_path, file_name), np.asarray(values))
+                uniques = None
+            elif dtype == object:
+                # Missing values have the code -1
+                codes, uniques = pd.factorize(np.asarray(values, dtype = object))
+                np.save(os.path.join(write_path, file_name), codes.astype(get_code_type(len(uniques))))
+            else:
+                codes, uniques = pd.factorize(np.asarray(values, dtype = object), use_na_sentinel = False)
+                np.save(os.path.join(write_path, file_name), codes.astype(np.int32))
+            info.append({'kind': kind, 'name': values.name, 'file': file_name, 'dtype': dtype, 'uniques': uniques})
+        meta[name] = info
+
+    with open(os.path.join(write_path, 'meta.pkl'), 'wb') as f:
+        pickle.dump(meta, f)
+    return write_path
+
+
+def get_code_type(n):
+    """
+
+    Parameters
+    ----------
+    n : int
+        Number of unique values of a column
+
+    Returns
+    -------
+    numpy dtype
+        Smallest integer type that pandas uses for the codes of a categorical with n categories
+
+    """
+    for dtype in [np.int8, np.int16, np.int32]:
+        if n < np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def load(read_path):
+    """
+
+    Parameters
+    ----------
+    read_path : str
+        Full path of the folder with the exported datasets (see export())
+
+    Returns
+    -------
+    datasets : dict
+        Datasets by name. Numeric, boolean and date columns are mapped read-only from the exported files, so they are not copied into the memory of the process and are shared by all the processes that load them
+        Columns of Python objects, ex: the CDCR IDs and the offenses, are loaded as categoricals over their mapped codes, so they are shared as well (only their unique values are loaded by every process)
+
+    """
+    with open(os.path.join(read_path, 'meta.pkl'), 'rb') as f:
+        meta = pickle.load(f)
+
+    datasets = {}
+    for name, info in meta.items():
+        index = []
+        columns = {}
+        for col in info:
+            values = np.load(os.path.join(read_path, col['file']), mmap_mode = 'r').view(np.ndarray)
+            if col['dtype'] == object:
+                values = pd.Categorical.from_codes(values, categories = col['uniques'])
+            elif col['uniques'] is not None:
+                values = col['uniques'].take(values)
+                if col['dtype'] != object:
+                    values = pd.array(values, dtype = col['dtype'])
+            if col['kind'] == 'index':
+                index.append((col['name'], values))
+            else:
+                columns[col['name']] = values
+        # The arrays are wrapped without copying them
+        if len(index) == 1:
+            index = pd.Index(index[0][1], name = index[0][0], copy = False)
+        else:
+            index = pd.MultiIndex.from_arrays([values for label, values in index], names = [label for label, values in index])
+        datasets[name] = pd.DataFrame(columns, index = index, columns = pd.Index([col['name'] for col in info if col['kind'] == 'column']), copy = False)
+
+    return datasets
+
+
+def attach(read_path):
+    """
+
+    Parameters
+    ----------
+    read_path : str
+        Full path of the folder with the exported datasets (see export())
+
+    Returns
+    -------
+    None.
+        Loads the datasets in the calling process (see load()). Called once by every worker process when it starts
+
+    """
+    global datasets, ready_time
+    datasets = load(read_path)
+    ready_time = time.time()
+
+
+def receive(data):
+    """
+
+    Parameters
+    ----------
+    data : dict
+        Datasets by name, pickled by the main process and sent to the worker process when it starts
+
+    Returns
+    -------
+    None.
+        Keeps the datasets in the calling process (the alternative to attach() that measure() compares it with)
+
+    """
+    global datasets, ready_time
+    datasets = data
+    ready_time = time.time()
+
+
+def get_memory():
+    """
+
+    Returns
+    -------
+    dict
+        Resident set size (RSS) and proportional set size (PSS) of the calling process in MB
+        The PSS splits the pages that are shared between processes among them, so the PSS of several processes can be added up. It is None on platforms without /proc
+
+    """
+    import report
+
+    memory = {'rss (MB)': report.rss(), 'pss (MB)': None}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                if line.startswith('Pss:'):
+                    memory['pss (MB)'] = int(line.split()[1])/1024
+    except OSError:
+        pass
+    return memory
+
+
+def start(data,
+          max_workers = 2,
+          write_path = None):
+    """
+
+    Parameters
+    ----------
+    data : dict
+        Prepared datasets by name (see run.run_prepare())
+    max_workers : int, optional
+        Number of worker processes
+        Default is 2.
+    write_path : str, optional
+        Full path of the folder where the datasets are exported
+        Default is None, i.e. a temporary folder that is removed when the pool is stopped.
+
+    Returns
+    -------
+    None.
+        The datasets are exported once and every worker maps them when it starts (see attach()). Workers are started rather than forked, so that they behave the same on every platform
+
+    """
+    global pool, folder, remove
+    if pool is not None:
+        return
+    remove = write_path is None
+    folder = export(data, write_path or tempfile.mkdtemp(prefix = 'shared_'))
+    pool = ProcessPoolExecutor(max_workers = max_workers,
+                               mp_context = multiprocessing.get_context('spawn'),
+                               initializer = attach,
+                               initargs = (folder,))
+
+
+def stop():
+    """
+
+    Returns
+    -------
+    None.
+        Waits for the worker processes to finish and removes the exported datasets if they were written to a temporary folder
+
+    """
+    global pool, folder
+    if pool is None:
+        return
+    try:
+        pool.shutdown(wait = True)
+    finally:
+        if remove:
+            shutil.rmtree(folder, ignore_errors = True)
+        pool = None
+        folder = None
+
+
+def run_eligibility(**kwargs):
+    """
+
+    Parameters
+    ----------
+    **kwargs
+        Arguments of eligibility.gen_eligibility() other than the datasets and the run report
+
+    Returns
+    -------
+    errors : list
+        Errors of the scenario (see eligibility.gen_eligibility())
+    cdcr_nums : list
+        Eligible CDCR numbers of the scenario
+    run_report : list
+        Records of the scenario (see report.track()), to be added to the records of the main process
+
+    """
+    import eligibility
+
+    # Runs in a worker process, on the datasets it mapped when it started
+    run_report = []
+    # The near misses are also returned if a margin is passed (they are written by the worker with the eligible individuals)
+    res = eligibility.gen_eligibility(demographics = datasets['demographics'],
+                                      sorting_criteria = datasets['sorting_criteria'],
+                                      current_commits = datasets['current_commits'],
+                                      prior_commits = datasets['prior_commits'],
+                                      run_report = run_report,
+                                      **kwargs)
+    return res[0], res[1], run_report
+
+
+def probe(delay = 0.2):
+    """
+
+    Parameters
+    ----------
+    delay : float, optional
+        Seconds to wait before returning, so that the tasks of measure() are spread over all the workers
+        Default is 0.2.
+
+    Returns
+    -------
+    dict
+        Process ID, time the datasets were ready and memory of the calling worker process, after reading every column once
+
+    """
+    # Read every column, so that the pages of the mapped columns are loaded
+    for df in datasets.values():
+        for i in range(df.shape[1]):
+            df.iloc[:, i].isna().sum()
+    time.sleep(delay)
+    return dict({'pid': os.getpid(), 'ready': ready_time}, **get_memory())
+
+
+def measure(data,
+            max_workers = 2,
+            write_path = None):
+    """
+
+    Parameters
+    ----------
+    data : dict
+        Prepared datasets by name (see run.run_prepare())
+    max_workers : int, optional
+        Number of worker processes
+        Default is 2.
+    write_path : str, optional
+        Full path of the folder where the datasets are exported
+        Default is None, i.e. a temporary folder that is removed afterwards.
+
+    Returns
+    -------
+    results : list
+        Spin-up time (until every worker has the datasets) and total memory of the workers when the datasets are pickled to every worker and when they are mapped from the exported files
+
+    """
+    data = {name: data[name] for name in names if data.get(name) is not None}
+    tmp = write_path is None
+    write_path = write_path or tempfile.mkdtemp(prefix = 'shared_')
+    results = []
+    try:
+        for mode in ['pickle', 'map']:
+            # The datasets are exported once before the workers are started (the export is timed separately)
+            export_time = None
+            if mode == 'map':
+                t = time.time()
+                export(data, write_path)
+                export_time = round(time.time() - t, 3)
+                initializer, initargs = attach, (write_path,)
+            else:
+                initializer, initargs = receive, (data,)
+            start_time = time.time()
+            with ProcessPoolExecutor(max_workers = max_workers, mp_context = multiprocessing.get_context('spawn'), initializer = initializer, initargs = initargs) as executor:
+                # One task per worker (the workers are started as the tasks are submitted)
+                workers = {}
+                for attempt in range(5):
+                    for res in executor.map(probe, [0.2]*max_workers):
+                        workers[res['pid']] = res
+                    if len(workers) >= max_workers:
+                        break
+            workers = list(workers.values())
+            results.append({'mode': mode,
+                            'workers': len(workers),
+                            'export (s)': export_time,
+                            'spin-up (s)': round(max(res['ready'] for res in workers) - start_time, 3),
+                            'total rss (MB)': round(sum(res['rss (MB)'] or 0 for res in workers), 1),
+                            'total pss (MB)': round(sum(res['pss (MB)'] or 0 for res in workers), 1) if all(res['pss (MB)'] is not None for res in workers) else None})
+            print('Workers with '+('pickled' if mode == 'pickle' else 'mapped')+' datasets:', results[-1])
+    finally:
+        if tmp:
+            shutil.rmtree(write_path, ignore_errors = True)
+
+    return results
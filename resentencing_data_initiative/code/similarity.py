@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+import helpers
+import utils
+import store
+import report
+import pandas as pd
+import numpy as np
+import os
+
+try:
+    from scipy import sparse
+except ImportError:
+    # Dense matrices are used instead, which is slower for large cohorts
+    sparse = None
+
+
+# Categorical columns of the demographics data that are encoded
+cat_cols = ['sentencing county', 'ethnicity']
+# Bins (in years) of the time variables that are encoded
+bins = {'age in years': [0, 18, 26, 36, 46, 56, 66, 76, 120],
+        'aggregate sentence in years': [0, 5, 10, 15, 20, 25, 30, 40, 50, 1000],
+        'time served in years': [0, 5, 10, 15, 20, 25, 30, 40, 100]}
+# Columns of the current commitments with enhancements
+enh_cols = ['off_enh1', 'off_enh2', 'off_enh3', 'off_enh4']
+
+
+def gen_tokens(data,
+               id_label,
+               col,
+               prefix):
+    """
+
+    Parameters
+    ----------
+    data : pandas dataframe
+        Data wherein each row pertains to a single value (ex: offense) of a CDCR number
+    id_label : str
+        Name of the column with the CDCR IDs
+    col : str
+        Name of the column with the values to encode
+    prefix : str
+        Name of the feature, ex: 'current offense'
+
+    Returns
+    -------
+    pandas dataframe
+        CDCR number and feature ('prefix: value') of every non-empty value
+
+    """
+    vals = utils.clean_series(data[col].astype(str))
+    sel = (vals != '') & (vals != 'nan')
+    return pd.DataFrame({id_label: data[id_label].values[sel.values], 'token': (prefix+': '+vals[sel]).values})
+
+
+def gen_section_tokens(data,
+                       id_label,
+                       col,
+                       prefix):
+    """
+
+    Parameters
+    ----------
+    data : pandas dataframe
+        Data wherein each row pertains to a single offense of a CDCR number
+    id_label : str
+        Name of the column with the CDCR IDs
+    col : str
+        Name of the column with the raw offense codes, ex: 'offense'
+    prefix : str
+        Name of the feature, ex: 'current section'
+
+    Returns
+    -------
+    pandas dataframe
+        CDCR number and code section ('prefix: 211') of every offense, so that related offenses (ex: PC211, PC211 2nd and PC664/211) are similar
+        Sections are the numbers with at least 3 digits in the code, i.e. subdivisions like (a)(1) are ignored
+
+    """
+    # Each distinct code is parsed once
+    codes = data[col].astype(str)
+    uniq = pd.Series(codes.unique())
+    sections = pd.Series(uniq.str.findall(r'\d{3,}').values, index = uniq.values)
+    df = pd.DataFrame({id_label: data[id_label].values, 'token': codes.map(sections).values}).explode('token').dropna()
+    df['token'] = prefix+': '+df['token']
+    return df
+
+
+def encode(el_cdcr_nums,
+           demographics,
+           current_commits,
+           prior_commits,
+           id_label,
+           idf = True):
+    """
+
+    Parameters
+    ----------
+    el_cdcr_nums : list
+        CDCR numbers of the eligible population
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated (with cleaned column names)
+    current_commits : pandas dataframe
+        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense (with cleaned column names)
+    prior_commits : pandas dataframe
+        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense (with cleaned column names)
+    id_label : str
+        Name of the column with the CDCR IDs
+    idf : boolean, optional
+        Specify whether to weigh features by their inverse frequency, so that rare offenses count more than common values like the county
+        Default is True.
+
+    Returns
+    -------
+    X : scipy sparse matrix or numpy array
+        One row per CDCR number with one column per feature (offense codes and sections of current and prior commitments, enhancements, county, ethnicity and binned time variables). Rows have unit length, so X @ X.T is the cosine similarity
+        A numpy array is returned if scipy is not installed
+    cdcr_nums : pandas index
+        CDCR number of each row
+    features : pandas index
+        Name of each column, ex: 'current offense: 211'
+
+    """
+    id_label = utils.clean(id_label)
+    cohort = store.take(store.gen_store(demographics, id_label, verbose = False), el_cdcr_nums)
+    cdcr_nums = cohort.index
+    sel = set(cdcr_nums)
+    current = current_commits[current_commits[id_label].isin(sel)]
+    prior = prior_commits[prior_commits[id_label].isin(sel)]
+
+    # Add the time variables if they are missing
+    if not all(col in cohort.columns for col in bins.keys()):
+        cohort, errors = helpers.gen_time_vars(df = cohort, id_label = id_label, merge = True)
+
+    # Features of every CDCR number as (CDCR number, feature) pairs
+    tokens = [gen_tokens(current, id_label, 'offense', 'current offense'),
+              gen_section_tokens(current, id_label, 'offense', 'current section'),
+              gen_tokens(prior, id_label, 'offense', 'prior offense'),
+              gen_section_tokens(prior, id_label, 'offense', 'prior section')]
+    tokens += [gen_tokens(current, id_label, col, 'enhancement') for col in enh_cols if col in current.columns]
+    tokens += [gen_tokens(cohort, id_label, col, col) for col in cat_cols if col in cohort.columns]
+    for col, edges in bins.items():
+        binned = pd.DataFrame({id_label: cohort[id_label].values, 'binned': pd.cut(cohort[col], bins = edges, right = False).astype(str).values})
+        tokens.append(gen_tokens(binned, id_label, 'binned', col))
+    tokens = pd.concat(tokens, ignore_index = True).drop_duplicates()
+
+    # Row and column of every feature
+    rows = cdcr_nums.get_indexer(tokens[id_label])
+    cols, features = pd.factorize(tokens['token'])
+    n, d = len(cdcr_nums), len(features)
+
+    # Inverse frequency of each feature
+    if idf:
+        weights = (np.log((1 + n)/(1 + np.bincount(cols, minlength = d))) + 1).astype(np.float32)
+    else:
+        weights = np.ones(d, dtype = np.float32)
+    vals = weights[cols]
+
+    # Normalize the rows to unit length
+    norms = np.sqrt(np.bincount(rows, weights = vals**2, minlength = n))
+    norms[norms == 0] = 1
+    vals = (vals/norms[rows]).astype(np.float32)
+
+    if sparse is not None:
+        X = sparse.csr_matrix((vals, (rows, cols)), shape = (n, d))
+    else:
+        X = np.zeros((n, d), dtype = np.float32)
+        X[rows, cols] = vals
+
+    return X, cdcr_nums, features
+
+
+def gen_neighbours(X,
+                   cdcr_nums,
+                   k = 10,
+                   block_size = 500,
+                   dense_share = 0.01):
+    """
+
+    Parameters
+    ----------
+    X : scipy sparse matrix or numpy array
+        Encoded CDCR numbers (see encode())
+    cdcr_nums : pandas index
+        CDCR number of each row of X
+    k : int, optional
+        Number of neighbours of each CDCR number
+        Default is 10.
+    block_size : int, optional
+        Number of rows whose similarities are computed at a time (limits the memory to block_size x number of rows)
+        Default is 500.
+    dense_share : float, optional
+        Features of more than this share of the CDCR numbers are multiplied as dense matrices (only used with scipy)
+        Default is 0.01.
+
+    Returns
+    -------
+    pandas dataframe
+        The k most similar CDCR numbers of every CDCR number with the cosine similarity and the rank (1 is the most similar)
+
+    """
+    n = X.shape[0]
+    k = min(k, n - 1)
+    if k < 1:
+        return pd.DataFrame(columns = ['cdcr #', 'neighbour', 'similarity', 'rank'])
+    if sparse is not None:
+        # Features shared by many CDCR numbers (ex: county, age bins) make the product dense, so they are multiplied as dense matrices
+        # The remaining features (ex: offense codes) are rare and multiplied as sparse matrices
+        freq = np.bincount(X.indices, minlength = X.shape[1]) > dense_share*n
+        Xd = X[:, np.flatnonzero(freq)].toarray()
+        Xs = X[:, np.flatnonzero(~freq)].tocsr()
+        XsT = Xs.T.tocsr()
+    else:
+        Xd = X
+
+    idx = []
+    sims = []
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        # Similarity of the block with every row
+        S = Xd[start:end] @ Xd.T
+        if sparse is not None:
+            S += (Xs[start:end] @ XsT).toarray()
+        # Negated in place, so that the smallest values are the most similar
+        np.negative(S, out = S)
+        # A CDCR number is not its own neighbour
+        S[np.arange(end - start), np.arange(start, end)] = np.inf
+        # Top k of each row without sorting the whole row
+        top = np.argpartition(S, k - 1, axis = 1)[:, :k]
+        top_sims = -np.take_along_axis(S, top, axis = 1)
+        order = np.argsort(-top_sims, axis = 1, kind = 'stable')
+        idx.append(np.take_along_axis(top, order, axis = 1))
+        sims.append(np.take_along_axis(top_sims, order, axis = 1))
+    idx = np.vstack(idx)
+    sims = np.vstack(sims)
+
+    return pd.DataFrame({'cdcr #': np.repeat(cdcr_nums.values, k),
+                         'neighbour': cdcr_nums.values[idx.ravel()],
+                         'similarity': sims.ravel().round(4),
+                         'rank': np.tile(np.arange(1, k + 1), n)})
+
+
+def gen_clusters(X,
+                 n_clusters = 10,
+                 n_iter = 30,
+                 seed = 0):
+    """
+
+    Parameters
+    ----------
+    X : scipy sparse matrix or numpy array
+        Encoded CDCR numbers (see encode())
+    n_clusters : int, optional
+        Number of sub-cohorts
+        Default is 10.
+    n_iter : int, optional
+        Maximum number of iterations
+        Default is 30.
+    seed : int, optional
+        Seed of the random number generator used to pick the initial centers
+        Default is 0.
+
+    Returns
+    -------
+    labels : numpy array
+        Sub-cohort of each row of X
+    centers : numpy array
+        Unit length center of each sub-cohort (one column per feature)
+
+    """
+    n = X.shape[0]
+    # There cannot be more sub-cohorts than CDCR numbers
+    n_clusters = min(n_clusters, n)
+    if n_clusters < 1:
+        return np.zeros(n, dtype = int), np.zeros((0, X.shape[1]), dtype = np.float32)
+    rng = np.random.default_rng(seed)
+
+    # Start from randomly picked CDCR numbers
+    centers = X[rng.choice(n, n_clusters, replace = False)]
+    centers = centers.toarray() if sparse is not None else centers.copy()
+    labels = np.full(n, -1)
+
+    # Spherical k-means, i.e. every CDCR number joins the center with the highest cosine similarity
+    for i in range(n_iter):
+        new_labels = np.asarray(X @ centers.T).argmax(axis = 1)
+        if (new_labels == labels).all():
+            break
+        labels = new_labels
+
+        # New centers are the normalized sums of their members
+        if sparse is not None:
+            A = sparse.csr_matrix((np.ones(n, dtype = np.float32), (labels, np.arange(n))), shape = (n_clusters, n))
+            centers = np.asarray((A @ X).todense())
+        else:
+            centers = np.zeros((n_clusters, X.shape[1]), dtype = np.float32)
+            np.add.at(centers, labels, X)
+        norms = np.linalg.norm(centers, axis = 1)
+        # Empty sub-cohorts are restarted from a random CDCR number
+        empty = norms == 0
+        if empty.any():
+            restart = X[rng.choice(n, int(empty.sum()), replace = False)]
+            centers[empty] = restart.toarray() if sparse is not None else restart
+            norms[empty] = 1
+        centers = centers/norms[:, None]
+
+    return labels, centers
+
+
+def gen_subcohorts(el_cdcr_nums,
+                   demographics,
+                   current_commits,
+                   prior_commits,
+                   id_label,
+                   n_clusters = 10,
+                   k = 10,
+                   top = 5,
+                   write_path = None,
+                   pop_label = None,
+                   run_report = None):
+    """
+
+    Parameters
+    ----------
+    el_cdcr_nums : list
+        CDCR numbers of the eligible population
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated
+    current_commits : pandas dataframe
+        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
+    prior_commits : pandas dataframe
+        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
+    id_label : str
+        Name of the column with the CDCR IDs
+    n_clusters : int, optional
+        Number of sub-cohorts
+        Default is 10.
+    k : int, optional
+        Number of neighbours of each CDCR number. If 0, neighbours are not computed
+        Default is 10.
+    top : int, optional
+        Number of features that describe each sub-cohort
+        Default is 5.
+    write_path : str, optional
+        Full path of the folder where the sub-cohorts should be written to Excel. If None, nothing is written
+        Default is None.
+    pop_label : str, optional
+        Label of the population, used to name the output file
+        Default is None.
+    run_report : list, optional
+        Records of the run (see report.track())
+        Default is None.
+
+    Returns
+    -------
+    members : pandas dataframe
+        Sub-cohort of every CDCR number
+    subcohorts : pandas dataframe
+        Size of each sub-cohort and the features that best describe it
+    neighbours : pandas dataframe
+        Most similar CDCR numbers of every CDCR number (see gen_neighbours())
+
+    """
+    # Clean the column names of shallow copies, since other stages can read the same datasets at the same time
+    demographics, current_commits, prior_commits = [df.set_axis([utils.clean(col, remove = ['\n']) for col in df.columns], axis = 1, copy = False) for df in [demographics, current_commits, prior_commits]]
+
+    # A cohort without CDCR numbers, ex: a scenario that nobody is eligible under, has no sub-cohorts or neighbours
+    if len(el_cdcr_nums) == 0:
+        with report.track(run_report, stage = pop_label, rule_id = 'clusters', input_size = 0) as record:
+            members = pd.DataFrame(columns = ['cdcr #', 'sub-cohort'])
+            subcohorts = pd.DataFrame(columns = ['sub-cohort', 'size', 'features'])
+            neighbours = pd.DataFrame(columns = ['cdcr #', 'neighbour', 'similarity', 'rank']) if k else None
+            record['output size'] = 0
+    else:
+        with report.track(run_report, stage = pop_label, rule_id = 'encode', input_size = len(el_cdcr_nums)) as record:
+            X, cdcr_nums, features = encode(el_cdcr_nums = el_cdcr_nums,
+                                            demographics = demographics,
+                                            current_commits = current_commits,
+                                            prior_commits = prior_commits,
+                                            id_label = id_label)
+            record['output size'] = X.shape[1]
+
+        with report.track(run_report, stage = pop_label, rule_id = 'clusters', input_size = len(cdcr_nums)) as record:
+            labels, centers = gen_clusters(X, n_clusters = n_clusters)
+            members = pd.DataFrame({'cdcr #': cdcr_nums.values, 'sub-cohort': labels})
+            # Features with the highest weight in each center
+            top_features = np.argsort(-centers, axis = 1)[:, :top]
+            subcohorts = pd.DataFrame({'sub-cohort': np.arange(len(centers)),
+                                       'size': np.bincount(labels, minlength = len(centers)),
+                                       'features': ['; '.join(features[top_features[i]]) for i in range(len(centers))]})
+            record['output size'] = len(subcohorts)
+
+        neighbours = None
+        if k:
+            with report.track(run_report, stage = pop_label, rule_id = 'neighbours', input_size = len(cdcr_nums)) as record:
+                neighbours = gen_neighbours(X, cdcr_nums, k = k)
+                record['output size'] = len(neighbours)
+
+    # Write data to excel files
+    if write_path:
+        # If directory does not exist, then first create it
+        if not os.path.exists(write_path):
+            os.makedirs(write_path)
+        with pd.ExcelWriter(write_path+'/'+str(pop_label)+'_subcohorts.xlsx') as writer:
+            subcohorts.to_excel(writer, sheet_name = 'Sub-cohorts', index = False)
+            members.to_excel(writer, sheet_name = 'Members', index = False)
+            if neighbours is not None:
+                neighbours.to_excel(writer, sheet_name = 'Neighbours', index = False)
+        print('Sub-cohorts written to: ', write_path+'/'+str(pop_label)+'_subcohorts.xlsx')
+
+    return members, subcohorts, neighbours
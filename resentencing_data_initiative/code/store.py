@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import numpy as np
+
+
+# Name of the index of a store. It differs from the column names, so the CDCR ID column is kept as a regular column as well
+index_name = 'cdcr id'
+
+
+def is_store(demographics):
+    """
+
+    Parameters
+    ----------
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated
+
+    Returns
+    -------
+    boolean
+        True if the dataframe is already indexed by CDCR ID (see gen_store())
+
+    """
+    return (demographics.index.name == index_name) and demographics.index.is_unique
+
+
+def gen_store(demographics,
+              id_label,
+              verbose = True):
+    """
+
+    Parameters
+    ----------
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated
+    id_label : str
+        Name of the column with the CDCR IDs
+    verbose : boolean, optional
+        Specify whether to print a warning when CDCR numbers appear in more than one row
+        Default is True.
+
+    Returns
+    -------
+    store : pandas dataframe
+        Demographics indexed by CDCR ID, i.e. a unique, hashed index so that the rows of any CDCR number can be looked up without scanning the data (see take())
+        If a CDCR number appears in more than one row, only its first row is kept
+
+    """
+    if is_store(demographics):
+        return demographics
+
+    # Detect CDCR numbers with more than one row
+    dup = demographics[id_label].duplicated(keep = 'first').values
+    if dup.any():
+        if verbose:
+            dup_cdcr_nums = demographics.loc[dup, id_label].unique()
+            print('Warning: ', len(dup_cdcr_nums), 'CDCR numbers appear in more than one row of the demographics data, ex:', list(dup_cdcr_nums[:5]), '. Only the first row of each is used')
+        store = demographics.take(np.flatnonzero(~dup))
+    else:
+        # Only the index is replaced, the columns are not copied
+        store = demographics.set_axis(demographics.index, axis = 0, copy = False)
+
+    store.index = pd.Index(store[id_label].values, name = index_name)
+    return store
+
+
+def take(store,
+         cdcr_nums):
+    """
+
+    Parameters
+    ----------
+    store : pandas dataframe
+        Demographics indexed by CDCR ID (see gen_store())
+    cdcr_nums : list, set or array
+        CDCR numbers of the cohort. CDCR numbers that are not in the store are ignored
+
+    Returns
+    -------
+    pandas dataframe
+        Rows of the cohort in the order of the store, i.e. the order of the demographics data
+
+    """
+    if isinstance(cdcr_nums, (set, frozenset)):
+        cdcr_nums = list(cdcr_nums)
+    # Positions of the CDCR numbers in the store (-1 if missing), found with hash lookups
+    pos = store.index.get_indexer(pd.Index(cdcr_nums).unique())
+    return store.take(np.sort(pos[pos >= 0]))
+
+
+def gen_mask(store,
+             cdcr_nums = None):
+    """
+
+    Parameters
+    ----------
+    store : pandas dataframe
+        Demographics indexed by CDCR ID (see gen_store())
+    cdcr_nums : list, set, array or None, optional
+        CDCR numbers of the cohort. CDCR numbers that are not in the store are ignored. A boolean array with one value per row of the store is copied
+        Default is None, i.e. the entire population.
+
+    Returns
+    -------
+    mask : numpy array
+        Boolean value for each row of the store that is True for the individuals of the cohort
+        Cohorts are combined with &, | and ~ and counted with numpy.count_nonzero() without looking up any CDCR number (see get_ids())
+
+    """
+    if cdcr_nums is None:
+        return np.ones(len(store), dtype = bool)
+    if isinstance(cdcr_nums, np.ndarray) and (cdcr_nums.dtype == bool):
+        if len(cdcr_nums) != len(store):
+            raise ValueError('The cohort has '+str(len(cdcr_nums))+' values but the store has '+str(len(store))+' rows')
+        return cdcr_nums.copy()
+    if isinstance(cdcr_nums, (set, frozenset)):
+        cdcr_nums = list(cdcr_nums)
+    # Positions of the CDCR numbers in the store (-1 if missing), found with hash lookups
+    pos = store.index.get_indexer(pd.Index(cdcr_nums).unique())
+    mask = np.zeros(len(store), dtype = bool)
+    mask[pos[pos >= 0]] = True
+    return mask
+
+
+def get_ids(store,
+            mask):
+    """
+
+    Parameters
+    ----------
+    store : pandas dataframe
+        Demographics indexed by CDCR ID (see gen_store())
+    mask : numpy array
+        Boolean value for each row of the store (see gen_mask())
+
+    Returns
+    -------
+    list
+        CDCR numbers of the cohort in the order of the store
+
+    """
+    return store.index[mask].tolist()
@@ -1,14 +1,24 @@
 # -*- coding: utf-8 -*-
 import helpers
 import utils
-import pandas as pd
+import report
+import store
+import writer
 import numpy as np
-import datetime
-import copy
-from tqdm import tqdm
 import os
 
 
+# Cleaned columns that the summaries read from each dataset besides the CDCR ID (None means all the columns, the demographics of the cohort are all kept in the summary)
+cols = {'demographics': None,
+        'current_commits': ['offense'],
+        'prior_commits': ['offense'],
+        'merit_credit': [],
+        'milestone_credit': [],
+        'rehab_credit': [],
+        'voced_credit': [],
+        'rv_report': ['rule violation date', 'division', 'rule violation']}
+
+
 def gen_summary(cdcr_nums, 
                 demographics,
                 current_commits, 
@@ -25,7 +35,11 @@ def gen_summary(cdcr_nums,
                 month = None,
                 pop_label = None,
                 write_path = None,
-                to_excel = False):
+                to_excel = False,
+                run_report = None,
+                memory_budget = None,
+                stream = None,
+                batch_size = 10000):
     """
 
     Parameters
@@ -33,7 +47,7 @@ def gen_summary(cdcr_nums,
     cdcr_nums : list of strs
         List of CDCR numbers to generate population summary for
     demographics : pandas dataframe
-        Data on demographics of the incarcerated population
+        Data on demographics of the incarcerated population. Can also be indexed by CDCR ID already (see store.gen_store()), in which case the index is reused
     current_commits : pandas dataframe
         Data on current offenses of the incarcerated population wherein each row contains a single offense
     prior_commits : pandas dataframe
@@ -72,53 +86,126 @@ def gen_summary(cdcr_nums,
     write_path : str, optional 
         Specify the full path where the Excel outputs should be written. 
         If to_excel = True but write_path = None, data outputs are written to the county_name/month/output/date folder by default. To avoid this behavior, pass a value to write_path.
+    run_report : list, optional
+        Records of the run (see report.track()). If passed, a record with the cohort size, wall time, CPU time and peak memory is appended for summary generation and for writing the output
+        Default is None.
+    memory_budget : float, optional
+        Memory budget in MB (see config.memory_budget_mb). If the summary is estimated to exceed it, a warning is printed and the summary is generated in chunks. If to_excel = True, the chunks are streamed to [pop_label]_summary.xlsx (see stream), so that the whole summary is never held in memory
+        Otherwise the chunks are combined in memory, which only limits the intermediate data of each chunk. The peak memory that was measured is printed in both cases
+        Default is None.
+    stream : str, optional
+        Format to stream the summary to, i.e. 'xlsx', 'jsonl', 'csv' or 'parquet' (see writer.write_stream()). The summaries are generated in batches of CDCR numbers and each batch is appended to [pop_label]_summary.[stream] as soon as it is generated, so the memory used does not grow with the size of the cohort
+        The summary is written even if to_excel = False
+        Default is None, i.e. the summary is generated at once and returned.
+    batch_size : int, optional
+        Number of CDCR numbers in each batch if the summary is streamed
+        Default is 10000.
     
     Returns
     -------
-    df : pandas dataframe
+    df : pandas dataframe or str
         Data on convictions, rules violations, programming for each CDCR number passed in the input dataframe. If merge = True, this includes the input dataframe as well
+        Full path of the file that the summary was streamed to if stream is passed, or if to_excel = True and the summary exceeds the memory budget
 
     """
     print('Generating population summaries')
     
     # Clean the column names 
     if clean_col_names:
-        for df in [demographics, current_commits, prior_commits, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report]:
-            df.columns = [utils.clean(col, remove = ['\n']) for col in df.columns]
+        # Shallow copies are renamed, since other stages can read the same datasets at the same time
+        demographics, current_commits, prior_commits, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report = [df.set_axis([utils.clean(col, remove = ['\n']) for col in df.columns], axis = 1, copy = False) for df in [demographics, current_commits, prior_commits, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report]]
     else:
         print('Since column names are not cleaned, several required variables for summary generation cannot be found')
     
-    # Get demographics data of selected individuals and take a copy so the original dataframe is not modified
-    df = demographics.loc[demographics[utils.clean(id_label)].isin(cdcr_nums)][:]
+    demographics = store.gen_store(demographics, utils.clean(id_label))
+    
+    # Summarize the cohort in chunks if the summary is estimated to exceed the memory budget
+    chunk_size = None
+    if memory_budget:
+        # Only a share of the demographics, commitments and rule violations are joined into the summary
+        share = len(cdcr_nums)/max(len(demographics), 1)
+        est_mb = sum(utils.est_memory(data)*share for data in [demographics, current_commits, prior_commits, rv_report])
+        if utils.check_memory_budget(stage = 'summary', est_mb = est_mb, budget_mb = memory_budget):
+            chunk_size = max(int(len(cdcr_nums)*memory_budget/est_mb), 1)
+            # Chunks that are combined in memory still need the memory of the whole summary, so a summary that is written anyway is streamed to the output file
+            if stream or to_excel:
+                stream, batch_size = stream or 'xlsx', min(batch_size, chunk_size)
+                print('Streaming the summary to the output file in chunks of', batch_size, 'CDCR numbers')
+            else:
+                print('Summarizing the cohort in chunks of', chunk_size, 'CDCR numbers. The combined summary is held in memory')
+    
+    # Stream the summaries to the output file one batch of CDCR numbers at a time
+    if stream:
+        if not write_path:
+            write_path = utils.get_write_path(read_path = read_path, county_name = county_name, month = month)
+        if not os.path.exists(write_path):
+            os.makedirs(write_path)
+        # Positions of the cohort in the demographics, so that the batches are in the same order as the summary that is not streamed
+        pos = np.flatnonzero(store.gen_mask(demographics, cdcr_nums))
+        
+        def batches():
+            for i in range(0, max(len(pos), 1), batch_size):
+                # Only the demographics of the batch are copied
+                df = demographics.take(pos[i:i+batch_size])
+                df['dppv disability - mobility'] = df['dppv disability - mobility'].str.replace('Impacting Placement', '')
+                yield from helpers.iter_summary(df = df, 
+                                                id_label = utils.clean(id_label),
+                                                current_commits = current_commits, 
+                                                prior_commits = prior_commits, 
+                                                merit_credit = merit_credit, 
+                                                milestone_credit = milestone_credit, 
+                                                rehab_credit = rehab_credit, 
+                                                voced_credit = voced_credit, 
+                                                rv_report = rv_report)
+        
+        with report.track(run_report, stage = pop_label, rule_id = 'stream summary', input_size = len(cdcr_nums)) as record:
+            write_path, record['output size'] = writer.write_stream(batches(), 
+                                                                    write_path = write_path+'/'+pop_label+'_summary.'+stream, 
+                                                                    label = 'Summary of individuals')
+        if chunk_size and record.get('peak rss (mb)') is not None:
+            print('Peak memory while streaming the summary:', record['peak rss (mb)'], 'MB, i.e.', record['peak memory delta (mb)'], 'MB more than at the start (budget of', memory_budget, 'MB)')
+        return write_path
+    
+    # Get demographics data of selected individuals by CDCR ID. take() returns a new dataframe, so the original dataframe is not modified and no further copy is needed
+    df = store.take(demographics, cdcr_nums)
     
     # Remove string in disability column of demographics dataset
     df['dppv disability - mobility'] = df['dppv disability - mobility'].str.replace('Impacting Placement', '')
     
     # Generate summaries of individuals who are selected
-    summary = helpers.gen_summary(df = df, 
-                                  id_label = utils.clean(id_label),
-                                  current_commits = current_commits, 
-                                  prior_commits = prior_commits, 
-                                  merit_credit = merit_credit, 
-                                  milestone_credit = milestone_credit, 
-                                  rehab_credit = rehab_credit, 
-                                  voced_credit = voced_credit, 
-                                  rv_report = rv_report, 
-                                  merge = True)
+    with report.track(run_report, stage = pop_label, rule_id = 'summary', input_size = len(cdcr_nums)) as record:
+        summary = helpers.gen_summary(df = df, 
+                                      id_label = utils.clean(id_label),
+                                      current_commits = current_commits, 
+                                      prior_commits = prior_commits, 
+                                      merit_credit = merit_credit, 
+                                      milestone_credit = milestone_credit, 
+                                      rehab_credit = rehab_credit, 
+                                      voced_credit = voced_credit, 
+                                      rv_report = rv_report, 
+                                      merge = True,
+                                      chunk_size = chunk_size)
+        record['output size'] = len(summary)
+    if chunk_size and record.get('peak rss (mb)') is not None:
+        print('Peak memory while summarizing the cohort in chunks:', record['peak rss (mb)'], 'MB, i.e.', record['peak memory delta (mb)'], 'MB more than at the start (budget of', memory_budget, 'MB)')
     
     # Write data to excel files
     if to_excel:
-        if write_path: 
-            pass
-        else: 
-            write_path = '/'.join(l for l in [read_path, county_name, month, 'output', 'date of execution', utils.get_todays_date(sep = '_')] if l)
+        with report.track(run_report, stage = pop_label, rule_id = 'write summary', input_size = len(summary)) as record:
+            if write_path: 
+                pass
+            else: 
+                write_path = utils.get_write_path(read_path = read_path, county_name = county_name, month = month)
             
-        # If directory does not exist, then first create it
-        if not os.path.exists(write_path):
-            os.makedirs(write_path)
+            # If directory does not exist, then first create it
+            if not os.path.exists(write_path):
+                os.makedirs(write_path)
                 
-        # Write data to excel files
-        summary.to_excel(write_path+'/'+pop_label+'_summary.xlsx', index = False)
-        print('Summary of individuals written to: ', write_path+'/'+pop_label+'_summary.xlsx')
+            # Write data to excel files (in the background if the writer is started, see writer.start())
+            writer.submit(writer.write_excel, 
+                          sheets = {'Sheet1': (summary, False)}, 
+                          write_path = write_path+'/'+pop_label+'_summary.xlsx', 
+                          label = 'Summary of individuals')
+            record['output size'] = len(summary)
         
     return summary
\ No newline at end of file
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+import helpers
+import utils
+from scenarios import rules
+import pandas as pd
+import numpy as np
+import itertools
+
+
+def gen_axes(grid):
+    """
+
+    Parameters
+    ----------
+    grid : dict
+        Thresholds to sweep for each rule with numerical conditions (see rules.num)
+        Rules with a single condition take a list of thresholds, ex: {'r_1': [45, 50, 55]}
+        Rules with several conditions take a list of tuples with one threshold per condition, ex: {'r_6': [(14, 16), (14, 18)]}
+
+    Returns
+    -------
+    axes : list of dicts
+        One axis per numerical condition with the rule, variable, operator and the sorted unique thresholds to sweep
+        Thresholds are sorted so that the individuals who meet a threshold also meet all the thresholds before it, i.e. ascending for '>=' and '>' and descending for '<=' and '<'
+
+    """
+    axes = []
+    for rule in grid.keys():
+        for i, cond in enumerate(rules.num[rule]):
+            # Thresholds of this condition
+            thresholds = [t[i] if isinstance(t, (tuple, list)) else t for t in grid[rule]]
+            axes.append({'rule': rule,
+                         'variable': cond['variable'],
+                         'operator': cond['operator'],
+                         'thresholds': sorted(set(thresholds), reverse = cond['operator'] in ['<', '<=']),
+                         'label': rule+': '+cond['variable']+' '+cond['operator']})
+    return axes
+
+
+def gen_levels(values,
+               axis):
+    """
+
+    Parameters
+    ----------
+    values : numpy array
+        Values of the variable of the axis for every individual, ex: age in years
+    axis : dict
+        Axis generated with gen_axes()
+
+    Returns
+    -------
+    levels : numpy array
+        Number of thresholds of the axis that each individual meets. Since the thresholds are nested, an individual meets threshold k (0-based, in the sorted order of the axis) if and only if their level is greater than k
+
+    """
+    # Thresholds in ascending order to search the values in
+    asc = np.sort(np.asarray(axis['thresholds'], dtype = float))
+    if axis['operator'] == '>=':
+        levels = np.searchsorted(asc, values, side = 'right')
+    elif axis['operator'] == '>':
+        levels = np.searchsorted(asc, values, side = 'left')
+    elif axis['operator'] == '<':
+        levels = len(asc) - np.searchsorted(asc, values, side = 'right')
+    elif axis['operator'] == '<=':
+        levels = len(asc) - np.searchsorted(asc, values, side = 'left')
+    else:
+        raise ValueError('Comparison operator '+str(axis['operator'])+' is not supported')
+
+    # Individuals with missing values do not meet any threshold
+    levels[np.isnan(values)] = 0
+    return levels
+
+
+def threshold_sweep(demographics,
+                    grid,
+                    id_label,
+                    el_cdcr_nums = None):
+    """
+
+    Parameters
+    ----------
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated. The time variables are calculated if they are missing (see helpers.gen_time_vars())
+    grid : dict
+        Thresholds to sweep for each rule with numerical conditions, ex: {'r_1': [45, 50, 55], 'r_3': [10, 15], 'r_6': [(14, 16), (14, 18)]}
+        The cohort size is calculated for every combination of thresholds across all the rules (and across the conditions of a rule)
+    id_label : str
+        Name of the column with the CDCR IDs
+    el_cdcr_nums : list, optional
+        CDCR numbers that already meet the other eligibility conditions (ex: the offense related rules). Only these CDCR numbers are evaluated
+        Default is None, i.e. the entire population is evaluated.
+
+    Returns
+    -------
+    sweep : pandas dataframe
+        One row per combination of thresholds with the threshold of each condition and the number of CDCR numbers that meet all of them
+    levels : pandas dataframe
+        Number of thresholds of each condition that each CDCR number meets. Encodes the membership of every combination (see sweep_members())
+
+    """
+    id_label = utils.clean(id_label)
+
+    # Calculate the time variables if they are not present
+    if not all(cond['variable'] in demographics.columns for rule in grid.keys() for cond in rules.num[rule]):
+        demographics, errors = helpers.gen_time_vars(df = demographics, id_label = id_label, merge = True)
+
+    # Only evaluate the CDCR numbers that meet the other eligibility conditions
+    if el_cdcr_nums is not None:
+        demographics = demographics.take(np.flatnonzero(demographics[id_label].isin(el_cdcr_nums).values))
+
+    axes = gen_axes(grid)
+
+    # Number of thresholds of each condition that each individual meets (one search per condition)
+    levels = np.column_stack([gen_levels(demographics[axis['variable']].to_numpy(dtype = float), axis) for axis in axes])
+
+    # Count the individuals at every combination of levels in a single pass
+    shape = tuple(len(axis['thresholds'])+1 for axis in axes)
+    counts = np.bincount(np.ravel_multi_index(levels.T, shape), minlength = int(np.prod(shape))).reshape(shape)
+
+    # Cumulative counts from the highest level down, i.e. the number of individuals at or above each combination of levels
+    for i in range(len(axes)):
+        counts = np.flip(np.flip(counts, axis = i).cumsum(axis = i), axis = i)
+
+    # An individual meets threshold k of an axis if their level is greater than k
+    sweep = []
+    for combo in itertools.product(*[range(len(axis['thresholds'])) for axis in axes]):
+        row = {axis['label']: axis['thresholds'][k] for axis, k in zip(axes, combo)}
+        row['count'] = int(counts[tuple(k+1 for k in combo)])
+        sweep.append(row)
+
+    levels = pd.DataFrame(levels, columns = [axis['label'] for axis in axes], index = demographics[id_label].values)
+    levels.attrs['axes'] = axes
+
+    return pd.DataFrame(sweep), levels
+
+
+def sweep_members(levels,
+                  thresholds):
+    """
+
+    Parameters
+    ----------
+    levels : pandas dataframe
+        Levels returned by threshold_sweep()
+    thresholds : dict or pandas series
+        Threshold of each condition, i.e. a row of the sweep returned by threshold_sweep() (the 'count' value is ignored)
+
+    Returns
+    -------
+    list
+        CDCR numbers that meet all the thresholds of the combination
+
+    """
+    mask = np.ones(len(levels), dtype = bool)
+    for axis in levels.attrs['axes']:
+        # Position of the threshold in the sorted thresholds of the axis
+        k = axis['thresholds'].index(thresholds[axis['label']])
+        mask &= levels[axis['label']].to_numpy() > k
+    return levels.index[mask].tolist()
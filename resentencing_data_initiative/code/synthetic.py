@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import numpy as np
+import datetime
+
+
+# Offenses used to generate synthetic commitments (raw values, i.e. before utils.clean() is applied)
+offenses = ['PC187', 'PC187 2nd', 'PC664/187', 'PC211', 'PC211 2nd', 'PC664/211', 'PC215', 'PC459', 'PC459 1st', 'PC245(a)(1)',
+            'PC288(a)', 'PC261(a)(2)', 'PC10851(a)', 'PC12020(a)', 'PC422', 'PC273.5(a)', 'HS11350(a)', 'HS11351', 'VC10851(a)', 'PC496(a)', 'PC192(a)']
+# Enhancements used to generate synthetic commitments
+enhancements = ['', '', '', '', 'PC12022(a)(1)', 'PC12022.5(a)', 'PC12022.53(b)', 'PC667.5(b)', 'PC667(a)(1)']
+# Tables of the synthetic sorting criteria
+tables = {'Table A': ['PC459', 'PC245(a)(1)', 'PC422'],
+          'Table B': ['PC187', 'PC211', 'PC215', 'PC261(a)(2)'],
+          'Table C': ['PC187', 'PC288(a)'],
+          'Table D': ['PC288(a)', 'PC261(a)(2)'],
+          'Table E': ['PC187', 'PC192(a)'],
+          'Table F': ['PC211', 'PC215']}
+
+
+def pick(rng, 
+         values, 
+         size, 
+         p = None):
+    """
+
+    Parameters
+    ----------
+    rng : numpy random generator
+        Random number generator
+    values : list or numpy array
+        Values to sample from
+    size : int
+        Number of values to sample
+    p : list, optional
+        Probability of each value
+        Default is None, i.e. uniform.
+
+    Returns
+    -------
+    numpy array
+        Sampled values as an object array. Repeated values refer to the same Python string, so large samples stay small in memory
+
+    """
+    return np.asarray(values, dtype = object)[rng.integers(0, len(values), size) if p is None else rng.choice(len(values), size, p = p)]
+
+
+def gen_data(n = 100000,
+             commits_per_person = 3,
+             seed = 0):
+    """
+
+    Parameters
+    ----------
+    n : int, optional
+        Number of individuals in the synthetic population
+        Default is 100000.
+    commits_per_person : int, optional
+        Average number of current and prior commitments per individual
+        Default is 3.
+    seed : int, optional
+        Seed of the random number generator
+        Default is 0.
+
+    Returns
+    -------
+    Synthetic datasets with the same columns as the raw data and in the same order as extract.get_input():
+    sorting_criteria, demographics, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report, current_commits, prior_commits
+
+    """
+    rng = np.random.default_rng(seed)
+    present_date = pd.Timestamp(datetime.datetime.now().date())
+
+    # CDCR numbers of the synthetic population
+    cdcr_nums = np.array(['S'+str(i).zfill(7) for i in range(n)], dtype = object)
+
+    # Demographics with ages between 18 and 85 and offenses committed between the age of 14 and the present date
+    birthday = present_date - pd.to_timedelta(rng.integers(18*365, 85*365, n), unit = 'D')
+    offense_end = birthday + pd.to_timedelta(rng.integers(14*365, 45*365, n), unit = 'D')
+    offense_end = offense_end.where(offense_end < present_date, present_date - pd.Timedelta(days = 1))
+    demographics = pd.DataFrame({'CDCNo': cdcr_nums,
+                                 'Birthday': birthday,
+                                 'Aggregate Sentence in Months': rng.integers(6, 900, n),
+                                 'Offense End Date': offense_end,
+                                 'Controlling Offense': pick(rng, offenses, n),
+                                 'Description': pick(rng, ['Robbery', 'Burglary', 'Assault', 'Murder', 'Drugs'], n),
+                                 'Sex Registrant': pick(rng, ['Yes', 'No'], n, p = [0.1, 0.9]),
+                                 'Offense Category': pick(rng, ['Crimes Against Persons', 'Property Crimes', 'Drug Crimes', 'Other Crimes'], n),
+                                 'Ethnicity': pick(rng, ['Black', 'Hispanic', 'White', 'Asian', 'Other'], n),
+                                 'Sentencing County': pick(rng, ['Los Angeles', 'San Diego', 'Orange', 'Kern'], n),
+                                 'DPPV Disability - Mobility': pick(rng, ['', 'Impacting Placement'], n, p = [0.95, 0.05])})
+
+    # Current commitments (each row pertains to a single offense)
+    m = n*commits_per_person
+    current_commits = pd.DataFrame({'CDCNo': pick(rng, cdcr_nums, m),
+                                    'Case Number': pick(rng, ['BA'+str(i) for i in range(1000)], m),
+                                    'Offense': pick(rng, offenses, m),
+                                    'Offense Category': pick(rng, ['Crimes Against Persons', 'Property Crimes', 'Drug Crimes'], m),
+                                    'Off_Enh1': pick(rng, enhancements, m),
+                                    'Off_Enh2': pick(rng, enhancements, m),
+                                    'Off_Enh3': '',
+                                    'Off_Enh4': '',
+                                    'Relationship': pick(rng, ['Initial', 'Concurrent', 'Consecutive', 'Stayed'], m),
+                                    'In-prison': pick(rng, ['Yes', 'No'], m, p = [0.05, 0.95])})
+
+    # Prior commitments (each row pertains to a single offense)
+    prior_commits = pd.DataFrame({'CDCNo': pick(rng, cdcr_nums, m),
+                                  'Case Number': pick(rng, ['BA'+str(i) for i in range(1000)], m),
+                                  'Offense': pick(rng, offenses, m),
+                                  'Offense Category': pick(rng, ['Crimes Against Persons', 'Property Crimes', 'Drug Crimes'], m)})
+
+    # Programming and credits attained by a share of the population
+    merit_credit, milestone_credit, rehab_credit, voced_credit = [pd.DataFrame({'CDCNo': pick(rng, cdcr_nums, n//4),
+                                                                                'Credit': rng.integers(1, 60, n//4)}) for i in range(4)]
+
+    # Rule violations
+    rv_report = pd.DataFrame({'CDCNo': pick(rng, cdcr_nums, n//2),
+                              'Rule Violation Date': present_date - pd.to_timedelta(rng.integers(1, 20*365, n//2), unit = 'D'),
+                              'Division': pick(rng, ['A', 'B', 'C', 'D', 'E', 'F'], n//2),
+                              'Rule Violation': pick(rng, ['Possession of a Controlled Substance', 'Fighting', 'Disobeying Orders'], n//2)})
+
+    # Sorting criteria in the same format as sorting_criteria.xlsx
+    sorting_criteria = pd.DataFrame([(off, table) for table in tables.keys() for off in tables[table]], columns = ['Offenses', 'Table'])
+
+    return sorting_criteria, demographics, merit_credit, milestone_credit, rehab_credit, voced_credit, rv_report, current_commits, prior_commits
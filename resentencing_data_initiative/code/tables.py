@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+import numpy as np
+import threading
+import weakref
+import checkpoint
+import impl
+import utils
+
+
+# Derived table of r_12: offenses in Table A, B, C or D, minus Table F and the implied offenses it generates with this expansion
+derived = {'Tables A to D minus Table F': {'tables': ['Table A', 'Table B', 'Table C', 'Table D'],
+                                           'minus': ['Table F'],
+                                           'spec': {'impl_rel': {'all': ['/att', '(664)', '2nd', "(ss)"]},
+                                                    'perm': 4,
+                                                    'fix_pos': {"2nd": 0, "(ss)": 0},
+                                                    'placeholder': {"ss": ['a', 'b', 'c']}}}}
+
+# Compiled indexes by key of the sorting criteria and of the expansion of the implied offenses (see gen_index())
+indexes = {}
+# Codes of the unique offenses of the offense columns that were looked up, by dataframe and name of the column (see lookup())
+lookups = {}
+# Positions in the demographics of the CDCR IDs of the commitments, by dataframe and name of the ID column (see locate())
+positions = {}
+lock = threading.Lock()
+
+
+def gen_spec(eligibility_conditions,
+             rule,
+             fixed = False):
+    """
+
+    Parameters
+    ----------
+    eligibility_conditions : dict
+        Data on all the rules, whether they should be applied or not and other specifications
+    rule : str
+        Key of the rule, ex: 'r_4'
+    fixed : boolean, optional
+        Specify whether the rule also specifies fixed positions and placeholders of the implied offenses
+        Default is False.
+
+    Returns
+    -------
+    dict
+        Expansion of the implied offenses of the rule, i.e. the arguments of impl.gen_impl_map()
+
+    """
+    return {'impl_rel': eligibility_conditions[rule]['implied ineligibility'],
+            'perm': eligibility_conditions[rule]['perm'],
+            'fix_pos': eligibility_conditions[rule]['fix positions'] if fixed else None,
+            'placeholder': eligibility_conditions[rule]['placeholder'] if fixed else None}
+
+
+def gen_tables(sorting_criteria):
+    """
+
+    Parameters
+    ----------
+    sorting_criteria : pandas dataframe
+        Data on offenses and their categories or tables
+
+    Returns
+    -------
+    tables : dict
+        Cleaned offenses of every table of the sorting criteria by name of the table, and of the derived tables (see derived)
+
+    """
+    tables = {}
+    for table, offenses in sorting_criteria.groupby('Table', sort = True, observed = True)['Offenses']:
+        tables[table] = set(utils.clean_blk(offenses.tolist()))
+
+    # Offenses of the derived tables, minus the offenses that the other tables imply
+    for name, spec in derived.items():
+        minus = set()
+        for offenses in impl.gen_impl_map(offenses = set().union(*[tables.get(table, set()) for table in spec['minus']]), **spec['spec']).values():
+            minus.update(offenses)
+        tables[name] = set().union(*[tables.get(table, set()) for table in spec['tables']]).difference(minus)
+
+    return tables
+
+
+def gen_index(sorting_criteria,
+              spec):
+    """
+
+    Parameters
+    ----------
+    sorting_criteria : pandas dataframe
+        Data on offenses and their categories or tables
+    spec : dict
+        Expansion of the implied offenses (see gen_spec())
+
+    Returns
+    -------
+    index : dict
+        Compiled index of the sorting criteria, with:
+        'tables': bit of every table by name, ex: {'Table A': 0, ...}. An offense listed in a table has its bit set, an offense implied by an offense of the table has the bit shifted by 'shift' set
+        'shift': number of tables, i.e. distance between the base and the implied bit of a table
+        'codes': bitmask of the tables by cleaned (and implied) offense, ex: {'187': 0b100000100}
+        The index is compiled once per sorting criteria and expansion, and reused by every rule with the same expansion
+
+    """
+    key = checkpoint.get_key(sorting_criteria[['Table', 'Offenses']].values.tolist(), spec)
+    with lock:
+        if key in indexes:
+            return indexes[key]
+
+    tables = gen_tables(sorting_criteria)
+    bits = {table: i for i, table in enumerate(tables.keys())}
+    shift = len(bits)
+    codes = {}
+    for table, offenses in tables.items():
+        # Every offense of the table and its implied offenses
+        for off, impl_off in impl.gen_impl_map(offenses = offenses, **spec).items():
+            for code in impl_off:
+                codes[code] = codes.get(code, 0) | (1 << (bits[table] + (0 if code == off else shift)))
+
+    index = {'tables': bits, 'shift': shift, 'codes': codes}
+    with lock:
+        indexes[key] = index
+    return index
+
+
+def gen_mask(index,
+             tables,
+             implied = True):
+    """
+
+    Parameters
+    ----------
+    index : dict
+        Compiled index of the sorting criteria (see gen_index())
+    tables : list
+        Names of the tables, ex: ['Table C', 'Table D']. Tables that are not in the sorting criteria are ignored
+    implied : boolean, optional
+        Specify whether the offenses implied by the offenses of the tables also match
+        Default is True.
+
+    Returns
+    -------
+    mask : int
+        Bitmask of the tables, to be tested against the bitmasks of the offenses, ex: (bits & mask) != 0
+
+    """
+    mask = 0
+    for table in tables:
+        if table in index['tables']:
+            mask |= 1 << index['tables'][table]
+            if implied:
+                mask |= 1 << (index['tables'][table] + index['shift'])
+    return mask
+
+
+def sel_offenses(index,
+                 mask):
+    """
+
+    Parameters
+    ----------
+    index : dict
+        Compiled index of the sorting criteria (see gen_index())
+    mask : int
+        Bitmask of the tables (see gen_mask())
+
+    Returns
+    -------
+    list
+        Cleaned offenses of the tables and their implied offenses
+
+    """
+    return [code for code, bits in index['codes'].items() if bits & mask]
+
+
+def remember(cache,
+             key,
+             objs,
+             func):
+    """
+
+    Parameters
+    ----------
+    cache : dict
+        Cache to look the result up in, ex: lookups
+    key : tuple
+        Key of the result in the cache
+    objs : list
+        Objects the result is computed from. The result is only reused while they exist and are the same objects, ex: the series of a column, which pandas replaces when the column is changed
+    func : function
+        Function that computes the result
+
+    Returns
+    -------
+    Result of func, computed once for the same objects
+
+    """
+    with lock:
+        found = cache.get(key)
+    if (found is None) or any(ref() is not obj for ref, obj in zip(found[0], objs)):
+        found = ([weakref.ref(obj) for obj in objs], func())
+        with lock:
+            # Forget the results of objects that no longer exist
+            for k in [k for k, val in cache.items() if any(ref() is None for ref in val[0])]:
+                del cache[k]
+            cache[key] = found
+    return found[1]
+
+
+def lookup(df,
+           col,
+           index):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Data with a column of cleaned offenses, ex: the prepared current commitments
+    col : str
+        Name of the column with the cleaned offenses, ex: 'offense cleaned'
+    index : dict
+        Compiled index of the sorting criteria (see gen_index())
+
+    Returns
+    -------
+    bits : numpy array
+        Bitmask of the tables of the offense of every row (0 for offenses that are in no table), so that every table-based rule is a bitwise test on it, ex: (bits & mask) != 0
+        The column is reduced to codes of its unique offenses once, so every rule only looks up the unique offenses
+
+    """
+    values = df[col]
+    codes, uniques = remember(lookups, (id(df), col), [values], lambda: pd.factorize(values))
+    # Missing offenses have the code -1, which takes the 0 appended after the bits of the unique offenses
+    return np.array([index['codes'].get(off, 0) for off in uniques]+[0], dtype = np.int64)[codes]
+
+
+def locate(store,
+           df,
+           id_label):
+    """
+
+    Parameters
+    ----------
+    store : pandas dataframe
+        Demographics indexed by CDCR ID (see store.gen_store())
+    df : pandas dataframe
+        Data wherein each row pertains to a single offense of a CDCR number, ex: the prepared current commitments
+    id_label : str
+        Name of the column with the CDCR IDs
+
+    Returns
+    -------
+    numpy array
+        Position in the store of the CDCR number of every row of df (-1 for CDCR numbers that are not in the store), computed once for every rule
+
+    """
+    values = df[id_label]
+    return remember(positions, (id(df), id_label), [values, store.index], lambda: store.index.get_indexer(values))
@@ -2,9 +2,7 @@
 import pandas as pd
 import numpy as np
 import datetime
-from tqdm import tqdm
-import copy
-import os
+import re
 
 def incorrect_time(df, cols):
     """
@@ -22,12 +20,8 @@ def incorrect_time(df, cols):
         Rows of df in which ANY of the time-related columns have an error (NaN or NaT)
 
     """
-    # Initialize a dataframe to store the errors
-    errors = pd.DataFrame()
-    # Loop through all time related columns 
-    for col in cols:
-        errors = pd.concat([errors, df[pd.isna(df[col])]])
-    return errors
+    # Select the rows with an error in any of the time-related columns in a single pass (each row is returned once)
+    return df[df[cols].isna().any(axis = 1)]
 
 
 def clean(data, remove = ['pc', 'rape', '\n', ' ']):
@@ -95,7 +89,7 @@ def clean_blk(data,
     
     # If input is a column of a pandas dataframe
     elif isinstance(data, pd.Series):
-        return data.apply(clean)
+        return clean_series(data)
     
     # If input is a pandas dataframe
     elif isinstance(data, pd.DataFrame):
@@ -103,15 +97,64 @@ def clean_blk(data,
         if inplace:
             # Apply the cleaning function onto each column specified
             for col in names.keys():
-                data[names[col]] = data[col].apply(clean)
+                data[names[col]] = clean_series(data[col])
             return data
         # Create a separate dataframe with the modified columns and leave the existing one unchanged
         else:
-            data_new = data[:]
+            # Shallow copy, i.e. the new columns are only added to the new dataframe and the existing columns are not copied
+            data_new = data.copy(deep = False)
             # Apply the cleaning function onto each column specified
             for col in names.keys():
-                data_new[names[col]] = data[col].apply(clean)
+                data_new[names[col]] = clean_series(data[col])
             return data_new
+
+
+
+def clean_series(data):
+    """
+
+    Parameters
+    ----------
+    data : pandas series
+        Column wherein each value is a single string. Example: Offenses in the current commitments data
+
+    Returns
+    -------
+    pandas series
+        Applies the clean() function on each unique value only once and maps the results back onto the column
+
+    """
+    # Offense codes repeat a lot across rows, so only the unique values are cleaned
+    cleaned = {val: clean(val) for val in data.unique()}
+    return data.map(cleaned)
+
+
+def match_codes(data, 
+                id_label, 
+                col, 
+                sel):
+    """
+
+    Parameters
+    ----------
+    data : pandas dataframe
+        Data wherein each row pertains to a single value (ex: offense) of a CDCR number
+    id_label : str
+        Name of the column with the CDCR IDs
+    col : str
+        Name of the column in data with the values to be searched, ex: 'offense cleaned'
+    sel : list, set, pandas series or numpy array
+        Values to be identified in col, ex: list of ineligible offenses, or a boolean array with one value per row of data that is True for the matching rows (see eligibility.table_hits())
+
+    Returns
+    -------
+    pandas series
+        Distinct values in col that match a value in sel exactly, joined with ', ' and indexed by CDCR number. Only the CDCR numbers with at least one match are included
+
+    """
+    rows = sel if (isinstance(sel, np.ndarray) and sel.dtype == bool) else data[col].isin(sel)
+    matches = data.loc[rows, [id_label, col]]
+    return matches[col].astype(str).groupby(matches[id_label], sort = False, observed = True).agg(lambda x: ', '.join(sorted(set(x))))
         
 
 def val_search(data, 
@@ -146,6 +189,90 @@ def val_search(data,
         return match
     
     
+def compile_patterns(patterns):
+    """
+
+    Parameters
+    ----------
+    patterns : dict or list
+        Code patterns by type of match, ex: {'contains': ['12022'], 'prefix': ['667'], 'regex': ['^12022\\.5']}
+        'contains' matches anywhere in a code, 'prefix' at the start of a code and 'regex' is a regular expression
+        A list is treated as {'contains': list}
+
+    Returns
+    -------
+    compiled regular expression
+        Single regular expression that matches a code if any of the patterns matches it
+
+    """
+    if not isinstance(patterns, dict):
+        patterns = {'contains': patterns}
+    
+    parts = []
+    for how, vals in patterns.items():
+        for p in vals:
+            if how == 'contains':
+                parts.append(re.escape(p))
+            elif how == 'prefix':
+                parts.append('^'+re.escape(p))
+            elif how == 'regex':
+                parts.append('(?:'+p+')')
+            else:
+                raise ValueError('Type of match '+str(how)+' is not supported. Use contains, prefix or regex')
+    
+    # An expression that never matches if there are no patterns
+    return re.compile('|'.join(parts) if parts else '(?!)')
+
+
+def match_patterns(data, 
+                   id_label, 
+                   cols, 
+                   patterns):
+    """
+
+    Parameters
+    ----------
+    data : pandas dataframe
+        Data wherein each row pertains to a single offense of a CDCR number, ex: current commitments
+    id_label : str
+        Name of the column with the CDCR IDs
+    cols : list
+        Names of the columns with the codes to search, ex: ['offense cleaned', 'off_enh1 cleaned']
+    patterns : dict or list
+        Code patterns to search for (see compile_patterns())
+
+    Returns
+    -------
+    hits : pandas dataframe
+        Indexed by the CDCR numbers in data. 'hit' is True if any code of the CDCR number matches a pattern and 'matched codes' lists the matching codes (empty string if none)
+
+    """
+    regex = compile_patterns(patterns)
+    
+    # Each distinct code is searched once, the rows are then selected with a vectorized lookup
+    matched = set()
+    checked = set()
+    ids = []
+    codes = []
+    for col in cols:
+        vals = data[col]
+        new = set(vals.dropna().unique()) - checked
+        matched.update(c for c in new if regex.search(str(c)))
+        checked.update(new)
+        sel = vals.isin(matched).values
+        ids.append(data[id_label].values[sel])
+        codes.append(vals.values[sel])
+    
+    # Distinct matching codes of each CDCR number
+    matches = pd.Series(np.concatenate(codes) if codes else [], index = np.concatenate(ids) if ids else [], dtype = object)
+    joined = matches.groupby(level = 0, sort = False, observed = True).agg(lambda x: ', '.join(sorted(set(x))))
+    
+    cdcr_nums = pd.Index(data[id_label].unique(), name = id_label)
+    return pd.DataFrame({'hit': cdcr_nums.isin(joined.index), 
+                         'matched codes': cdcr_nums.map(joined).fillna('')}, 
+                        index = cdcr_nums)
+    
+    
 def get_todays_date(order = ['year', 'month', 'day'], 
                     sep = ''):
     """
@@ -175,4 +302,111 @@ def get_todays_date(order = ['year', 'month', 'day'],
         # Better to use d in case user passes 'date' instead of 'day' in the order variable
         if val[0] == 'd':
             td.append(str(datetime.date.today().day))
-    return sep.join(td)
\ No newline at end of file
+    return sep.join(td)
+
+def get_write_path(read_path, 
+                   county_name = None, 
+                   month = None):
+    """
+
+    Parameters
+    ----------
+    read_path : str
+        Full path from where input data is read (all parent folders)
+    county_name : str, optional
+        Name of the county for which eligibility was evaluated, ex: 'Los Angeles County'
+        Default is None.
+    month : str, optional
+        Year and month for which eligibility was evaluated, ex: '2023_06'
+        Default is None.
+
+    Returns
+    -------
+    str
+        Default folder where outputs are written, i.e. county_name/month/output/date of execution/yyyy_mm_dd
+
+    """
+    return '/'.join(l for l in [read_path, county_name, month, 'output', 'date of execution', get_todays_date(sep = '_')] if l)
+
+
+def est_memory(df, 
+               sample = 1000):
+    """
+
+    Parameters
+    ----------
+    df : pandas dataframe
+        Data to estimate the memory footprint of
+    sample : int, optional
+        Number of rows to measure. The measurement is scaled up to the full number of rows
+        Default is 1000.
+
+    Returns
+    -------
+    float
+        Estimated memory footprint of the dataframe in MB (including the contents of string columns)
+
+    """
+    if len(df) == 0:
+        return 0.0
+    # Measuring every string in a large dataframe is slow, so only a sample of rows is measured
+    n = min(sample, len(df))
+    return df.iloc[:n].memory_usage(index = True, deep = True).sum()*len(df)/n/(1024*1024)
+
+
+def check_memory_budget(stage, 
+                        est_mb, 
+                        budget_mb = None):
+    """
+
+    Parameters
+    ----------
+    stage : str
+        Name of the stage for which memory is checked, ex: 'summary'
+    est_mb : float
+        Estimated memory in MB that the stage will need
+    budget_mb : float, optional
+        Memory budget in MB (see config.memory_budget_mb). If None, the budget is not checked
+        Default is None.
+
+    Returns
+    -------
+    boolean
+        True if the estimate exceeds the budget, i.e. the stage should be executed in chunks
+
+    """
+    if (budget_mb is None) or (est_mb <= budget_mb):
+        return False
+    print('Warning: stage', stage, 'is estimated to need', round(est_mb, 1), 'MB which exceeds the memory budget of', budget_mb, 'MB')
+    return True
+
+
+def compare(data, 
+            operator, 
+            threshold):
+    """
+
+    Parameters
+    ----------
+    data : pandas series or numpy array
+        Numerical values, ex: age in years
+    operator : str
+        Comparison to apply. Takes '>=', '>', '<=' or '<'
+    threshold : float
+        Value to compare against
+
+    Returns
+    -------
+    pandas series or numpy array
+        Boolean values that are True where the comparison holds (always False for missing values)
+
+    """
+    if operator == '>=':
+        return data >= threshold
+    elif operator == '>':
+        return data > threshold
+    elif operator == '<=':
+        return data <= threshold
+    elif operator == '<':
+        return data < threshold
+    raise ValueError('Comparison operator '+str(operator)+' is not supported')
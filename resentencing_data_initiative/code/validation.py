@@ -1,62 +1,170 @@
 # -*- coding: utf-8 -*-
-from helpers import *
-import config
-from extract import *
-from eligibility import *
-from summary import *
+import helpers
+import utils
+import eligibility
 import pandas as pd
-import numpy as np
-import datetime
-from tqdm import tqdm
-import copy
 import os
 
 
-# Fix path and date range (do not use config data)
-county_name = 'Los Angeles'
-month = '/'.join(['Rough', 'Data_05_2021', '21_05'])
-data_path = '/content/drive/My Drive/Stanford Law 3XP/Data'
-code_path = '/content/drive/My Drive/Stanford Law 3XP/Code'
-
-# CDCR numbers eligible for resentencing according to OpenLattice
-ol_el_cdcr_nums = pd.read_excel('/'.join([data_path, county_name, 'Rough/LA_DA_Cohort1_Update_05_2021.xlsx']))['CDCR..'].to_list()
-
-# CDCR numbers eligible for resentencing according to our logic
-errors, adult_el_cdcr_nums = gen_adult_eligibility(demographics, 
-                                                   current_commits, 
-                                                   prior_commits, 
-                                                   data_path = data_path, 
-                                                   county_name = county_name, 
-                                                   month = month,
-                                                   to_excel = False)
-
-# Find CDCR numbers eligible in OpenLattice script that are ineligible in this script
-missing_nums = []
-for cdcr_num in ol_el_cdcr_nums:
-  if (cdcr_num in demographics['CDCR #'].tolist()) and (cdcr_num not in adult_el_cdcr_nums):
-    missing_nums.append(cdcr_num)
-
-# Missing CDCR numbers
-d = {}
-write_path = '/'.join([data_path, county_name, 'Rough', 'ol_validation_.xlsx'])
-for cdcr_num in missing_nums:
-  off = current_commits[current_commits['CDCR #'] == cdcr_num]['Offense']
-  d[cdcr_num] = off.to_list()
-print('These CDCR numbers are eligible according to OpenLattice script but are ineligible according to this script')
-
-df = pd.DataFrame()
-df['CDCR #'] = d.keys()
-df['Offenses'] = d.values()
-df.to_excel(write_path, index = False)
-
-# Find CDCR numbers ineligible in this script that are eligible in OpenLattice script
-missing_nums = []
-for cdcr_num in adult_el_cdcr_nums:
-  if cdcr_num not in ol_el_cdcr_nums:
-    missing_nums.append(cdcr_num)
-
-# Missing CDCR numbers
-for cdcr_num in missing_nums:
-  off = current_commits[current_commits['CDCR #'] == cdcr_num]['Offense']
-  print(cdcr_num, ':', off.to_list(), ';')
-print('These CDCR numbers are eligible according to this script but are ineligible according to OpenLattice script')
+def read_reference(read_path,
+                   column):
+    """
+
+    Parameters
+    ----------
+    read_path : str
+        Full path of an Excel (.xlsx) or csv file with externally identified CDCR numbers, ex: the OpenLattice cohort
+    column : str
+        Name of the column with the CDCR numbers, ex: 'CDCR..'
+
+    Returns
+    -------
+    set
+        Externally identified CDCR numbers
+
+    """
+    # Only the column with the CDCR numbers is read
+    if read_path.endswith('.csv'):
+        df = pd.read_csv(read_path, usecols = [column], dtype = str)
+    else:
+        df = pd.read_excel(read_path, usecols = [column], dtype = str)
+    return set(df[column].dropna().str.strip())
+
+
+def compare(el_cdcr_nums,
+            ref_cdcr_nums,
+            demographics,
+            current_commits,
+            id_label,
+            exclusions = None,
+            eligibility_conditions = None):
+    """
+
+    Parameters
+    ----------
+    el_cdcr_nums : list or set
+        CDCR numbers identified by the scenario
+    ref_cdcr_nums : list or set
+        Externally identified CDCR numbers (see read_reference())
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated (with cleaned column names)
+    current_commits : pandas dataframe
+        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense (with cleaned column names)
+    id_label : str
+        Name of the column with the CDCR IDs
+    exclusions : dict, optional
+        Rule that excluded each CDCR number (see eligibility.apply_rules())
+        Default is None.
+    eligibility_conditions : dict, optional
+        Conditions of the scenario, used to add the description of the excluding rule
+        Default is None.
+
+    Returns
+    -------
+    df : pandas dataframe
+        One row per mismatched CDCR number, i.e. found only by the scenario or only by the reference, with whether it is in the demographics data, its current offenses and the rule that excluded it
+
+    """
+    id_label = utils.clean(id_label)
+    el_cdcr_nums = set(el_cdcr_nums)
+    ref_cdcr_nums = set(ref_cdcr_nums)
+
+    # Both set differences with hashed lookups
+    only_ref = ref_cdcr_nums - el_cdcr_nums
+    only_el = el_cdcr_nums - ref_cdcr_nums
+    df = pd.DataFrame({id_label: sorted(only_ref) + sorted(only_el),
+                       'found by': ['reference only']*len(only_ref) + ['scenario only']*len(only_el)})
+
+    # Whether the CDCR number is in the data at all
+    df['in demographics'] = df[id_label].isin(set(demographics[id_label]))
+    # Current offenses of each mismatched CDCR number (joined with a single groupby)
+    df['current offenses'] = helpers.join_by_id(data = current_commits, id_label = id_label, cdcr_nums = df[id_label], col = 'offense', sep = ', ').values
+
+    # Rule that excluded each CDCR number
+    if exclusions is not None:
+        df['excluded by'] = df[id_label].map(exclusions).fillna('').values
+        if eligibility_conditions is not None:
+            desc = {rule: eligibility_conditions[rule]['desc'] for rule in eligibility.el_rules.keys()}
+            df['excluded by (description)'] = df['excluded by'].map(desc).fillna('').values
+
+    print('Found by both: ', len(el_cdcr_nums & ref_cdcr_nums))
+    print('Found only by the scenario: ', len(only_el))
+    print('Found only by the reference: ', len(only_ref), '(in demographics data: '+str(int(df.loc[df['found by'] == 'reference only', 'in demographics'].sum()))+')')
+
+    return df
+
+
+def validate(ref_cdcr_nums,
+             demographics,
+             sorting_criteria,
+             current_commits,
+             prior_commits,
+             eligibility_conditions,
+             id_label,
+             pop_label = None,
+             write_path = None):
+    """
+
+    Parameters
+    ----------
+    ref_cdcr_nums : list or set
+        Externally identified CDCR numbers (see read_reference())
+    demographics : pandas dataframe
+        Data on individuals currently incarcerated
+    sorting_criteria : pandas dataframe
+        Data on offenses and their categories or tables
+    current_commits : pandas dataframe
+        Data on current offenses of incarcerated individuals wherein each row pertains to a single offense
+    prior_commits : pandas dataframe
+        Data on prior offenses of incarcerated individuals wherein each row pertains to a single offense
+    eligibility_conditions : dict
+        Data on all the rules, whether they should be applied or not and other specifications
+    id_label : str
+        Name of the column with the CDCR IDs
+    pop_label : str, optional
+        Label of the scenario, used to name the output file
+        Default is None.
+    write_path : str, optional
+        Full path of the folder where the mismatches should be written to Excel. If None, nothing is written
+        Default is None.
+
+    Returns
+    -------
+    el_cdcr_nums : list
+        CDCR numbers identified by the scenario
+    df : pandas dataframe
+        Mismatched CDCR numbers (see compare())
+
+    """
+    # Identify eligible CDCR numbers and record the rule that excluded everyone else
+    demographics, errors = eligibility.prep_data(demographics = demographics,
+                                                 current_commits = current_commits,
+                                                 prior_commits = prior_commits,
+                                                 id_label = id_label)
+    exclusions = {}
+    el_cdcr_nums = eligibility.apply_rules(demographics = demographics,
+                                           sorting_criteria = sorting_criteria,
+                                           current_commits = current_commits,
+                                           prior_commits = prior_commits,
+                                           eligibility_conditions = eligibility_conditions,
+                                           id_label = id_label,
+                                           exclusions = exclusions)
+
+    # Compare them with the externally identified CDCR numbers
+    df = compare(el_cdcr_nums = el_cdcr_nums,
+                 ref_cdcr_nums = ref_cdcr_nums,
+                 demographics = demographics,
+                 current_commits = current_commits,
+                 id_label = id_label,
+                 exclusions = exclusions,
+                 eligibility_conditions = eligibility_conditions)
+
+    # Write data to excel files
+    if write_path:
+        # If directory does not exist, then first create it
+        if not os.path.exists(write_path):
+            os.makedirs(write_path)
+        df.to_excel(write_path+'/'+str(pop_label)+'_validation.xlsx', index = False)
+        print('Validation of the scenario written to: ', write_path+'/'+str(pop_label)+'_validation.xlsx')
+
+    return el_cdcr_nums, df
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import re
+import threading
+import time
+
+# File system events wake the watcher up as soon as files land (optional, the folder is polled otherwise)
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+
+def get_file_names(read_path = os.path.dirname(os.path.abspath(__file__))+'/naming_convention/file_names.txt'):
+    """
+
+    Parameters
+    ----------
+    read_path : str, optional
+        Full path of the naming convention of the input files
+        Default is naming_convention/file_names.txt next to this module.
+
+    Returns
+    -------
+    list
+        Names of the files that make up the data of a month, ex: ['Demographics.xlsx', 'CurrentCommitments.xlsx', ...]
+
+    """
+    with open(read_path) as f:
+        return re.findall(r"'([^']+)'", f.read())
+
+
+def get_fingerprint(folder,
+                    file_names):
+    """
+
+    Parameters
+    ----------
+    folder : str
+        Full path of the folder with the data of a month
+    file_names : list
+        Names of the files that make up the data of a month (see get_file_names())
+
+    Returns
+    -------
+    dict or None
+        Size and modification time (ns) of each file, ex: {'Demographics.xlsx': [1024, 1690000000000000000], ...}
+        None if any of the files is missing
+
+    """
+    fingerprint = {}
+    for file_name in file_names:
+        try:
+            stat = os.stat(folder+'/'+file_name)
+        except FileNotFoundError:
+            return None
+        fingerprint[file_name] = [stat.st_size, stat.st_mtime_ns]
+    return fingerprint
+
+
+def scan(county_path,
+         file_names):
+    """
+
+    Parameters
+    ----------
+    county_path : str
+        Full path of the county folder
+    file_names : list
+        Names of the files that make up the data of a month (see get_file_names())
+
+    Returns
+    -------
+    months : dict
+        Fingerprint by month folder for the month folders that have all the files (see get_fingerprint())
+
+    """
+    months = {}
+    for entry in sorted(os.scandir(county_path), key = lambda entry: entry.name):
+        if entry.is_dir() and not entry.name.startswith('.'):
+            fingerprint = get_fingerprint(entry.path, file_names)
+            if fingerprint is not None:
+                months[entry.name] = fingerprint
+    return months
+
+
+def read_state(state_path):
+    """
+
+    Parameters
+    ----------
+    state_path : str
+        Full path of the json file with the runs of the watcher
+
+    Returns
+    -------
+    dict
+        Fingerprint, status ('complete' or 'failed') and end time of the last run of each month. Empty if the file does not exist
+
+    """
+    if not os.path.exists(state_path):
+        return {}
+    with open(state_path) as f:
+        return json.load(f)
+
+
+def write_state(state,
+                state_path):
+    """
+
+    Parameters
+    ----------
+    state : dict
+        Runs of the watcher (see read_state())
+    state_path : str
+        Full path of the json file with the runs of the watcher
+
+    Returns
+    -------
+    None.
+
+    """
+    # Replace the file in one step so that an interrupted write does not lose the earlier runs
+    with open(state_path+'.tmp', 'w') as f:
+        json.dump(state, f, indent = 2)
+    os.replace(state_path+'.tmp', state_path)
+
+
+def watch(read_path,
+          county_name,
+          run,
+          interval = 30,
+          settle = 120,
+          state_path = None,
+          file_names = None,
+          polls = None):
+    """
+
+    Parameters
+    ----------
+    read_path : str
+        Full path of the data (all parent folders)
+    county_name : str
+        Name of the county folder to watch, ex: 'Los Angeles County'
+    run : function
+        Function that runs the pipeline for a month, called with the name of the month folder, ex: run('2023_06')
+    interval : float, optional
+        Seconds between two scans of the county folder (file system events also trigger a scan if watchdog is installed)
+        Default is 30.
+    settle : float, optional
+        Seconds without any change to the files of a month before the pipeline is triggered, so that partial uploads are not picked up
+        Default is 120.
+    state_path : str, optional
+        Full path of the json file with the runs of the watcher. Months whose files did not change since their last run are not run again
+        Default is None, i.e. watcher_state.json in the county folder.
+    file_names : list, optional
+        Names of the files that make up the data of a month
+        Default is None, i.e. the files in naming_convention/file_names.txt.
+    polls : int, optional
+        Number of scans after which the watcher returns, ex: to run it from a scheduler
+        Default is None, i.e. the folder is watched until the process is interrupted.
+
+    Returns
+    -------
+    None.
+
+    """
+    county_path = '/'.join(l for l in [read_path, county_name] if l)
+    if state_path is None:
+        state_path = county_path+'/watcher_state.json'
+    if file_names is None:
+        file_names = get_file_names()
+    state = read_state(state_path)
+
+    # Wake up on file system events if watchdog is installed, otherwise only poll
+    wake = threading.Event()
+    observer = None
+    if Observer is not None:
+        handler = FileSystemEventHandler()
+        handler.on_any_event = lambda event: wake.set()
+        observer = Observer()
+        observer.schedule(handler, county_path, recursive = True)
+        observer.start()
+    print('Watching', county_path, 'for month folders with', ', '.join(file_names))
+
+    # Fingerprint of each month at the previous scan
+    seen = {}
+    try:
+        while polls is None or polls > 0:
+            for month, fingerprint in scan(county_path, file_names).items():
+                # Skip months whose files did not change since their last run
+                if month in state and state[month]['fingerprint'] == fingerprint:
+                    continue
+
+                # Wait until the files stop changing between two scans and were last modified more than settle seconds ago
+                newest = max(mtime for size, mtime in fingerprint.values())/1e9
+                if seen.get(month) != fingerprint or time.time() - newest < settle:
+                    if seen.get(month) is None:
+                        print('New or changed data found in', month+', waiting for the files to stop changing')
+                    seen[month] = fingerprint
+                    continue
+
+                print('Running the pipeline for', month)
+                try:
+                    run(month)
+                    status = 'complete'
+                except Exception as e:
+                    # Failed months are run again once their files change
+                    print('Warning: run of', month, 'failed:', repr(e))
+                    status = 'failed'
+                state[month] = {'fingerprint': fingerprint, 'status': status, 'finished': datetime.datetime.now().isoformat(timespec = 'seconds')}
+                write_state(state, state_path)
+                seen.pop(month, None)
+
+            if polls is not None:
+                polls -= 1
+                if polls == 0:
+                    break
+            wake.wait(interval)
+            wake.clear()
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
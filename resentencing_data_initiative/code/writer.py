@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+import report
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import os
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    # Parquet outputs are written as pickle files instead
+    pyarrow = None
+
+try:
+    import openpyxl
+except ImportError:
+    # Streamed Excel outputs are written as JSON lines instead
+    openpyxl = None
+
+# Formats that outputs can be streamed to (see write_stream())
+stream_formats = ['xlsx', 'jsonl', 'csv', 'parquet']
+
+
+# Thread pool that writes the outputs in the background (None means outputs are written immediately)
+executor = None
+# Limits the number of writes that are queued or running, so that finished outputs do not pile up in memory
+slots = None
+# Writes that have been submitted and not flushed yet
+pending = []
+# Total time spent writing in the background and time the run waited for a free slot since the last flush (seconds)
+write_time = [0.0]
+wait_time = [0.0]
+# Set when a write fails. The writes queued after it are skipped, since the run is stopped at the next check
+failed = threading.Event()
+lock = threading.Lock()
+
+
+def start(max_workers = 1,
+          max_pending = 4):
+    """
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Number of threads that write outputs. With a single thread, outputs are written in the order they are submitted
+        Default is 1.
+    max_pending : int, optional
+        Maximum number of writes that can be queued or running. Submitting another write waits until one of them is done
+        Default is 4.
+
+    Returns
+    -------
+    None.
+
+    """
+    global executor, slots
+    if executor is None:
+        executor = ThreadPoolExecutor(max_workers = max_workers, thread_name_prefix = 'writer')
+        slots = threading.BoundedSemaphore(max_pending)
+
+
+def check():
+    """
+
+    Returns
+    -------
+    None.
+        Raises the error of the first background write that failed, so that failures stop the run as soon as they are noticed
+
+    """
+    with lock:
+        failed_futures = [future for future in pending if future.done() and future.exception() is not None]
+        if failed_futures:
+            pending.remove(failed_futures[0])
+    if failed_futures:
+        raise failed_futures[0].exception()
+
+
+def submit(func,
+           *args,
+           **kwargs):
+    """
+
+    Parameters
+    ----------
+    func : function
+        Function that writes an output, ex: a function that calls to_excel()
+        The data it writes should not be modified after it is submitted
+    *args, **kwargs
+        Arguments of func
+
+    Returns
+    -------
+    None.
+        If the writer is not started (see start()), func is called immediately
+
+    """
+    if executor is None:
+        func(*args, **kwargs)
+        return
+
+    # Raise errors of earlier writes
+    check()
+
+    # Wait for a free slot if too many writes are queued
+    t = time.perf_counter()
+    slots.acquire()
+    with lock:
+        wait_time[0] += time.perf_counter() - t
+
+    def timed():
+        t = time.perf_counter()
+        try:
+            if not failed.is_set():
+                func(*args, **kwargs)
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            with lock:
+                write_time[0] += time.perf_counter() - t
+            slots.release()
+
+    future = executor.submit(timed)
+    with lock:
+        pending.append(future)
+
+
+def write_excel(sheets, 
+                write_path, 
+                label):
+    """
+
+    Parameters
+    ----------
+    sheets : dict
+        Data and whether to write its index by sheet name, ex: {'Cohort': (df, False)}
+    write_path : str
+        Full path of the Excel file
+    label : str
+        Description of the output used in the message, ex: 'Demographics of eligible individuals'
+    
+    Returns
+    -------
+    None.
+
+    """
+    with pd.ExcelWriter(write_path) as excel:
+        for sheet_name, (data, index) in sheets.items():
+            data.to_excel(excel, sheet_name = sheet_name, index = index)
+    print(label, 'written to: ', write_path)
+
+
+def write_parquet(data, 
+                  write_path, 
+                  label):
+    """
+
+    Parameters
+    ----------
+    data : pandas dataframe
+        Data to write (with its index)
+    write_path : str
+        Full path of the Parquet file. If pyarrow is not installed, the data is pickled to the same path with a .pkl extension instead
+    label : str
+        Description of the output used in the message, ex: 'Explanations of eligibility'
+    
+    Returns
+    -------
+    None.
+
+    """
+    if pyarrow is None:
+        write_path = os.path.splitext(write_path)[0]+'.pkl'
+        print('Warning: pyarrow is not installed, so the', label.lower(), 'are pickled instead of written to Parquet')
+        data.to_pickle(write_path)
+    else:
+        data.to_parquet(write_path)
+    print(label, 'written to: ', write_path)
+
+
+def write_stream(batches, 
+                 write_path, 
+                 label):
+    """
+
+    Parameters
+    ----------
+    batches : iterable
+        Pandas dataframes with the same columns, ex: summaries of consecutive batches of a cohort (see helpers.iter_summary())
+    write_path : str
+        Full path of the output. The format is taken from the extension, i.e. .xlsx, .jsonl, .csv or .parquet
+        If openpyxl (for .xlsx) or pyarrow (for .parquet) is not installed, the batches are written as JSON lines to the same path with a .jsonl extension instead
+    label : str
+        Description of the output used in the message, ex: 'Summary of individuals'
+    
+    Returns
+    -------
+    write_path : str
+        Full path of the file that was written
+    count : int
+        Number of rows written
+
+    """
+    fmt = os.path.splitext(write_path)[1].lstrip('.')
+    if fmt not in stream_formats:
+        raise ValueError('Outputs cannot be streamed to .'+fmt+' files. Available formats are: '+', '.join(stream_formats))
+    if ((fmt == 'xlsx') and (openpyxl is None)) or ((fmt == 'parquet') and (pyarrow is None)):
+        print('Warning:', 'openpyxl' if fmt == 'xlsx' else 'pyarrow', 'is not installed, so the', label.lower(), 'is written as JSON lines instead')
+        fmt = 'jsonl'
+        write_path = os.path.splitext(write_path)[0]+'.jsonl'
+    
+    # Each batch is appended to the file as soon as it is generated, so only one batch is held in memory at a time
+    count = 0
+    f = open(write_path, 'w', newline = '') if fmt in ['jsonl', 'csv'] else None
+    workbook = None
+    parquet = None
+    try:
+        for i, batch in enumerate(batches):
+            if fmt == 'jsonl':
+                if len(batch):
+                    f.write(batch.to_json(orient = 'records', lines = True, date_format = 'iso', default_handler = str).rstrip('\n')+'\n')
+            elif fmt == 'csv':
+                batch.to_csv(f, index = False, header = (i == 0))
+            elif fmt == 'xlsx':
+                # Rows are written to a temporary file by the write-only workbook, not kept in memory
+                if workbook is None:
+                    workbook = openpyxl.Workbook(write_only = True)
+                    sheet = workbook.create_sheet('Sheet1')
+                    sheet.append([str(col) for col in batch.columns])
+                for row in batch.itertuples(index = False):
+                    sheet.append([None if pd.isna(val) else val for val in row])
+            else:
+                # Columns that are empty in the first batch are written as strings
+                if parquet is None:
+                    schema = pyarrow.Schema.from_pandas(batch, preserve_index = False)
+                    schema = pyarrow.schema([field.with_type(pyarrow.string()) if pyarrow.types.is_null(field.type) else field for field in schema])
+                    parquet = pyarrow.parquet.ParquetWriter(write_path, schema)
+                parquet.write_table(pyarrow.Table.from_pandas(batch, schema = schema, preserve_index = False))
+            count += len(batch)
+    finally:
+        if f is not None:
+            f.close()
+        if parquet is not None:
+            parquet.close()
+    if workbook is not None:
+        workbook.save(write_path)
+    print(label, 'written to: ', write_path, '('+str(count)+' rows)')
+    return write_path, count
+
+
+def flush(run_report = None):
+    """
+
+    Parameters
+    ----------
+    run_report : list, optional
+        Records of the run (see report.track()). A 'flush writes' record is added with the total time spent writing in the background and the share of it that was hidden behind the computation
+        Default is None.
+
+    Returns
+    -------
+    None.
+        Waits for all the submitted writes and raises the error of the first write that failed
+
+    """
+    with report.track(run_report, stage = 'flush writes', input_size = len(pending)) as record:
+        errors = []
+        wait = time.perf_counter()
+        while pending:
+            with lock:
+                future = pending.pop(0)
+            if future.exception() is not None:
+                errors.append(future.exception())
+        wait = time.perf_counter() - wait
+        failed.clear()
+        with lock:
+            total = write_time[0]
+            write_time[0] = 0.0
+            wait += wait_time[0]
+            wait_time[0] = 0.0
+        record['output size'] = record['input size']
+        record['write time (s)'] = round(total, 4)
+        # Writing time that overlapped with the computation, i.e. the run did not wait for it (at submission or at the flush)
+        record['hidden write time (s)'] = round(max(total - wait, 0), 4)
+
+    if errors:
+        raise errors[0]
+
+
+def stop(run_report = None):
+    """
+
+    Parameters
+    ----------
+    run_report : list, optional
+        Records of the run (see flush())
+        Default is None.
+
+    Returns
+    -------
+    None.
+        Waits for all the submitted writes and shuts the thread pool down. Outputs are written immediately afterwards
+
+    """
+    global executor, slots
+    if executor is None:
+        return
+    try:
+        flush(run_report)
+    finally:
+        executor.shutdown(wait = True)
+        executor = None
+        slots = None